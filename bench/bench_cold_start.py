@@ -0,0 +1,123 @@
+"""Cold start: time until the port answers, the first update is handled, the backlog is gone.
+
+    python bench/bench_cold_start.py [--users 100000] [--backlog 200] [--runs 3]
+
+Starts ``bot.py`` (``RUN_MODE=webhook``) as a fresh process against the
+fake Bot API, with a stats.json of ``--users`` users and
+``pending_update_count`` set to ``--backlog``, the way a sleeping
+instance wakes up.  The bench plays Telegram: it connects as soon as the
+port accepts and POSTs the backlog (distinct users sending /start) over
+``--connections`` parallel connections, like ``max_connections``.
+
+Reported, as seconds since the process was spawned:
+``port`` (first accepted connection), ``first 200`` (first update
+answered — time-to-first-response), ``drained`` (last backlog update
+answered), plus the milestones the bot logs itself (``startup: ...``).
+The first run registers the webhook; later runs find it unchanged and
+skip ``setWebhook``.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+import aiohttp
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT = BENCH_DIR.parent
+sys.path.insert(0, str(BENCH_DIR))
+
+from bench_store import synth_users  # noqa: E402
+from fake_bot_api import FakeBotApi, start  # noqa: E402
+from loadtest import FIRST_UID, SECRET, free_port, make_update  # noqa: E402
+
+
+async def wait_port(port: int, started: float, timeout: float) -> float:
+    while perf_counter() - started < timeout:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return perf_counter() - started
+        except OSError:
+            await asyncio.sleep(0.005)
+    raise TimeoutError(f"port {port} did not open in {timeout}s")
+
+
+async def read_milestones(stream: asyncio.StreamReader, out: dict):
+    async for raw in stream:
+        try:
+            doc = json.loads(raw)
+        except ValueError:
+            continue
+        if "phase" in doc:
+            out[doc["phase"]] = doc["ms"] / 1000
+
+
+async def one_run(args, api: FakeBotApi, api_port: int, data_dir: Path) -> dict:
+    port = free_port()
+    api.pending_update_count = args.backlog
+    env = dict(os.environ,
+               BOT_TOKEN="123456:COLDSTART", RUN_MODE="webhook", PORT=str(port), WEBHOOK_SECRET=SECRET,
+               TELEGRAM_API_URL=f"http://127.0.0.1:{api_port}", RENDER_EXTERNAL_URL=f"http://127.0.0.1:{port}",
+               DATA_DIR=str(data_dir), STORE_BACKEND=args.store, LOG_FORMAT="json", METRICS_PORT="0",
+               OUTBOUND_GLOBAL_RATE="1000000", OUTBOUND_CHAT_RATE="1000", OUTBOUND_CHAT_BURST="1000",
+               STARTUP_DRAIN_RATE=str(args.drain_rate))
+    started = perf_counter()
+    proc = await asyncio.create_subprocess_exec(sys.executable, str(ROOT / "bot.py"), cwd=str(ROOT), env=env,
+                                                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    milestones: dict = {}
+    reader = asyncio.create_task(read_milestones(proc.stderr, milestones))
+    answered: list[float] = []
+    try:
+        port_s = await wait_port(port, started, args.timeout)
+        url = f"http://127.0.0.1:{port}/webhook/{SECRET}"
+        sem = asyncio.Semaphore(args.connections)
+        timeout = aiohttp.ClientTimeout(total=args.timeout)
+        async with aiohttp.ClientSession(timeout=timeout) as http:
+            async def deliver(i: int):
+                async with sem:
+                    async with http.post(url, json=make_update(i + 1, FIRST_UID + i, "/start"),
+                                         headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}) as resp:
+                        if resp.status == 200:
+                            answered.append(perf_counter() - started)
+            await asyncio.gather(*(deliver(i) for i in range(args.backlog)))
+    finally:
+        proc.terminate()
+        await proc.wait()
+        await reader
+    return {"port": port_s, "first 200": min(answered, default=float("nan")),
+            "drained": max(answered, default=float("nan")), "ok": len(answered), **milestones}
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--backlog", type=int, default=200)
+    parser.add_argument("--connections", type=int, default=40)
+    parser.add_argument("--drain-rate", type=float, default=20.0)
+    parser.add_argument("--store", choices=("json", "sqlite", "journal"), default="json")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+
+    api = FakeBotApi(seed=1)
+    api_port = free_port()
+    api_runner = await start(api, api_port)
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = Path(tmp)
+        (data_dir / "stats.json").write_text(json.dumps({"users": synth_users(args.users)}))
+        print(f"store={args.store} users={args.users:,} backlog={args.backlog} "
+              f"drain={args.drain_rate}/s connections={args.connections}")
+        for run in range(args.runs):
+            res = await one_run(args, api, api_port, data_dir)
+            print(f"run {run + 1}: " + ", ".join(
+                f"{k} {v:.3f}s" if isinstance(v, float) else f"{k} {v}" for k, v in res.items()))
+    await api_runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,106 @@
+"""Journal backend: write throughput vs full stats.json rewrites, and recovery time.
+
+    python bench/bench_journal.py [--users 100000] [--entries 100000 1000000] [--batch 100]
+
+Writes: ``--batch`` dirty users per flush (one field each, like
+``set_stage``), flushed ``--flushes`` times through ``JsonBackend.write``
+(rewrite the document) and ``JournalBackend.write`` (append + fsync).
+Reported as flushes/s and changed fields/s.
+
+Recovery: a snapshot of ``--users`` users plus a journal of N entries,
+then ``JournalBackend.load()`` from cold; the result is checked against
+the state that was written.  Compaction time for the same state is shown
+for comparison.
+"""
+import argparse
+import random
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from bench_store import synth_users  # noqa: E402
+from journal import JournalBackend  # noqa: E402
+from records import records_from_json, records_to_json  # noqa: E402
+from store import JsonBackend, atomic_write_text  # noqa: E402
+
+
+def seed(path: Path, users: dict):
+    import json
+    atomic_write_text(path, json.dumps({"users": users}, separators=(",", ":")))
+
+
+def churn(records: dict, uids: list, batch: int, rnd: random.Random) -> dict:
+    dirty = {}
+    for uid in rnd.sample(uids, batch):
+        rec = dirty[uid] = records[uid].replace(stage=rnd.randint(0, 9), ts=1758000000 + rnd.randint(0, 10**6))
+        records[uid] = rec
+    return dirty
+
+
+def bench_writes(tmp: Path, users: dict, batch: int, flushes: int):
+    print(f"\n== writes: {len(users):,} users, {batch} dirty per flush ==")
+    print(f"{'backend':<10}{'flushes/s':>12}{'fields/s':>14}{'ms/flush':>10}")
+    for backend in (JsonBackend(tmp / "w_json.json"), JournalBackend(tmp / "w_journal.json")):
+        seed(backend.path, users)
+        records, _ = backend.load()
+        uids = list(records)
+        rnd = random.Random(1)
+        n = max(3, flushes // 20) if backend.name == "json" else flushes
+        started = perf_counter()
+        for _ in range(n):
+            backend.write(churn(records, uids, batch, rnd), {})
+        elapsed = perf_counter() - started
+        backend.close()
+        print(f"{backend.name:<10}{n / elapsed:>12.1f}{n * batch * 2 / elapsed:>14.0f}{elapsed / n * 1000:>10.2f}")
+
+
+def bench_recovery(tmp: Path, users: dict, entries: int, batch: int):
+    path = tmp / f"r_{entries}.json"
+    seed(path, users)
+    backend = JournalBackend(path, compact_bytes=2**62)
+    records, _ = backend.load()
+    uids = list(records)
+    rnd = random.Random(entries)
+    written = 0
+    while written < entries:
+        backend.write(churn(records, uids, batch, rnd), {"meta": {"n": written}})
+        written = backend.entries
+    journal_mb = backend.journal_bytes / 2**20
+    backend.close()
+
+    fresh = JournalBackend(path, compact_bytes=2**62)
+    started = perf_counter()
+    loaded, sections = fresh.load()
+    recovery_s = perf_counter() - started
+    assert records_to_json(loaded) == records_to_json(records), "replay diverged"
+    started = perf_counter()
+    fresh.compact()
+    compact_s = perf_counter() - started
+    fresh.close()
+    assert not fresh.journal_path.stat().st_size and not fresh.old_path.exists()
+    print(f"{entries:>12,}{journal_mb:>12.1f}{recovery_s:>14.2f}{compact_s:>14.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--entries", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--flushes", type=int, default=200)
+    args = parser.parse_args()
+    users = synth_users(args.users)
+    assert records_to_json(records_from_json(users)) == users
+    with tempfile.TemporaryDirectory() as tmp:
+        bench_writes(Path(tmp), users, args.batch, args.flushes)
+        print(f"\n== recovery: snapshot of {args.users:,} users + journal ==")
+        print(f"{'entries':>12}{'journal MB':>12}{'load, s':>14}{'snapshot, s':>14}")
+        for n in args.entries:
+            bench_recovery(Path(tmp), users, n, args.batch)
+
+
+if __name__ == "__main__":
+    main()
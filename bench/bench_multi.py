@@ -0,0 +1,134 @@
+"""Webhook throughput with 1, 2, 4 and 8 worker processes (RUN_MODE=webhook-multi).
+
+    python bench/bench_multi.py [--workers 1,2,4,8] [--updates 5000] [--concurrency 200]
+
+For each worker count the bot is started as a subprocess against the fake
+Bot API (bench/fake_bot_api.py) with a throwaway DATA_DIR and the SQLite
+store, then ``--updates`` "/start" updates from distinct users are POSTed
+to the webhook with ``--concurrency`` requests in flight.  The webhook
+answers after the handler ran (WEBHOOK_ACK_MODE=sync), so updates/s is
+end-to-end handler throughput.  Outbound rate limits are lifted so the
+bot, not the Telegram limits, is what gets measured.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter, time
+
+import aiohttp
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from fake_bot_api import FakeBotApi, start  # noqa: E402
+
+ROOT = Path(__file__).resolve().parent.parent
+SECRET = "bench"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_update(update_id: int, uid: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": {"id": uid, "is_bot": False, "first_name": "u"},
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }
+
+
+async def wait_ready(api: FakeBotApi, workers: int, proc: subprocess.Popen, timeout: float = 60):
+    # каждый воркер зовёт getMe прямо перед тем, как занять порт
+    deadline = perf_counter() + timeout
+    while api.calls["getMe"] < workers:
+        if proc.poll() is not None:
+            raise RuntimeError(f"bot exited with {proc.returncode}")
+        if perf_counter() > deadline:
+            raise RuntimeError("bot did not start in time")
+        await asyncio.sleep(0.1)
+    await asyncio.sleep(1.0)
+
+
+async def run_one(workers: int, updates: int, concurrency: int) -> float:
+    api = FakeBotApi()
+    api_port, port = free_port(), free_port()
+    runner = await start(api, api_port)
+    with tempfile.TemporaryDirectory() as data_dir:
+        env = dict(
+            os.environ,
+            BOT_TOKEN="123456:BENCH",
+            RUN_MODE="webhook-multi",
+            WEB_PROCESSES=str(workers),
+            PORT=str(port),
+            WEBHOOK_SECRET=SECRET,
+            TELEGRAM_API_URL=f"http://127.0.0.1:{api_port}",
+            RENDER_EXTERNAL_URL=f"http://127.0.0.1:{port}",
+            DATA_DIR=data_dir,
+            STORE_BACKEND="sqlite",
+            OUTBOUND_GLOBAL_RATE="1000000",
+            OUTBOUND_CHAT_BURST="1000",
+        )
+        proc = subprocess.Popen([sys.executable, str(ROOT / "bot.py")], env=env, cwd=str(ROOT),
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            await wait_ready(api, workers, proc)
+            url = f"http://127.0.0.1:{port}/webhook/{SECRET}"
+            sem = asyncio.Semaphore(concurrency)
+            failed = 0
+            # новое соединение на каждый запрос, иначе keep-alive прибьёт всё к одному воркеру
+            connector = aiohttp.TCPConnector(limit=concurrency, force_close=True)
+            async with aiohttp.ClientSession(connector=connector) as http:
+                async def post(i: int):
+                    nonlocal failed
+                    async with sem:
+                        async with http.post(url, json=start_update(i, 1_000_000 + i),
+                                             headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}) as resp:
+                            if resp.status != 200:
+                                failed += 1
+
+                started = perf_counter()
+                await asyncio.gather(*(post(i) for i in range(1, updates + 1)))
+                elapsed = perf_counter() - started
+            if failed:
+                print(f"  warning: {failed} webhook requests failed")
+            return updates / elapsed
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+            await runner.cleanup()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="1,2,4,8")
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"cpus={os.cpu_count()} updates={args.updates} concurrency={args.concurrency}")
+    base = None
+    for workers in [int(w) for w in args.workers.split(",")]:
+        rate = await run_one(workers, args.updates, args.concurrency)
+        base = base or rate
+        print(f"workers={workers:<2} {rate:8.0f} updates/s  x{rate / base:.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
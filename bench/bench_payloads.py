@@ -0,0 +1,136 @@
+"""Per-send preparation cost of a course post: rebuilt every time vs pre-rendered.
+
+    python bench/bench_payloads.py [--ops 20000]
+
+"before" reproduces the old ``_send_course_post``: a fresh
+``InlineKeyboardBuilder`` for the keyboard, the media items list, a
+``FileIdCache.media`` lookup per local file (a ``stat()`` each) and a new
+``MediaGroupBuilder``.  "after" is ``PayloadCache.get`` plus copying the
+prepared media tuple into the list ``send_media_group`` takes.  The API
+call itself is not included.
+
+Reported per send: CPU time (µs) and peak transient allocation (bytes,
+tracemalloc), for a text post and a two-video + photo album.
+"""
+import argparse
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+from time import process_time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from aiogram.types import InlineKeyboardButton  # noqa: E402
+from aiogram.utils.keyboard import InlineKeyboardBuilder  # noqa: E402
+from aiogram.utils.media_group import MediaGroupBuilder  # noqa: E402
+
+from media_cache import FileIdCache  # noqa: E402
+from payloads import PayloadCache, PostPayload  # noqa: E402
+
+SITE_URL = "https://example.com/course"
+TEXT = "Пост курса " * 40
+PHOTO = "https://files.fm/thumb_show.php?i=bench"
+
+
+def kb_course_2():
+    kb = InlineKeyboardBuilder()
+    kb.row(InlineKeyboardButton(text="Мини курс по P2P", url=SITE_URL))
+    return kb.as_markup()
+
+
+def build_group(text, items, medias):
+    group = MediaGroupBuilder(caption=text)
+    for (kind, _, spec), media in zip(items, medias):
+        if kind == "photo":
+            group.add_photo(media=media)
+        else:
+            group.add_video(media=media, height=spec["height"], width=spec["width"])
+    return group.build()
+
+
+def setup_cache(tmp: Path) -> tuple[FileIdCache, list]:
+    cache = FileIdCache(tmp / "media_cache.json", tmp)
+    videos = []
+    for n in (1, 2):
+        path = tmp / f"post_{n}.mp4"
+        path.write_bytes(b"\0" * 1024)
+        cache._entries[cache._key(str(path), "video")] = f"BAACAgIAAxkBAAI{n:06d}"
+        videos.append({"path": str(path), "height": 1280, "width": 720})
+    return cache, videos
+
+
+def before_text():
+    return TEXT, kb_course_2()
+
+
+def make_before_album(cache: FileIdCache, videos: list):
+    def run():
+        keyboard = kb_course_2()
+        items = [("photo", None, PHOTO)] + [("video", v["path"], v) for v in videos]
+        medias = [cache.media(path, kind) if path else media for kind, path, media in items]
+        return build_group(TEXT, items, medias), keyboard
+    return run
+
+
+def make_after(cache: FileIdCache, videos: list):
+    keyboard = kb_course_2()
+
+    def render(key):
+        if key == "text":
+            return PostPayload(key, TEXT, keyboard)
+        items = tuple([("photo", None, PHOTO)] + [("video", v["path"], v) for v in videos])
+        ready = cache.ready_media(list(items))
+        return PostPayload(key, TEXT, shape="media_group", items=items,
+                           media=tuple(build_group(TEXT, items, ready)))
+
+    posts = PayloadCache(render, lambda: cache.version)
+
+    def text():
+        post = posts.get("text")
+        return post.text, post.keyboard
+
+    def album():
+        post = posts.get("album")
+        return list(post.media), post.follow_up
+    return text, album
+
+
+def measure(fn, ops: int) -> tuple[float, float]:
+    fn()  # прогрев (и первый рендер для «after»)
+    started = process_time()
+    for _ in range(ops):
+        fn()
+    cpu_us = (process_time() - started) / ops * 1e6
+    tracemalloc.start()
+    peaks = 0
+    samples = min(ops, 2000)
+    for _ in range(samples):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        fn()
+        peaks += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return cpu_us, peaks / samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ops", type=int, default=20000)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        cache, videos = setup_cache(Path(tmp))
+        after_text, after_album = make_after(cache, videos)
+        cases = [
+            ("text post", before_text, after_text),
+            ("album (photo + 2 videos)", make_before_album(cache, videos), after_album),
+        ]
+        print(f"{'case':28} {'before µs':>10} {'after µs':>10} {'before B':>10} {'after B':>10}")
+        for name, before, after in cases:
+            b_cpu, b_mem = measure(before, args.ops)
+            a_cpu, a_mem = measure(after, args.ops)
+            print(f"{name:28} {b_cpu:10.2f} {a_cpu:10.2f} {b_mem:10.0f} {a_mem:10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Memory per user: stats.json dict layout vs ``UserRecord``.
+
+    python bench/bench_records.py [--sizes 100000 1000000]
+
+"dict" is what UserStore held before: ``{"1378979725": {"stage": ...,
+"ts": ..., "watched": {"1": true}}}``.  "record" is ``{1378979725:
+UserRecord}``.  Both are built from the same synthetic users (the
+``bench_store`` generator) with tracemalloc running; the number is what
+stays allocated once the mapping is built.  Also printed: field read
+latency over random users and on one hot record (the bare cost of
+``get()``), and the time to convert from / back to the JSON schema.
+"""
+import argparse
+import gc
+import random
+import sys
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from bench_store import synth_users  # noqa: E402
+from records import UserRecord, records_from_json, records_to_json  # noqa: E402
+
+
+def traced(build) -> tuple[object, int]:
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def read_us(users, keys: list, ops: int = 200_000, hot: bool = False) -> float:
+    # hot — всё время одна запись: чистая цена get() без промахов кеша
+    picks = [keys[0]] * ops if hot else [random.choice(keys) for _ in range(ops)]
+    started = perf_counter()
+    for key in picks:
+        users[key].get("pm_ok", False)
+        users[key].get("stage", 0)
+    return (perf_counter() - started) / ops / 2 * 1e6
+
+
+def run(n: int):
+    source = synth_users(n)
+    # новые строки-ключи и вложенные dict, как после json.loads
+    as_dicts, dict_bytes = traced(lambda: {
+        str(int(k)): dict(v, **({"watched": dict(v["watched"])} if "watched" in v else {}))
+        for k, v in source.items()})
+    records, record_bytes = traced(lambda: records_from_json(source))
+    started = perf_counter()
+    records_from_json(source)
+    convert_s = perf_counter() - started
+    assert all(isinstance(r, UserRecord) for r in records.values())
+    started = perf_counter()
+    back = records_to_json(records)
+    export_s = perf_counter() - started
+    assert back == source, "round trip changed the data"
+    del back
+
+    print(f"\n== {n:,} users ==")
+    print(f"{'layout':<10}{'total MB':>12}{'B/user':>10}{'get, us':>10}{'hot get, us':>13}")
+    for name, users, size in (("dict", as_dicts, dict_bytes), ("record", records, record_bytes)):
+        keys = list(users)
+        print(f"{name:<10}{size / 2**20:>12.1f}{size / n:>10.0f}{read_us(users, keys):>10.3f}"
+              f"{read_us(users, keys, hot=True):>13.3f}")
+    print(f"saved {1 - record_bytes / dict_bytes:.0%}; from JSON {convert_s:.2f} s, "
+          f"back to JSON {export_s:.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+    args = parser.parse_args()
+    for n in args.sizes:
+        run(n)
+
+
+if __name__ == "__main__":
+    main()
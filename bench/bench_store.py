@@ -0,0 +1,135 @@
+"""Per-operation latency: legacy stats.json rewrite vs SQLite vs in-memory store.
+
+    python bench/bench_store.py --sizes 10000 100000 1000000
+
+"legacy json" reproduces the old accessors: every get parses the whole
+file and every set re-serializes it with indent=2.  "sqlite" is a point
+SELECT / single-row upsert+commit on the WAL database.  "store" is the
+in-memory UserStore path the bot uses now (reads from memory, writes only
+mark the record dirty); its batched flush is timed separately.
+"""
+import argparse
+import asyncio
+import json
+import random
+import sqlite3
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from store import (JsonBackend, SqliteBackend, UserStore, _SQLITE_SCHEMA,  # noqa: E402
+                   _UPSERT_USER, _record_to_row)
+
+
+def synth_users(n: int) -> dict:
+    rnd = random.Random(n)
+    users = {}
+    for i in range(n):
+        rec = {"stage": rnd.randint(0, 9), "ts": 1757000000 + rnd.randint(0, 10 ** 6)}
+        if rnd.random() < 0.6:
+            rec["pm_ok"] = True
+        if rnd.random() < 0.3:
+            rec["watched"] = {"1": True, "2": rnd.random() < 0.5}
+        if rnd.random() < 0.1:
+            rec["diary_request"] = True
+            rec["diary_ts"] = rec["ts"] + 100
+        users[str(1_000_000_000 + i)] = rec
+    return users
+
+
+def timed(fn, ops: int) -> float:
+    """Mean latency of ``fn`` in microseconds."""
+    started = perf_counter()
+    for _ in range(ops):
+        fn()
+    return (perf_counter() - started) / ops * 1e6
+
+
+def bench_legacy_json(path: Path, uids: list, ops: int) -> tuple[float, float]:
+    def get():
+        d = json.loads(path.read_text() or "{}")
+        d.get("users", {}).get(random.choice(uids), {}).get("stage", 0)
+
+    def set_():
+        d = json.loads(path.read_text() or "{}")
+        u = d.setdefault("users", {}).setdefault(random.choice(uids), {})
+        u["stage"] = 3
+        path.write_text(json.dumps(d, ensure_ascii=False, indent=2))
+
+    return timed(get, ops), timed(set_, ops)
+
+
+def bench_sqlite(path: Path, uids: list, ops: int) -> tuple[float, float]:
+    conn = sqlite3.connect(str(path))
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    int_uids = [int(u) for u in uids]
+
+    def get():
+        conn.execute("SELECT stage FROM users WHERE uid = ?", (random.choice(int_uids),)).fetchone()
+
+    def set_():
+        with conn:
+            conn.execute(_UPSERT_USER, _record_to_row(random.choice(int_uids), {"stage": 3, "ts": 1}))
+
+    res = timed(get, ops), timed(set_, ops)
+    conn.close()
+    return res
+
+
+def bench_store(store: UserStore, uids: list, ops: int) -> tuple[float, float, float, int]:
+    int_uids = [int(u) for u in uids]
+    get = lambda: store.get_field(random.choice(int_uids), "stage", 0)  # noqa: E731
+    set_ = lambda: store.update_user(random.choice(int_uids), stage=3, ts=1)  # noqa: E731
+    get_us, set_us = timed(get, ops), timed(set_, ops)
+    dirty = len(store._dirty)
+    started = perf_counter()
+    asyncio.run(store.flush())
+    return get_us, set_us, (perf_counter() - started) * 1000, dirty
+
+
+def run(n: int, tmp: Path):
+    users = synth_users(n)
+    uids = list(users)
+    json_path = tmp / f"stats_{n}.json"
+    db_path = tmp / f"users_{n}.db"
+    json_path.write_text(json.dumps({"users": users}, ensure_ascii=False, indent=2))
+
+    conn = sqlite3.connect(str(db_path))
+    conn.executescript(_SQLITE_SCHEMA)
+    with conn:
+        conn.executemany(_UPSERT_USER, [_record_to_row(int(k), v) for k, v in users.items()])
+    conn.close()
+
+    slow_ops = max(3, min(200, 2_000_000 // n))
+    fast_ops = 20_000
+
+    print(f"\n== {n:,} users ==")
+    print(f"{'backend':<22}{'get, us':>14}{'set, us':>14}")
+    g, s = bench_legacy_json(json_path, uids, slow_ops)
+    print(f"{'legacy json (' + str(slow_ops) + ' ops)':<22}{g:>14.1f}{s:>14.1f}")
+    g, s = bench_sqlite(db_path, uids, fast_ops)
+    print(f"{'sqlite':<22}{g:>14.1f}{s:>14.1f}")
+    for backend in (JsonBackend(json_path), SqliteBackend(db_path)):
+        store = UserStore(backend)
+        store.load()
+        g, s, flush_ms, dirty = bench_store(store, uids, fast_ops)
+        backend.close()
+        print(f"{'store/' + backend.name:<22}{g:>14.2f}{s:>14.2f}"
+              f"   flush {dirty:,} dirty in {flush_ms:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in args.sizes:
+            run(n, Path(tmp))
+
+
+if __name__ == "__main__":
+    main()
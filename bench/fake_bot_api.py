@@ -0,0 +1,211 @@
+"""Fake Telegram Bot API server for load tests.
+
+    python bench/fake_bot_api.py [--port 8081] [--latency-ms 20-80] [--rate-429 0.01] [--error-rate 0.01]
+
+Point the bot at it with ``TELEGRAM_API_URL=http://127.0.0.1:8081``.
+Every method answers ``ok`` with a plausible result (messages carry a
+fake ``file_id`` for media), after an optional random latency.  A share
+of calls can be answered with 429 (``retry_after``) or a 500 instead.
+Calls are counted per method and per chat.
+
+Polling is supported too: ``push_update()`` queues an update for
+``getUpdates``, and ``wait_response(chat_id)`` resolves on the next API
+call the bot makes for that chat, which the load generator uses as the
+handler latency in polling mode.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+from collections import Counter
+from time import time
+from typing import Any, Dict, Optional
+
+from aiohttp import web
+
+_MEDIA_FIELDS = {
+    "sendPhoto": "photo",
+    "sendVideo": "video",
+    "sendVideoNote": "video_note",
+    "sendDocument": "document",
+}
+# служебные методы не ломаем, иначе бот просто не стартует
+_CONTROL_METHODS = {"getMe", "getUpdates", "setWebhook", "deleteWebhook", "getWebhookInfo"}
+
+
+def parse_range(value: str) -> tuple[float, float]:
+    """``"20"`` -> (20, 20), ``"20-80"`` -> (20, 80)."""
+    lo, _, hi = value.partition("-")
+    return float(lo), float(hi or lo)
+
+
+class FakeBotApi:
+    def __init__(self, latency_ms: tuple[float, float] = (0.0, 0.0), rate_429: float = 0.0,
+                 retry_after: int = 1, error_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency_ms = latency_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.calls: Counter[str] = Counter()
+        self.by_chat: Counter[int] = Counter()
+        self.injected_429 = 0
+        self.injected_errors = 0
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._updates: list[Dict[str, Any]] = []
+        self._updates_added: asyncio.Event | None = None
+        self._waiters: Dict[int, list[asyncio.Future]] = {}
+        self.webhook_url = ""
+        self.allowed_updates: list = []
+        self.max_connections = 40
+        self.pending_update_count = 0  # что getWebhookInfo скажет про накопившиеся апдейты (холодный старт)
+
+    # ----- polling -----
+    def push_update(self, update: Dict[str, Any]):
+        self._updates.append(update)
+        if self._updates_added is not None:
+            self._updates_added.set()
+
+    def wait_response(self, chat_id: int) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(chat_id, []).append(fut)
+        return fut
+
+    async def _get_updates(self, params: Dict[str, Any]) -> list:
+        if self._updates_added is None:
+            self._updates_added = asyncio.Event()
+        offset = int(params.get("offset") or 0)
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates:
+            self._updates_added.clear()
+            try:
+                await asyncio.wait_for(self._updates_added.wait(), timeout=float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:int(params.get("limit") or 100)]
+
+    # ----- results -----
+    def _message(self, chat_id: int, method: str) -> Dict[str, Any]:
+        msg: Dict[str, Any] = {
+            "message_id": next(self._message_ids),
+            "date": int(time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+        }
+        field = _MEDIA_FIELDS.get(method)
+        n = next(self._file_ids)
+        if field == "photo":
+            msg["photo"] = [{"file_id": f"photo{n}", "file_unique_id": f"u{n}", "width": 1280, "height": 720}]
+        elif field == "video":
+            msg["video"] = {"file_id": f"video{n}", "file_unique_id": f"u{n}", "width": 1280,
+                            "height": 720, "duration": 10}
+        elif field == "video_note":
+            msg["video_note"] = {"file_id": f"note{n}", "file_unique_id": f"u{n}", "length": 240, "duration": 10}
+        elif field == "document":
+            msg["document"] = {"file_id": f"doc{n}", "file_unique_id": f"u{n}"}
+        else:
+            msg["text"] = "ok"
+        return msg
+
+    def result_for(self, method: str, params: Dict[str, Any]) -> Any:
+        chat_id = int(params.get("chat_id") or 0)
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "getWebhookInfo":
+            info = {"url": self.webhook_url, "has_custom_certificate": False,
+                    "pending_update_count": self.pending_update_count or len(self._updates)}
+            if self.webhook_url:
+                info.update(allowed_updates=self.allowed_updates, max_connections=self.max_connections)
+            return info
+        if method == "setWebhook":
+            self.webhook_url = params.get("url", "")
+            allowed = params.get("allowed_updates") or []
+            self.allowed_updates = json.loads(allowed) if isinstance(allowed, str) else list(allowed)
+            self.max_connections = int(params.get("max_connections") or 40)
+            return True
+        if method == "deleteWebhook":
+            self.webhook_url = ""
+            return True
+        if method == "getChatMember":
+            user_id = int(params.get("user_id") or 0)
+            return {"status": "left", "user": {"id": user_id, "is_bot": False, "first_name": "u"}}
+        if method == "sendMediaGroup":
+            media = params.get("media") or "[]"
+            items = json.loads(media) if isinstance(media, str) else media
+            return [self._message(chat_id, "sendVideo" if it.get("type") == "video" else "sendPhoto")
+                    for it in items] or [self._message(chat_id, "sendPhoto")]
+        if method.startswith(("send", "copy", "forward")):
+            return self._message(chat_id, method)
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+
+        lo, hi = self.latency_ms
+        if hi > 0:
+            await asyncio.sleep(self.rng.uniform(lo, hi) / 1000)
+        chat_id = int(params["chat_id"]) if str(params.get("chat_id", "")).lstrip("-").isdigit() else None
+        if chat_id is not None:
+            self.by_chat[chat_id] += 1
+        if method not in _CONTROL_METHODS:
+            roll = self.rng.random()
+            if roll < self.rate_429:
+                self.injected_429 += 1
+                return web.json_response(
+                    {"ok": False, "error_code": 429,
+                     "description": f"Too Many Requests: retry after {self.retry_after}",
+                     "parameters": {"retry_after": self.retry_after}}, status=429)
+            if roll < self.rate_429 + self.error_rate:
+                self.injected_errors += 1
+                return web.json_response(
+                    {"ok": False, "error_code": 500, "description": "Internal Server Error: injected"}, status=500)
+        if chat_id is not None:
+            for fut in self._waiters.pop(chat_id, ()):
+                if not fut.done():
+                    fut.set_result(time())
+        return web.json_response({"ok": True, "result": self.result_for(method, params)})
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": dict(self.calls),
+            "total_calls": sum(self.calls.values()),
+            "injected_429": self.injected_429,
+            "injected_errors": self.injected_errors,
+        }
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/_stats", self.handle_stats)
+        return app
+
+
+async def start(api: FakeBotApi, port: int) -> web.AppRunner:
+    runner = web.AppRunner(api.make_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", default="0", help='fixed "20" or range "20-80"')
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    api = FakeBotApi(latency_ms=parse_range(args.latency_ms), rate_429=args.rate_429,
+                     retry_after=args.retry_after, error_rate=args.error_rate)
+    web.run_app(api.make_app(), host="127.0.0.1", port=args.port, access_log=None)
@@ -0,0 +1,220 @@
+"""End-to-end load test against the fake Bot API.
+
+    python bench/loadtest.py [--mode webhook|polling] [--users 2000] [--concurrency 200]
+                             [--latency-ms 20-80] [--rate-429 0.01] [--error-rate 0.01]
+                             [--ack sync|queue] [--store json|sqlite] [--real-limits] [--json out.json]
+
+The bot is imported in-process with a throwaway DATA_DIR and pointed at
+bench/fake_bot_api.py (same event loop).  Every simulated user goes
+through /start -> "🔑 ПОЛУЧИТЬ ДОСТУП" -> open:1 -> open:2 -> check_diary,
+one update after another; ``--concurrency`` users run at once.
+
+* webhook mode POSTs to ``handle_webhook``; latency is the HTTP round
+  trip (with ``--ack queue`` that is only the ack, not the handler);
+* polling mode hands updates out through ``getUpdates``; latency is the
+  time until the bot's first API call for that chat.
+
+Reported: updates/s, p50/p95/p99 latency, Bot API calls per user, peak
+RSS and event-loop lag (the fake API shares the loop, so its small cost is
+included — compare runs made with the same options).  Outbound rate
+limits are lifted unless ``--real-limits``, so the bot itself is measured.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter, time
+from typing import Any, Dict
+
+import aiohttp
+from aiohttp import web
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT = BENCH_DIR.parent
+sys.path.insert(0, str(BENCH_DIR))
+
+from fake_bot_api import FakeBotApi, parse_range, start  # noqa: E402
+
+SECRET = "loadtest"
+FIRST_UID = 1_000_000
+SCENARIO = ["/start", "🔑 ПОЛУЧИТЬ ДОСТУП", "open:1", "open:2", "check_diary"]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * (len(values) - 1) + 0.5))]
+
+
+def make_update(update_id: int, uid: int, step: str) -> Dict[str, Any]:
+    user = {"id": uid, "is_bot": False, "first_name": "u"}
+    chat = {"id": uid, "type": "private"}
+    if ":" in step or step == "check_diary":
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": user,
+                "chat_instance": str(uid),
+                "data": step,
+                "message": {"message_id": update_id, "date": int(time()), "chat": chat,
+                            "from": {"id": 1, "is_bot": True, "first_name": "Bench"}, "text": "..."},
+            },
+        }
+    msg = {"message_id": update_id, "date": int(time()), "chat": chat, "from": user, "text": step}
+    if step.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(step)}]
+    return {"update_id": update_id, "message": msg}
+
+
+async def monitor_lag(samples: list[float], interval: float = 0.05):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - started - interval))
+
+
+def configure_env(args, api_port: int, port: int, data_dir: str):
+    os.environ.update(
+        BOT_TOKEN="123456:LOADTEST",
+        RUN_MODE=args.mode,
+        PORT=str(port),
+        WEBHOOK_SECRET=SECRET,
+        WEBHOOK_ACK_MODE=args.ack,
+        TELEGRAM_API_URL=f"http://127.0.0.1:{api_port}",
+        RENDER_EXTERNAL_URL=f"http://127.0.0.1:{port}",
+        DATA_DIR=data_dir,
+        STORE_BACKEND=args.store,
+        DIARY_TG_CHAT_ID="-1001",
+    )
+    if not args.real_limits:
+        os.environ.update(OUTBOUND_GLOBAL_RATE="1000000", OUTBOUND_CHAT_RATE="1000", OUTBOUND_CHAT_BURST="1000")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=("webhook", "polling"), default="webhook")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--latency-ms", default="0")
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--ack", choices=("sync", "queue"), default="sync")
+    parser.add_argument("--store", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--real-limits", action="store_true")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--json", type=Path, help="also write the results here")
+    args = parser.parse_args()
+
+    api = FakeBotApi(latency_ms=parse_range(args.latency_ms), rate_429=args.rate_429,
+                     error_rate=args.error_rate, seed=1)
+    api_port, port = free_port(), free_port()
+    api_runner = await start(api, api_port)
+    data_dir = tempfile.TemporaryDirectory()
+    configure_env(args, api_port, port, data_dir.name)
+    sys.path.insert(0, str(ROOT))
+    import bot as botmod  # noqa: E402 — читает окружение при импорте
+
+    lag: list[float] = []
+    lag_task = asyncio.create_task(monitor_lag(lag))
+    if args.mode == "webhook":
+        runner = web.AppRunner(botmod.make_web_app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        polling = None
+    else:
+        runner = None
+        polling = asyncio.create_task(botmod.run_polling())
+
+    latencies: list[float] = []
+    errors = 0
+    update_ids = iter(range(1, 10 ** 9))
+    sem = asyncio.Semaphore(args.concurrency)
+    url = f"http://127.0.0.1:{port}/webhook/{SECRET}"
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency)) as http:
+        async def deliver(uid: int, step: str):
+            nonlocal errors
+            update = make_update(next(update_ids), uid, step)
+            started = perf_counter()
+            try:
+                if polling is None:
+                    async with http.post(url, json=update,
+                                         headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}) as resp:
+                        if resp.status != 200:
+                            errors += 1
+                            return
+                else:
+                    answered = api.wait_response(uid)
+                    api.push_update(update)
+                    await asyncio.wait_for(answered, timeout=args.timeout)
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                errors += 1
+                return
+            latencies.append(perf_counter() - started)
+
+        async def user(uid: int):
+            async with sem:
+                for step in SCENARIO:
+                    await deliver(uid, step)
+
+        started = perf_counter()
+        await asyncio.gather(*(user(FIRST_UID + i) for i in range(args.users)))
+        elapsed = perf_counter() - started
+
+    lag_task.cancel()
+    if runner is not None:
+        await runner.cleanup()
+    else:
+        polling.cancel()
+        await asyncio.gather(polling, return_exceptions=True)
+        await botmod.bot.session.close()
+    await api_runner.cleanup()
+    data_dir.cleanup()
+
+    per_user = [api.by_chat[FIRST_UID + i] for i in range(args.users)]
+    updates = args.users * len(SCENARIO)
+    result = {
+        "mode": args.mode,
+        "ack": args.ack,
+        "store": args.store,
+        "users": args.users,
+        "updates": updates,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 2),
+        "updates_per_s": round(updates / elapsed, 1),
+        "latency_ms": {p: round(percentile(latencies, q) * 1000, 1)
+                       for p, q in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))},
+        "calls_per_user": {"avg": round(sum(per_user) / len(per_user), 2),
+                           "p95": percentile(per_user, 0.95), "max": max(per_user)},
+        "api": api.stats(),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "loop_lag_ms": {"p99": round(percentile(lag, 0.99) * 1000, 1), "max": round(max(lag, default=0) * 1000, 1)},
+    }
+    lat = result["latency_ms"]
+    print(f"{args.mode}/{args.ack} store={args.store} users={args.users} updates={updates} errors={errors}")
+    print(f"  throughput  {result['updates_per_s']} updates/s ({result['elapsed_s']}s)")
+    print(f"  latency     p50={lat['p50']} p95={lat['p95']} p99={lat['p99']} ms")
+    print(f"  API calls   {result['api']['total_calls']} total, per user avg={result['calls_per_user']['avg']} "
+          f"p95={result['calls_per_user']['p95']}, injected 429={api.injected_429} 5xx={api.injected_errors}")
+    print(f"  peak RSS    {result['peak_rss_mb']} MB")
+    print(f"  loop lag    p99={result['loop_lag_ms']['p99']} max={result['loop_lag_ms']['max']} ms")
+    if args.json:
+        args.json.write_text(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,141 @@
+"""Replay racing updates through ShardedExecutor and check per-user ordering.
+
+    python bench/replay_race.py [--users 2000]
+
+Each simulated user double-taps "🔑 ПОЛУЧИТЬ ДОСТУП" and then taps
+``open:2`` while the delayed ``auto_send_next_lesson`` job fires.  The
+handlers do the same get_stage -> await API call -> set_stage
+read-modify-write as bot.py.  Without the executor the interleaving sends
+the lesson-1 intro twice and lets the stale job roll the stage back;
+through the executor every user's events must run strictly in order.
+It also cancels updates that are still queued behind a busy user and
+checks that the lanes and the backlog gauge drain back to zero.
+Exits with status 1 if either check fails — this script is the
+executor's regression test.
+"""
+import argparse
+import asyncio
+import random
+import sys
+from collections import defaultdict
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sharding import ShardedExecutor  # noqa: E402
+
+
+class World:
+    def __init__(self):
+        self.stage = defaultdict(int)
+        self.sent = defaultdict(list)
+        self.order = defaultdict(list)
+
+    async def api_call(self):
+        await asyncio.sleep(random.uniform(0, 0.003))
+
+    async def on_get_access(self, uid: int, seq: int):
+        self.order[uid].append(seq)
+        if self.stage[uid] >= 1:
+            return
+        await self.api_call()
+        self.sent[uid].append("lesson1_intro")
+        self.stage[uid] = 1
+
+    async def on_open(self, uid: int, seq: int, n: int):
+        self.order[uid].append(seq)
+        stage = self.stage[uid]
+        await self.api_call()
+        self.sent[uid].append(f"lesson{n}_url")
+        if n > stage:
+            self.stage[uid] = n
+
+    async def next_lesson_job(self, uid: int, seq: int, current: int):
+        self.order[uid].append(seq)
+        stage = self.stage[uid]
+        if stage > current:
+            return
+        await self.api_call()
+        self.sent[uid].append(f"after_l{current}")
+        self.stage[uid] = stage  # «пишет назад» прочитанное значение, как set_stage после await
+
+
+def events_for(world: World, uid: int):
+    return [
+        (0, world.on_get_access, (uid, 0)),
+        (1, world.on_get_access, (uid, 1)),
+        (2, world.on_open, (uid, 2, 2)),
+        (3, world.next_lesson_job, (uid, 3, 1)),
+    ]
+
+
+async def replay(users: int, ordered: bool, executor: ShardedExecutor) -> World:
+    world = World()
+    tasks = []
+    # события разных юзеров перемешаны, события одного юзера идут по порядку
+    per_user = {uid: events_for(world, uid) for uid in range(1, users + 1)}
+    while per_user:
+        uid = random.choice(list(per_user))
+        _, fn, args = per_user[uid].pop(0)
+        if not per_user[uid]:
+            del per_user[uid]
+        coro = executor.run(uid, fn, *args) if ordered else fn(*args)
+        tasks.append(asyncio.create_task(coro))
+        if random.random() < 0.3:
+            await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    return world
+
+
+async def cancel_waiters(executor: ShardedExecutor, users: int) -> int:
+    """Queue updates behind a busy user, cancel them, return what is left in the backlog."""
+    gate = asyncio.Event()
+    busy = [asyncio.create_task(executor.run(uid, gate.wait)) for uid in range(1, users + 1)]
+    await asyncio.sleep(0)
+    queued = [asyncio.create_task(executor.run(uid, asyncio.sleep, 0)) for uid in range(1, users + 1)]
+    await asyncio.sleep(0)
+    for task in queued:
+        task.cancel()
+    await asyncio.gather(*queued, return_exceptions=True)
+    gate.set()
+    await asyncio.gather(*busy)
+    st = executor.stats()
+    return st["backlog"] + st["active_users"]
+
+
+def violations(world: World) -> tuple[int, int, int]:
+    out_of_order = sum(1 for seqs in world.order.values() if seqs != sorted(seqs))
+    duplicates = sum(1 for sent in world.sent.values() if sent.count("lesson1_intro") > 1)
+    lost_stage = sum(1 for stage in world.stage.values() if stage != 2)
+    return out_of_order, duplicates, lost_stage
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=2000)
+    args = parser.parse_args()
+    random.seed(1)
+
+    ok = True
+    for ordered in (False, True):
+        started = perf_counter()
+        executor = ShardedExecutor(shards=64)
+        world = await replay(args.users, ordered, executor)
+        elapsed = perf_counter() - started
+        ooo, dup, lost = violations(world)
+        label = "ShardedExecutor" if ordered else "unordered"
+        print(f"{label:<16} users={args.users} out_of_order={ooo} duplicate_intro={dup} "
+              f"wrong_final_stage={lost} time={elapsed:.2f}s")
+        if ordered and (ooo or dup or lost):
+            ok = False
+    leaked = await cancel_waiters(ShardedExecutor(shards=64), args.users)
+    print(f"cancelled waiters: backlog + lanes left = {leaked}")
+    if leaked:
+        ok = False
+    print("OK: per-user ordering holds, lanes drain" if ok else "FAIL: ordering violated or lanes leaked")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
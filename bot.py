@@ -1,18 +1,26 @@
 import asyncio
+import functools
+import hmac
 import json
+import multiprocessing.connection
 import os
 import logging
+import random
+import signal
+from contextlib import asynccontextmanager
 from pathlib import Path
 from time import time
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from aiogram.types import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from aiogram.enums.chat_member_status import ChatMemberStatus
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode, ContentType
 from aiogram.filters import Command
 from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardMarkup,
-    InlineKeyboardButton, ChatJoinRequest, FSInputFile
+    InlineKeyboardButton, ChatJoinRequest, ChatMemberUpdated
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest, TelegramEntityTooLarge
@@ -21,20 +29,72 @@ from dotenv import load_dotenv
 from aiohttp import web
 from aiogram import Bot, Dispatcher, Router, F
 
-logging.basicConfig(level=logging.INFO)
+from broadcast import Broadcaster, describe_filters, parse_args
+from coordination import Coordinator
+from media_cache import FileIdCache, UrlResolver, is_bad_file_id
+from media_manifest import build_manifest
+from membership import MembershipIndex
+from metrics import ApiMetrics, HandlerMetrics, Registry, count_results, metrics_handler, task_count
+from flow import Context, Rule, compile_flow
+from funnel import Funnel, merge_states, report_lines
+from journal import JournalBackend
+from logpipe import setup_logging
+from outbound import OutboundDispatcher
+from payloads import KEYBOARDLESS_SHAPES, PayloadCache, PostPayload
+from prefilter import UpdateFilter
+from profiling import UpdateProfiler, profile_cpu, span
+from quiet import QuietGate
+from scheduler import Scheduler
+from sharding import ShardedExecutor, UserOrderMiddleware
+from startup import StartupGate
+from store import JsonBackend, SqliteBackend, UserStore, import_json
+from unreachable import UnreachableGuard, UnreachableSet
+from update_queue import UpdateQueue
 
 # ========= ENV / INIT =========
+load_dotenv()
 BASE_DIR = Path(__file__).parent
-DATA_DIR = BASE_DIR / "data"
+DATA_DIR = Path(os.getenv("DATA_DIR", str(BASE_DIR / "data")))
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
-load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is required")
 
-RUN_MODE = os.getenv("RUN_MODE", "polling")  # "webhook" on Render, "polling" locally
+RUN_MODE = os.getenv("RUN_MODE", "polling")  # "webhook" on Render, "polling" locally, "webhook-multi"
+# webhook-multi: WEB_PROCESSES воркеров слушают один порт (SO_REUSEPORT)
+MULTI_PROCESS = RUN_MODE.lower() == "webhook-multi"
+WEB_PROCESSES = int(os.getenv("WEB_PROCESSES", str(os.cpu_count() or 1)))
+WORKER_INDEX = int(os.getenv("WEBHOOK_WORKER_INDEX", "-1"))  # -1 — родительский процесс
+
+# ========= ЛОГИ: форматирование и запись в фоновом потоке =========
+LOG_LISTENER = setup_logging(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    fmt=os.getenv("LOG_FORMAT", "json"),  # "json" | "text"
+    # aiogram.event пишет строку на каждый апдейт — по умолчанию глушим
+    levels=os.getenv("LOG_LEVELS", "aiogram.event=WARNING"),
+    rate=float(os.getenv("LOG_RATE", "20")),  # записей в секунду на одну строку кода
+    burst=float(os.getenv("LOG_BURST", "100")),
+    sample_every=int(os.getenv("LOG_SAMPLE_EVERY", "100")),
+    static={"worker": WORKER_INDEX} if MULTI_PROCESS else None,
+)
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "supersecret")
+# "sync": отвечаем Telegram после обработки; "queue": сразу 200, обработка в фоне
+WEBHOOK_ACK_MODE = os.getenv("WEBHOOK_ACK_MODE", "sync").lower()
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_OVERFLOW = os.getenv("WEBHOOK_OVERFLOW", "reject")  # "reject" (503) | "drop_oldest"
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# апдейты, накопившиеся пока инстанс спал, по умолчанию обрабатываем (1 — выбросить, как раньше)
+WEBHOOK_DROP_PENDING = os.getenv("WEBHOOK_DROP_PENDING", "0") == "1"
+# отсев апдейтов по сырому JSON до Update.model_validate (см. prefilter.py)
+WEBHOOK_PREFILTER = os.getenv("WEBHOOK_PREFILTER", "1") == "1"
+# 1 — выбрасывать message из групп/каналов; по умолчанию выключено: из групп приходят кружки
+# (capture_video_note), /diag и пересылки из канала. Шумные чаты точечно — WEBHOOK_IGNORE_CHATS
+WEBHOOK_PRIVATE_ONLY = os.getenv("WEBHOOK_PRIVATE_ONLY", "0") == "1"
+WEBHOOK_IGNORE_CHATS = [int(x) for x in os.getenv("WEBHOOK_IGNORE_CHATS", "").split(",") if x.strip()]
+# канал, где бот отвечает на посты их file_id (0 — выключено, channel_post тогда не подписываемся)
+FILE_ID_CHANNEL_ID = int(os.getenv("FILE_ID_CHANNEL_ID", "0") or 0)
 # External URL detection - works with multiple platforms
 EXTERNAL_URL = (
     os.getenv("RENDER_EXTERNAL_URL") or  # Render.com
@@ -94,14 +154,61 @@ ACCESS_REM_DELAYS = [
 
 COURSE_POST_DELAY = int(os.getenv("COURSE_POST_DELAY", "1800"))
 ROTATION_DELAY = int(os.getenv("ROTATION_DELAY", "21600"))
-LAST_BOT_MESSAGE_TS: dict[int, float] = {}
 
 MARK_REMIND_DELAY_1 = int(os.getenv("MARK_REMIND_DELAY_1", "300"))
 MARK_REMIND_DELAY_2 = int(os.getenv("MARK_REMIND_DELAY_2", "300"))
 
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0") or 0)
 
-bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+# свой Bot API сервер (или стенд для нагрузочных тестов), по умолчанию api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+bot = Bot(
+    BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+)
+
+# ========= НЕСКОЛЬКО ПРОЦЕССОВ: общие локи, тишина и маркеры в SQLite =========
+COORD = Coordinator(DATA_DIR / "coord.db", quiet_window=max(COURSE_POST_DELAY, ROTATION_DELAY)) if MULTI_PROCESS else None
+
+# заблокировавшим бота не пишем вовсе: 403 ловится один раз, дальше вызов отсекается до API
+UNREACHABLE = UnreachableSet(DATA_DIR / "unreachable.bin", shared=COORD)
+bot.session.middleware(UnreachableGuard(UNREACHABLE))
+
+# все отправки идут через общий диспетчер: лимиты Telegram, порядок в чате, ретраи
+OUTBOUND = OutboundDispatcher(
+    global_rate=float(os.getenv("OUTBOUND_GLOBAL_RATE", "30")),
+    chat_rate=float(os.getenv("OUTBOUND_CHAT_RATE", "1")),
+    chat_burst=float(os.getenv("OUTBOUND_CHAT_BURST", "3")),
+    group_rate=float(os.getenv("OUTBOUND_GROUP_PER_MIN", "20")) / 60,
+    max_retries=int(os.getenv("OUTBOUND_MAX_RETRIES", "5")),
+)
+bot.session.middleware(OUTBOUND)
+
+# ========= МЕТРИКИ (Prometheus: /metrics) =========
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # если задан — нужен заголовок Authorization: Bearer <token>
+METRICS_PORT = int(os.getenv("METRICS_PORT", os.getenv("PORT", "10000")))  # сервер метрик в polling, 0 — выкл.
+METRICS = Registry({"worker": WORKER_INDEX} if MULTI_PROCESS else None)
+HANDLER_CALLS = METRICS.counter("bot_handler_calls_total", "Handler invocations by result", ("handler", "result"))
+HANDLER_SECONDS = METRICS.histogram("bot_handler_duration_seconds", "Handler latency", ("handler",))
+API_CALLS = METRICS.counter("bot_api_requests_total", "Bot API requests (every attempt) by method and result",
+                            ("method", "result"))
+API_SECONDS = METRICS.histogram("bot_api_request_duration_seconds", "Bot API request latency", ("method",))
+MEDIA_SENDS = METRICS.counter("bot_media_send_total", "_send_file_with_fallback results", ("result",))
+STORE_SECONDS = METRICS.histogram("bot_store_io_seconds", "Store backend I/O latency", ("op",),
+                                  buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, 5.0))
+FLOW_SECONDS = METRICS.histogram("bot_transition_seconds", "Funnel transition duration (incl. sleeps)",
+                                 ("transition",))
+# внутри OUTBOUND: видно каждую попытку, включая 429 и ретраи
+bot.session.middleware(ApiMetrics(API_CALLS, API_SECONDS))
+
+# ========= ПРОФИЛИРОВАНИЕ (включается на лету: /profile on) =========
+PROFILER = UpdateProfiler(slow_ms=float(os.getenv("PROFILE_SLOW_MS", "1000")))
+PROFILE_SECRET = os.getenv("PROFILE_SECRET", "")  # без него /debug/profile отвечает 404
+
+# ========= ХОЛОДНЫЙ СТАРТ: порт сразу, состояние в фоне, накопившиеся апдейты — с ограничением =========
+STARTUP = StartupGate(rate=float(os.getenv("STARTUP_DRAIN_RATE", "20")),
+                      burst=float(os.getenv("STARTUP_DRAIN_BURST", "20")))
 
 async def send_admin_message(text: str):
     """Send a message to the admin if ADMIN_ID is set."""
@@ -111,109 +218,163 @@ async def send_admin_message(text: str):
         except Exception as e:
             logging.error("Failed to send admin message: %s", e)
 router = Router()
+_OBSERVERS = (router.message, router.callback_query, router.chat_join_request, router.chat_member,
+              router.channel_post)
+for _observer in _OBSERVERS:
+    _observer.middleware(HandlerMetrics(HANDLER_CALLS, HANDLER_SECONDS))
+PROFILER.attach(observers=_OBSERVERS, session=bot.session)
+if os.getenv("PROFILE_UPDATES", "0") == "1":
+    PROFILER.enable()
 DEEP_LINK = ""  # заполним в main()
-SENDING_POSTS: set[int] = set()  # chat_ids that are already sending course posts
 VIDEO_NOTE_SENT: set[int] = set()
-PROCESSING_CHECKS: set[int] = set()
 
-# ========= ХРАНИЛКА ПРОГРЕССА (файл) =========
+# ========= ХРАНИЛКА ПРОГРЕССА (память + фоновая запись в файл/SQLite) =========
 stats_file = DATA_DIR / "stats.json"
-if not stats_file.exists():
-    stats_file.write_text(json.dumps({"users": {}}, ensure_ascii=False, indent=2))
-
-def _read() -> Dict[str, Any]:
-    try:
-        return json.loads(stats_file.read_text() or "{}")
-    except Exception:
-        return {"users": {}}
+STORE_BACKEND = os.getenv("STORE_BACKEND", "json").lower()  # "json" | "sqlite" | "journal"
+STORE_SQLITE_PATH = Path(os.getenv("STORE_SQLITE_PATH", str(DATA_DIR / "users.db")))
+# journal: stats.json — снапшот, изменения дописываются в stats.journal; сжатие, когда журнал больше N МБ
+STORE_JOURNAL_COMPACT_MB = float(os.getenv("STORE_JOURNAL_COMPACT_MB", "16"))
+STORE_FLUSH_INTERVAL = float(os.getenv("STORE_FLUSH_INTERVAL", "2"))
+
+if MULTI_PROCESS and STORE_BACKEND != "sqlite":
+    raise RuntimeError("RUN_MODE=webhook-multi needs STORE_BACKEND=sqlite (workers share one database)")
+
+def _make_store_backend():
+    if STORE_BACKEND == "sqlite":
+        if not STORE_SQLITE_PATH.exists() and stats_file.exists():
+            # первый запуск на SQLite — переносим прогресс из stats.json
+            import_json(stats_file, STORE_SQLITE_PATH)
+        return SqliteBackend(STORE_SQLITE_PATH)
+    if STORE_BACKEND == "journal":
+        return JournalBackend(stats_file, compact_bytes=int(STORE_JOURNAL_COMPACT_MB * 2**20))
+    return JsonBackend(stats_file)
+
+def _observe_store(op: str, seconds: float):
+    STORE_SECONDS.observe(seconds, op)
+    span(f"store:{op}", seconds)
+
+STORE = UserStore(_make_store_backend(), flush_interval=STORE_FLUSH_INTERVAL, observe=_observe_store)
+
+# ========= ВОРОНКА: счётчики по этапам и когортам (без прохода по юзерам) =========
+FUNNEL = Funnel(STORE, section=f"funnel.w{WORKER_INDEX}" if MULTI_PROCESS else "funnel")
+
+def _load_state():
+    """Прогресс с диска. На старте идёт в потоке, когда порт уже слушается; апдейты ждут в STARTUP."""
+    STORE.load()
+    SCHEDULER.load_ids()  # счётчик id из базы — здесь, а не первым schedule() на event loop
+    if not FUNNEL.load() and not any(name.startswith("funnel") for name in STORE.section_names()):
+        # первый запуск с воронкой: считаем по всей базе один раз (в webhook-multi — только воркер 0)
+        if not MULTI_PROCESS or WORKER_INDEX == 0:
+            FUNNEL.rebuild()
+
+# ========= КЕШ file_id ДЛЯ ЛОКАЛЬНЫХ ФАЙЛОВ (загружаем один раз) =========
+# в webhook-multi файлы только читаются при старте, а записи идут через общую базу COORD
+URL_RESOLVER = UrlResolver(DATA_DIR / "url_cache.json",
+                           negative_ttl=float(os.getenv("URL_NEGATIVE_TTL", "3600")), shared=COORD)
+MEDIA_CACHE = FileIdCache(DATA_DIR / "media_cache.json", BASE_DIR, urls=URL_RESOLVER, shared=COORD)
+
+@asynccontextmanager
+async def _shared_user_scope(uid: int):
+    """Юзер занят во всех процессах; запись читаем свежую и сразу пишем обратно."""
+    async with COORD.user_lock(uid) as lease:
+        await STORE.refresh_user(uid)
+        try:
+            yield
+        finally:
+            if not lease.lost:  # аренду перехватили — запись уже может писать другой процесс
+                await STORE.flush_user(uid)
+
+async def _claim_once(name: str, chat_id: int) -> bool:
+    """«Ещё не отправляли» — ровно для одного вызова, в т.ч. между процессами."""
+    if COORD is not None:
+        return await COORD.claim(name, chat_id)
+    if chat_id in VIDEO_NOTE_SENT:
+        return False
+    VIDEO_NOTE_SENT.add(chat_id)
+    return True
 
-def _write(d: Dict[str, Any]):
-    stats_file.write_text(json.dumps(d, ensure_ascii=False, indent=2))
+async def _release_once(name: str, chat_id: int):
+    if COORD is not None:
+        await COORD.release(name, chat_id)
+    else:
+        VIDEO_NOTE_SENT.discard(chat_id)
+
+# ========= ТИШИНА В ЧАТЕ (когда бот писал последний раз) =========
+QUIET = QuietGate(DATA_DIR / "quiet.json", max_window=max(COURSE_POST_DELAY, ROTATION_DELAY), shared=COORD)
+
+# ========= ПОРЯДОК ОБРАБОТКИ: апдейты одного юзера строго по очереди =========
+SHARDS = ShardedExecutor(shards=int(os.getenv("UPDATE_SHARDS", "64")),
+                         around=_shared_user_scope if MULTI_PROCESS else None)
+
+# ========= ПЛАНИРОВЩИК ОТЛОЖЕННЫХ ЗАДАЧ (напоминания, дрип) =========
+SCHEDULER = Scheduler(
+    DATA_DIR / "scheduler.db",
+    workers=int(os.getenv("SCHEDULER_WORKERS", "16")),
+    catchup_spread=float(os.getenv("SCHEDULER_CATCHUP_SPREAD", "300")),
+    # у каждого воркера своя «полоса» id задач; дрип крутит только лидер
+    shared=MULTI_PROCESS,
+    id_offset=WORKER_INDEX + 1 if MULTI_PROCESS else 0,
+    id_stride=WEB_PROCESSES + 1 if MULTI_PROCESS else 1,
+)
 
 def get_stage(uid: int) -> int:
-    d = _read()
-    return int(d.get("users", {}).get(str(uid), {}).get("stage", 0))
+    return int(STORE.get_field(uid, "stage", 0))
 
 def set_stage(uid: int, stage: int):
-    d = _read()
-    u = d.setdefault("users", {}).setdefault(str(uid), {})
-    u["stage"] = stage
-    u["ts"] = int(time())
-    _write(d)
+    FUNNEL.update(uid, stage=stage, ts=int(time()))
 
 def is_first_rotation_done(uid: int) -> bool:
-    d = _read()
-    return bool(d.get("users", {}).get(str(uid), {}).get("first_rotation_done", False))
+    return bool(STORE.get_field(uid, "first_rotation_done", False))
 
 def set_first_rotation_done(uid: int, done: bool = True):
-    d = _read()
-    u = d.setdefault("users", {}).setdefault(str(uid), {})
-    u["first_rotation_done"] = bool(done)
-    _write(d)
+    FUNNEL.update(uid, first_rotation_done=bool(done))
 
 def set_pm_ok(uid: int, ok: bool):
-    d = _read()
-    u = d.setdefault("users", {}).setdefault(str(uid), {})
-    u["pm_ok"] = bool(ok)
-    _write(d)
+    STORE.update_user(uid, pm_ok=bool(ok))
 
 def can_pm(uid: int) -> bool:
-    d = _read()
-    return bool(d.get("users", {}).get(str(uid), {}).get("pm_ok", False))
+    return bool(STORE.get_field(uid, "pm_ok", False))
 
 def is_watched(uid: int, n: int) -> bool:
-    d = _read()
-    return bool(d.get("users", {}).get(str(uid), {}).get("watched", {}).get(str(n), False))
+    return bool(STORE.get_field(uid, "watched", {}).get(str(n), False))
 
 def set_watched(uid: int, n: int, watched: bool):
-    d = _read()
-    u = d.setdefault("users", {}).setdefault(str(uid), {})
-    w = u.setdefault("watched", {})
+    w = dict(STORE.get_field(uid, "watched", {}))
     w[str(n)] = bool(watched)
-    _write(d)
+    STORE.update_user(uid, watched=w)
 
 def set_diary_request(uid: int, requested: bool):
     """Фіксує, що юзер відправив заявку на підписку в дневник"""
-    d = _read()
-    u = d.setdefault("users", {}).setdefault(str(uid), {})
-    u["diary_request"] = bool(requested)
-    u["diary_ts"] = int(time())
-    _write(d)
-    logging.info("set_diary_request(uid=%s)=%s", uid, requested)
+    FUNNEL.update(uid, diary_request=bool(requested), diary_ts=int(time()))
+    logging.info("diary request set to %s", requested, extra={"chat_id": uid})
 
 def has_diary_request(uid: int) -> bool:
     """Чи відправляв юзер заявку на підписку в дневник"""
-    d = _read()
-    val = bool(d.get("users", {}).get(str(uid), {}).get("diary_request", False))
-    logging.info("has_diary_request(uid=%s) -> %s", uid, val)
-    return val
+    return bool(STORE.get_field(uid, "diary_request", False))
+
+def diary_approved_at(uid: int) -> Optional[float]:
+    """Коли бот одобрил заявку в дневник (diary_ts), None — если заявки не было"""
+    if not has_diary_request(uid):
+        return None
+    return STORE.get_field(uid, "diary_ts") or None
 
 
 def is_loop_stopped(uid: int) -> bool:
-    d = _read()
-    return bool(d.get("users", {}).get(str(uid), {}).get("loop_stopped", False))
+    return bool(STORE.get_field(uid, "loop_stopped", False))
 
 
 def set_loop_stopped(uid: int, stopped: bool):
-    d = _read()
-    u = d.setdefault("users", {}).setdefault(str(uid), {})
-    u["loop_stopped"] = bool(stopped)
-    _write(d)
+    FUNNEL.update(uid, loop_stopped=bool(stopped))
 
 
 # ========= HELPER FUNCTIONS =========
 
 def _mark_bot_sent(chat_id: int):
-    LAST_BOT_MESSAGE_TS[chat_id] = time()
+    QUIET.mark(chat_id)
 
-async def _wait_quiet_since_last_bot_message(chat_id: int, delay: int):
-    while True:
-        last = LAST_BOT_MESSAGE_TS.get(chat_id, 0)
-        passed = time() - last
-        remaining = delay - passed
-        if remaining <= 0:
-            return
-        await asyncio.sleep(min(5, max(1, int(remaining))))
+def _quiet_remaining(chat_id: int, delay: int) -> float:
+    """Сколько ещё секунд ждать, чтобы с последнего сообщения бота прошло delay."""
+    return QUIET.remaining(chat_id, delay)
 
 def smart_truncate(text: str, max_length: int = 700) -> tuple[str, str]:
     """Truncate text intelligently to max_length, preferring sentence boundaries.
@@ -252,10 +413,10 @@ async def send_block(chat_id: int, banner_url: str, text: str,
         if banner_url:
             # Check if it's a local file path (not a URL)
             if not banner_url.startswith(('http://', 'https://')):
-                # It's a local file, use FSInputFile
+                # It's a local file: upload once, then reuse the cached file_id
                 try:
-                    photo = FSInputFile(banner_url)
-                    await bot.send_photo(chat_id, photo, caption=text, reply_markup=reply_markup, parse_mode=parse_mode)
+                    await MEDIA_CACHE.send(banner_url, "photo", lambda photo: bot.send_photo(
+                        chat_id, photo, caption=text, reply_markup=reply_markup, parse_mode=parse_mode))
                     _mark_bot_sent(chat_id)
                     return
                 except Exception as e:
@@ -264,32 +425,17 @@ async def send_block(chat_id: int, banner_url: str, text: str,
                     _mark_bot_sent(chat_id)
                     return
 
-            # It's a URL, send as before
-            await bot.send_photo(chat_id, banner_url, caption=text, reply_markup=reply_markup, parse_mode=parse_mode)
+            # It's a URL: resolver reuses the file_id / working rewrite and skips known-broken URLs
+            msg = await URL_RESOLVER.send_photo(banner_url, lambda photo: bot.send_photo(
+                chat_id, photo, caption=text, reply_markup=reply_markup, parse_mode=parse_mode))
+            if msg is None:
+                await bot.send_message(chat_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
             _mark_bot_sent(chat_id)
         else:
             await bot.send_message(chat_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
             _mark_bot_sent(chat_id)
     except TelegramBadRequest as e:
-        if "wrong type of the web page content" in str(e) or "failed to get HTTP URL content" in str(e):
-            logging.warning("Banner URL '%s' rejected by Telegram. Trying to extract direct image URL from Imgur album for chat %s...", banner_url, chat_id)
-            # Try to convert Imgur album URL to direct image URL
-            if "imgur.com/a/" in banner_url:
-                # Extract album ID and try common image extensions
-                album_id = banner_url.split("/a/")[-1].split("?")[0].split("#")[0]
-                direct_url = f"https://i.imgur.com/{album_id}.jpg"
-                try:
-                    await bot.send_photo(chat_id, direct_url, caption=text, reply_markup=reply_markup, parse_mode=parse_mode)
-                    _mark_bot_sent(chat_id)
-                    logging.info("Successfully sent direct image URL %s for chat %s", direct_url, chat_id)
-                    return
-                except Exception:
-                    pass
-            logging.warning("Could not extract direct image URL, falling back to text message for chat %s", chat_id)
-            await bot.send_message(chat_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
-            _mark_bot_sent(chat_id)
-        else:
-            logging.exception("TelegramBadRequest in send_block for chat %s: %s", chat_id, e)
+        logging.exception("TelegramBadRequest in send_block for chat %s: %s", chat_id, e)
     except TelegramForbiddenError:
         logging.warning("TelegramForbiddenError in send_block for chat %s. User may have blocked the bot.", chat_id)
     except Exception:
@@ -305,20 +451,27 @@ async def send_url_only(chat_id: int, url: str, reply_markup=None):
         await bot.send_message(chat_id, url, reply_markup=reply_markup)
         _mark_bot_sent(chat_id)
 
+async def _fetch_diary_membership(user_id: int) -> bool:
+    member = await bot.get_chat_member(DIARY_TG_CHAT_ID, user_id)
+    return member.status in {
+        ChatMemberStatus.MEMBER,
+        ChatMemberStatus.ADMINISTRATOR,
+        ChatMemberStatus.CREATOR,
+    }
+
+# заявки и chat_member обновляют индекс сами; get_chat_member — только на промах кеша
+DIARY_MEMBERS = MembershipIndex(
+    _fetch_diary_membership,
+    hint=diary_approved_at,  # заявку бот одобряет сразу; верим ей member_ttl, дальше — get_chat_member
+    member_ttl=float(os.getenv("DIARY_MEMBER_TTL", "3600")),
+    nonmember_ttl=float(os.getenv("DIARY_NONMEMBER_TTL", "30")),
+)
+
 async def is_subscribed_telegram(user_id: int) -> bool:
     """True, если дневник = Telegram-канал и юзер там участник"""
     if not DIARY_TG_CHAT_ID:
         return False
-    
-    try:
-        member = await bot.get_chat_member(DIARY_TG_CHAT_ID, user_id)
-        return member.status in {
-            ChatMemberStatus.MEMBER,
-            ChatMemberStatus.ADMINISTRATOR,
-            ChatMemberStatus.CREATOR,
-        }
-    except Exception:
-        return False
+    return await DIARY_MEMBERS.is_member(user_id)
 
 def _looks_like_videonote(fid: str | None) -> bool:
     if not fid:
@@ -326,60 +479,68 @@ def _looks_like_videonote(fid: str | None) -> bool:
     # несколько известных префиксов, плюс проверка длины — простая эвристика
     return fid.startswith(("DQAC", "AQAD", "BAAD", "CAAD")) or len(fid) > 40
 
-async def _send_l3_video_later(chat_id: int, delay: int | None = None):
+def _send_l3_video_later(chat_id: int, delay: int | None = None):
     if not L3_FOLLOWUP_FILE:
         return
-    await asyncio.sleep(delay if delay is not None else L3_FOLLOWUP_DELAY)
+    SCHEDULER.schedule("l3_followup", {"chat_id": chat_id},
+                       delay=delay if delay is not None else L3_FOLLOWUP_DELAY,
+                       key=f"l3_followup:{chat_id}")
+
+async def _send_l3_video(chat_id: int):
     await _send_file_with_fallback(chat_id, L3_FOLLOWUP_FILE, L3_FOLLOWUP_CAPTION or None)
 
-async def auto_send_next_lesson(user_id: int, current_lesson: int):
-    """Автоматически отправляет следующий урок после небольшой паузы."""
+def schedule_next_lesson(user_id: int, current_lesson: int):
+    """Ставит отправку следующего урока после небольшой паузы."""
     delay = 0
     if current_lesson == 1:
         delay = NEXT_AFTER_1
     elif current_lesson == 2:
         delay = NEXT_AFTER_2
+    SCHEDULER.schedule("next_lesson", {"user_id": user_id, "current_lesson": current_lesson},
+                       delay=delay, key=f"next_lesson:{user_id}:{current_lesson}")
 
-    if delay > 0:
-        await asyncio.sleep(delay)
-
+async def auto_send_next_lesson(user_id: int, current_lesson: int):
+    """Автоматически отправляет следующий урок (задача планировщика)."""
     try:
         # Failsafe: if user has already advanced, don't send a delayed message for a past lesson
         if get_stage(user_id) > current_lesson:
-            logging.info(f"auto_send_next_lesson: User {user_id} is already at stage {get_stage(user_id)}, skipping message for lesson {current_lesson + 1}.")
+            logging.info("auto_send_next_lesson: already past lesson %s, skipping", current_lesson + 1,
+                         extra={"chat_id": user_id, "stage": get_stage(user_id)})
             return
 
-        if current_lesson == 1:
-            # После урока 1 -> отправляем блок и доступ к уроку 2
-            await send_block(user_id, BANNER_AFTER3, AFTER_L1, reply_markup=kb_open(2), parse_mode=ParseMode.HTML)
-        elif current_lesson == 2:
-            # После урока 2 -> отправляем блок перед уроком 3
-            await send_block(user_id, BANNER_AFTER5, AFTER_L2, reply_markup=kb_open(3), parse_mode=ParseMode.HTML)
+        # после урока 1 — блок и доступ к уроку 2, после урока 2 — блок перед уроком 3
+        await FLOW.run(f"next_lesson:{current_lesson}", Context(user_id, get_stage(user_id)))
 
     except Exception as e:
         logging.warning("auto_send_next_lesson failed: %s", e)
 
 
 
-async def delete_message_after_delay(chat_id: int, message_id: int, delay: int):
-    await asyncio.sleep(delay)
+def delete_message_after_delay(chat_id: int, message_id: int, delay: int):
+    SCHEDULER.schedule("delete_message", {"chat_id": chat_id, "message_id": message_id}, delay=delay)
+
+async def delete_message(chat_id: int, message_id: int):
     try:
         await bot.delete_message(chat_id, message_id)
     except Exception as e:
         logging.warning(f"Failed to delete message {message_id} in chat {chat_id}: {e}")
 
 # ========= KEYBOARD FUNCTIONS =========
+# разметка aiogram — неизменяемые (frozen) модели: собираем один раз и отдаём один и тот же объект
+@functools.cache
 def kb_access() -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     kb.row(InlineKeyboardButton(text="🔑 ПОЛУЧИТЬ ДОСТУП", callback_data="open:1"))
     return kb.as_markup()
 
+@functools.cache
 def kb_access_reply() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardBuilder()
     kb.add(KeyboardButton(text="🔑 ПОЛУЧИТЬ ДОСТУП"))
     kb.adjust(1)
     return kb.as_markup(resize_keyboard=True)
 
+@functools.cache
 def kb_open(n: int) -> InlineKeyboardMarkup:
     labels = {1: "ОТКРЫТЬ УРОК 1", 2: "ОТКРЫТЬ УРОК 2", 3: "ОТКРЫТЬ УРОК 3"}
     kb = InlineKeyboardBuilder()
@@ -388,6 +549,7 @@ def kb_open(n: int) -> InlineKeyboardMarkup:
 
 # Функция kb_done убрана - теперь автоматическая отправка через 30 минут
 
+@functools.cache
 def kb_subscribe_then_l3() -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     if DIARY_TG_JOIN_URL:
@@ -397,17 +559,20 @@ def kb_subscribe_then_l3() -> InlineKeyboardMarkup:
     kb.row(InlineKeyboardButton(text="✅ Отправил запрос — ПРОВЕРИТЬ", callback_data="check_diary"))
     return kb.as_markup()
 
+@functools.cache
 def kb_buy_course() -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     kb.row(InlineKeyboardButton(text="Мини курс", callback_data="buy_course"))
     return kb.as_markup()
 
 
+@functools.cache
 def kb_apply_form() -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     kb.row(InlineKeyboardButton(text="📝 Оставить заявку", url=FORM_URL))
     return kb.as_markup()
 
+@functools.cache
 def kb_deeplink() -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     kb.row(InlineKeyboardButton(text="🎁 ПОЛУЧИТЬ УРОКИ", url=DEEP_LINK))
@@ -694,11 +859,13 @@ ACCESS_NUDGE_TEXTS = [
     "Давай не откладывать — забирай доступ и стартуем прямо сейчас 👇",
 ]
  # === Рассылка 8 постов по 1 каждые 5 часов ===
+@functools.cache
 def kb_course() -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     kb.row(InlineKeyboardButton(text="Получить доступ", url=SITE_URL))
     return kb.as_markup()
 
+@functools.cache
 def kb_course_2() -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     kb.row(InlineKeyboardButton(text="Мини курс по P2P", url=SITE_URL))
@@ -706,6 +873,38 @@ def kb_course_2() -> InlineKeyboardMarkup:
 
 
 
+# ========= МАНИФЕСТ МЕДИА (проверка и прогрев при старте) =========
+MEDIA_STORAGE_CHAT_ID = int(os.getenv("MEDIA_STORAGE_CHAT_ID", "0") or 0)
+MEDIA_WARMUP_CONCURRENCY = int(os.getenv("MEDIA_WARMUP_CONCURRENCY", "4"))
+
+def _media_entries():
+    for name in ("BANNER_WELCOME", "BANNER_AFTER1", "BANNER_AFTER2", "BANNER_AFTER3",
+                 "BANNER_AFTER4", "BANNER_AFTER5", "BANNER_BLOCK6", "BANNER_BLOCK7"):
+        yield name, globals()[name], "photo"
+    for idx, url in enumerate(COURSE_POST_PHOTOS):
+        yield f"COURSE_POST_PHOTOS[{idx}]", url, "photo"
+    for post, videos in COURSE_POST_VIDEOS.items():
+        for n, data in enumerate(videos):
+            yield f"COURSE_POST_VIDEOS[{post}][{n}]", data["path"], "video"
+    yield "WELCOME_VIDEO_FILE", WELCOME_VIDEO_FILE, "video_note"
+    yield "L3_FOLLOWUP_FILE", L3_FOLLOWUP_FILE, "video"
+
+MEDIA_MANIFEST = build_manifest(BASE_DIR, _media_entries())
+for _post, _photos in COURSE_POST_MEDIA.items():
+    for _idx in _photos:
+        if not 0 <= _idx < len(COURSE_POST_PHOTOS):
+            logging.error("COURSE_POST_MEDIA[%s] points to missing photo index %s", _post, _idx)
+logging.info(MEDIA_MANIFEST.report())
+
+async def warm_up_media():
+    """Заливаем все медиа в служебный чат, чтобы первый юзер получил готовые file_id."""
+    if not MEDIA_STORAGE_CHAT_ID:
+        return
+    await MEDIA_MANIFEST.warm_up(bot, MEDIA_STORAGE_CHAT_ID, MEDIA_CACHE, URL_RESOLVER,
+                                 concurrency=MEDIA_WARMUP_CONCURRENCY)
+    logging.info(MEDIA_MANIFEST.report())
+
+@count_results(MEDIA_SENDS)
 async def _send_file_with_fallback(chat_id: int, file_path_or_id: str, caption: str | None = None, reply_markup=None):
     """
     Отправляет файл, используя локальный путь (если существует) или file_id.
@@ -714,33 +913,27 @@ async def _send_file_with_fallback(chat_id: int, file_path_or_id: str, caption:
         logging.warning("_send_file_with_fallback: empty file_path_or_id for chat %s", chat_id)
         return "no_file_id"
 
-    # 1. Проверяем, является ли строка путем к СУЩЕСТВУЮЩЕМУ файлу
-    resolved_file_path = file_path_or_id
-    logging.info("DEBUG: file_path_or_id = %s", file_path_or_id)
-    # If it's a simple filename and not an absolute path, assume it's in the videos directory
-    if not Path(file_path_or_id).is_absolute() and not ("/" in file_path_or_id or "\\" in file_path_or_id):
-        potential_video_path = BASE_DIR / "videos" / file_path_or_id
-        logging.info("DEBUG: potential_video_path = %s", potential_video_path)
-        if potential_video_path.is_file():
-            resolved_file_path = str(potential_video_path)
-    elif not Path(file_path_or_id).is_absolute() and (BASE_DIR / file_path_or_id).is_file():
-        resolved_file_path = str(BASE_DIR / file_path_or_id)
-    logging.info("DEBUG: resolved_file_path = %s", resolved_file_path)
-
-    if Path(resolved_file_path).is_file():
+    # 1. Проверяем, является ли строка путем к СУЩЕСТВУЮЩЕМУ файлу (резолв берём из манифеста)
+    local_path = MEDIA_MANIFEST.resolve(file_path_or_id)
+    resolved_file_path = str(local_path) if local_path else file_path_or_id
+    logging.debug("_send_file_with_fallback: %s -> %s", file_path_or_id, resolved_file_path)
+
+    if local_path is not None:
         try:
-            video = FSInputFile(resolved_file_path)
-            await bot.send_video(chat_id, video, caption=caption, reply_markup=reply_markup)
+            await MEDIA_CACHE.send(resolved_file_path, "video", lambda video: bot.send_video(
+                chat_id, video, caption=caption, reply_markup=reply_markup))
             _mark_bot_sent(chat_id)
-            logging.info("Sent local video file %s to chat %s", resolved_file_path, chat_id)
+            logging.info("media sent", extra={"chat_id": chat_id, "method": "send_video",
+                                              "result": "local_video", "file": resolved_file_path})
             return "local_video"
         except TelegramEntityTooLarge as e:
             logging.warning("Local video file %s to chat %s is too large for direct video send. Attempting to send as document. Error: %s", resolved_file_path, chat_id, e)
             try:
-                document = FSInputFile(resolved_file_path)
-                await bot.send_document(chat_id, document, caption=caption, reply_markup=reply_markup)
+                await MEDIA_CACHE.send(resolved_file_path, "document", lambda document: bot.send_document(
+                    chat_id, document, caption=caption, reply_markup=reply_markup))
                 _mark_bot_sent(chat_id)
-                logging.info("Sent local video file %s as document to chat %s", resolved_file_path, chat_id)
+                logging.info("media sent", extra={"chat_id": chat_id, "method": "send_document",
+                                                  "result": "local_document", "file": resolved_file_path})
                 return "local_document"
             except Exception as doc_e:
                 logging.exception("Failed to send local video file %s as document to chat %s: %s", resolved_file_path, chat_id, doc_e)
@@ -766,14 +959,15 @@ async def _send_file_with_fallback(chat_id: int, file_path_or_id: str, caption:
 
     # 3. Если это не путь к файлу, считаем, что это file_id и пытаемся отправить.
     file_id = file_path_or_id
-    logging.info("DEBUG: Attempting to send as file_id: %s", file_id)
+    logging.debug("_send_file_with_fallback: sending as file_id %s", file_id)
     try:
         # Попытка №1: отправить как video_note, если похоже
         if _looks_like_videonote(file_id):
             try:
                 await bot.send_video_note(chat_id, file_id)
                 _mark_bot_sent(chat_id)
-                logging.info("Sent as video_note (file_id) to chat %s", chat_id)
+                logging.info("media sent", extra={"chat_id": chat_id, "method": "send_video_note",
+                                                  "result": "video_note"})
                 if caption or reply_markup:
                     await bot.send_message(chat_id, caption or " ", reply_markup=reply_markup)
                     _mark_bot_sent(chat_id)
@@ -787,7 +981,7 @@ async def _send_file_with_fallback(chat_id: int, file_path_or_id: str, caption:
         # Попытка №2: отправить как обычное видео
         await bot.send_video(chat_id, file_id, caption=caption, reply_markup=reply_markup)
         _mark_bot_sent(chat_id)
-        logging.info("Sent as video (file_id) to chat %s", chat_id)
+        logging.info("media sent", extra={"chat_id": chat_id, "method": "send_video", "result": "video"})
         return "video"
 
     except TelegramForbiddenError:
@@ -805,133 +999,224 @@ async def _send_file_with_fallback(chat_id: int, file_path_or_id: str, caption:
         logging.exception("Unexpected error sending file_id %s to chat %s: %s", file_id, chat_id, e)
         return "failed_unexpected"
 
-async def send_course_posts(chat_id: int):
-    if chat_id in SENDING_POSTS:
+COURSE_ROTATION = [i for i in range(len(COURSE_POSTS)) if i not in (0, 1)]
+
+async def start_course_posts(chat_id: int):
+    """Запускает дрип-рассылку, если она ещё не идёт для этого чата."""
+    if await SCHEDULER.has(f"drip:{chat_id}"):
         return
-    SENDING_POSTS.add(chat_id)
+    SCHEDULER.schedule("drip", {"chat_id": chat_id}, key=f"drip:{chat_id}")
+
+def _drip_delay(chat_id: int) -> int:
+    if get_stage(chat_id) >= 9 and is_first_rotation_done(chat_id):
+        return ROTATION_DELAY
+    return COURSE_POST_DELAY
+
+def _schedule_drip(chat_id: int, pos: int = 0):
+    delay = max(0.0, _quiet_remaining(chat_id, _drip_delay(chat_id)))
+    SCHEDULER.schedule("drip", {"chat_id": chat_id, "pos": pos}, delay=delay, key=f"drip:{chat_id}")
 
+def _push_drip_deadline(chat_id: int, ts: float):
+    """Бот написал в чат — сдвигаем ожидающий шаг дрипа на новый дедлайн тишины."""
+    key = f"drip:{chat_id}"
+    if SCHEDULER.due_of(key) is not None:
+        SCHEDULER.reschedule(key, ts + _drip_delay(chat_id))
+
+QUIET.on_mark(_push_drip_deadline)
+
+# ========= ВОРОНКА КАК ТАБЛИЦА: этап -> действия (см. flow.py) =========
+async def _act_url(ctx: Context, url: str):
+    await send_url_only(ctx.chat_id, url)
+
+async def _act_sleep(ctx: Context, seconds: float):
+    await asyncio.sleep(seconds)
+
+async def _act_block(ctx: Context, banner: str, text: str, reply_markup=None):
+    await send_block(ctx.chat_id, banner, text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+
+async def _act_file(ctx: Context, file: str, caption: str | None = None):
+    await _send_file_with_fallback(ctx.chat_id, file, caption)
+
+async def _act_stage(ctx: Context, stage: int):
+    if get_stage(ctx.chat_id) < stage:
+        set_stage(ctx.chat_id, stage)
+
+async def _act_next_lesson(ctx: Context, lesson: int):
+    schedule_next_lesson(ctx.chat_id, lesson)
+
+async def _act_video_note_once(ctx: Context, file: str):
+    chat_id = ctx.chat_id
+    if not await _claim_once("video_note", chat_id):
+        return
     try:
-        while True:
-            stage = get_stage(chat_id)
-            if stage < 9 or not is_first_rotation_done(chat_id):
-                await _wait_quiet_since_last_bot_message(chat_id, COURSE_POST_DELAY)
-
-            if stage < 2:
-                set_stage(chat_id, 2)
-                continue
-
-            if stage == 2:
-                await send_url_only(chat_id, LESSON1_URL)
-                await asyncio.sleep(2)
-                await send_block(chat_id, BANNER_AFTER3, AFTER_L1, reply_markup=kb_open(2), parse_mode=ParseMode.HTML)
-                _mark_bot_sent(chat_id)
-                set_stage(chat_id, 3)
-                continue
+        await MEDIA_CACHE.send(file, "video_note", lambda note: bot.send_video_note(chat_id, note))
+    except Exception:
+        await _release_once("video_note", chat_id)
+        raise
+    _mark_bot_sent(chat_id)
 
-            if stage == 3:
-                await send_block(chat_id, COURSE_POST_PHOTOS[2], COURSE_POSTS[0], reply_markup=kb_open(2), parse_mode=ParseMode.HTML)
-                _mark_bot_sent(chat_id)
-                set_stage(chat_id, 4)
-                continue
+async def _act_rotate(ctx: Context, rotation: tuple):
+    """Один пост ротации; ctx.pos — позиция в rotation, после полного круга — first_rotation_done."""
+    i = rotation[ctx.pos % len(rotation)]
+    try:
+        await _send_course_post(ctx.chat_id, i)
+    except TelegramForbiddenError:
+        raise
+    except Exception as e:
+        logging.warning("Failed to send course post %d: %s", i + 1, e, extra={"chat_id": ctx.chat_id})
+    ctx.pos += 1
+    if ctx.pos >= len(rotation):
+        ctx.pos = 0
+        if not is_first_rotation_done(ctx.chat_id):
+            set_first_rotation_done(ctx.chat_id, True)
+
+FLOW_ACTIONS = {
+    "url": _act_url,
+    "sleep": _act_sleep,
+    "block": _act_block,
+    "file": _act_file,
+    "stage": _act_stage,
+    "next_lesson": _act_next_lesson,
+    "video_note_once": _act_video_note_once,
+    "rotate": _act_rotate,
+}
 
-            if stage == 4:
-                await send_url_only(chat_id, LESSON2_URL)
-                await asyncio.sleep(2)
-                await send_block(chat_id, BANNER_AFTER5, AFTER_L2, reply_markup=kb_open(3), parse_mode=ParseMode.HTML)
-                _mark_bot_sent(chat_id)
-                set_stage(chat_id, 5)
-                continue
+_AFTER_L1 = ("block", BANNER_AFTER3, AFTER_L1, kb_open(2))
+_AFTER_L2 = ("block", BANNER_AFTER5, AFTER_L2, kb_open(3))
+_GATE_L3 = ("block", BANNER_AFTER2, GATE_BEFORE_L3, kb_subscribe_then_l3())
+
+FLOW_TABLE = {
+    # фоновый дрип: один шаг за пробуждение, дальше — пауза тишины
+    "drip": {
+        range(0, 2): Rule(("stage", 2)),
+        2: Rule(("url", LESSON1_URL), ("sleep", 2), _AFTER_L1, ("stage", 3)),
+        3: Rule(("block", COURSE_POST_PHOTOS[2], COURSE_POSTS[0], kb_open(2)), ("stage", 4)),
+        4: Rule(("url", LESSON2_URL), ("sleep", 2), _AFTER_L2, ("stage", 5)),
+        5: Rule(("block", COURSE_POST_PHOTOS[7], COURSE_POSTS[1], kb_open(3)), ("stage", 6)),
+        6: Rule(_GATE_L3, ("stage", 7)),
+        7: Rule(("url", LESSON3_URL), ("stage", 8)),
+        8: Rule(("video_note_once", WELCOME_VIDEO_FILE), ("stage", 9)),
+        9: Rule(("rotate", tuple(COURSE_ROTATION))),
+    },
+    # кнопки «ОТКРЫТЬ УРОК n»
+    "open:1": {range(0, 10): Rule(("url", LESSON1_URL), ("stage", 1), ("sleep", 1), ("next_lesson", 1))},
+    "open:2": {range(0, 10): Rule(("url", LESSON2_URL), ("stage", 2), ("sleep", 1), ("next_lesson", 2))},
+    "open:3": {
+        range(0, 7): Rule(_GATE_L3, ("stage", 6)),
+        range(7, 10): Rule(("url", LESSON3_URL), ("stage", 8)),
+    },
+    # «ПРОВЕРИТЬ» подписку на дневник прошла; с этапа 8 кнопка уже ничего не делает
+    "diary_ok": {range(0, 8): Rule(("file", L3_FOLLOWUP_FILE), ("stage", 8), ("url", LESSON3_URL))},
+    # отложенный блок после урока (schedule_next_lesson), если юзер ещё не ушёл дальше
+    "next_lesson:1": {range(0, 2): Rule(_AFTER_L1)},
+    "next_lesson:2": {range(0, 3): Rule(_AFTER_L2)},
+}
+FLOW = compile_flow(FLOW_TABLE, FLOW_ACTIONS, stages=10,
+                    observe=lambda name, seconds: FLOW_SECONDS.observe(seconds, name))
 
-            if stage == 5:
-                await send_block(chat_id, COURSE_POST_PHOTOS[7], COURSE_POSTS[1], reply_markup=kb_open(3), parse_mode=ParseMode.HTML)
-                _mark_bot_sent(chat_id)
-                set_stage(chat_id, 6)
-                continue
+async def send_course_posts(chat_id: int, pos: int = 0):
+    """Один шаг дрип-рассылки; следующий шаг ставится в планировщик.
 
-            if stage == 6:
-                await send_block(chat_id, BANNER_AFTER2, GATE_BEFORE_L3, reply_markup=kb_subscribe_then_l3(), parse_mode=ParseMode.HTML)
-                _mark_bot_sent(chat_id)
-                set_stage(chat_id, 7)
-                continue
+    pos — позиция в COURSE_ROTATION для стадии 9.
+    """
+    await QUIET.refresh(chat_id)
+    early = _quiet_remaining(chat_id, _drip_delay(chat_id)) > 0
+    QUIET.note_wakeup(deferred=early)
+    if early:
+        # дедлайн сдвинулся, а задачу не перенесли (например, после рестарта)
+        _schedule_drip(chat_id, pos)
+        return
 
-            if stage == 7:
-                await send_url_only(chat_id, LESSON3_URL)
-                _mark_bot_sent(chat_id)
-                set_stage(chat_id, 8)
-                continue
+    ctx = Context(chat_id, get_stage(chat_id), pos)
+    try:
+        await FLOW.run("drip", ctx)
+    except TelegramForbiddenError:
+        # юзер заблокировал бота — рассылку не продолжаем
+        return
 
-            if stage == 8:
-                if chat_id not in VIDEO_NOTE_SENT:
-                    await bot.send_video_note(chat_id, FSInputFile(WELCOME_VIDEO_FILE))
-                    _mark_bot_sent(chat_id)
-                    VIDEO_NOTE_SENT.add(chat_id)
-                set_stage(chat_id, 9)
-                continue
-
-            post_indices = [i for i in range(len(COURSE_POSTS)) if i not in (0, 1)]
-            # random.shuffle(post_indices)
-            first_done = is_first_rotation_done(chat_id)
-            per_post_delay = COURSE_POST_DELAY if not first_done else ROTATION_DELAY
-            for i in post_indices:
-                await _wait_quiet_since_last_bot_message(chat_id, per_post_delay)
-                try:
-                    text = COURSE_POSTS[i]
-                    reply_markup = kb_course_2()
-                    if i == 5:
-                        reply_markup = None
-
-                    if i in COURSE_POST_MEDIA or i in COURSE_POST_VIDEOS:
-                        media_group = MediaGroupBuilder(caption=text)
-                        if i in COURSE_POST_MEDIA:
-                            for photo_index in COURSE_POST_MEDIA[i]:
-                                media_group.add_photo(media=COURSE_POST_PHOTOS[photo_index])
-                        if i in COURSE_POST_VIDEOS:
-                            for data in COURSE_POST_VIDEOS[i]:
-                                media_group.add_video(
-                                    media=FSInputFile(data["path"]),
-                                    height=data.get("height"),
-                                    width=data.get("width"),
-                                )
-                        msg = await bot.send_media_group(chat_id, media_group.build())
-                        _mark_bot_sent(chat_id)
-                        if reply_markup is not None:
-                            try:
-                                await msg[0].edit_reply_markup(reply_markup=reply_markup)
-                            except TelegramBadRequest:
-                                await bot.send_message(chat_id, "Мини курс по Р2Р", reply_markup=kb_course())
-                                _mark_bot_sent(chat_id)
-                    else:
-                        await bot.send_message(chat_id, text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
-                        _mark_bot_sent(chat_id)
-                except TelegramForbiddenError:
-                    SENDING_POSTS.discard(chat_id)
-                    return
-                except Exception as e:
-                    logging.warning("Failed to send course post %d to %s: %s", i + 1, chat_id, e)
-            if not first_done:
-                set_first_rotation_done(chat_id, True)
-    finally:
-        SENDING_POSTS.discard(chat_id)
+    _schedule_drip(chat_id, ctx.pos)
+
+def _render_post(i: int) -> PostPayload:
+    """Собирает пост i один раз на версию кеша медиа (см. payloads.py)."""
+    text = COURSE_POSTS[i]
+    keyboard = None if i == 5 else kb_course_2()
+    # (kind, локальный путь или None, URL фото / параметры видео)
+    items = tuple([("photo", None, COURSE_POST_PHOTOS[idx]) for idx in COURSE_POST_MEDIA.get(i, [])]
+                  + [("video", data["path"], data) for data in COURSE_POST_VIDEOS.get(i, [])])
+    if not items:
+        return PostPayload(i, text, keyboard)
+    shape, follow_up = "media_group", None
+    if shape in KEYBOARDLESS_SHAPES and keyboard is not None:
+        follow_up, keyboard = ("Мини курс по Р2Р", kb_course()), None
+    ready = MEDIA_CACHE.ready_media(list(items))
+    return PostPayload(i, text, keyboard, shape=shape, items=items, follow_up=follow_up,
+                       media=tuple(_build_group(text, items, ready)) if ready is not None else None)
+
+def _build_group(text: str, items, medias) -> list:
+    media_group = MediaGroupBuilder(caption=text)
+    for (kind, _, spec), media in zip(items, medias):
+        if kind == "photo":
+            media_group.add_photo(media=media)
+        else:
+            media_group.add_video(media=media, height=spec.get("height"), width=spec.get("width"))
+    return media_group.build()
 
-async def access_nurture(user_id: int):
-    """Спам до нажатия «ПОЛУЧИТЬ ДОСТУП». Запускать после /start."""
-    for i, delay in enumerate(ACCESS_REM_DELAYS):
-        await asyncio.sleep(delay)
-        if get_stage(user_id) >= 1:
-            break
-        txt = ACCESS_NUDGE_TEXTS[min(i, len(ACCESS_NUDGE_TEXTS) - 1)]
+POSTS = PayloadCache(_render_post, lambda: (MEDIA_CACHE.version, URL_RESOLVER.version))
+
+async def _send_course_post(chat_id: int, i: int):
+    post = POSTS.get(i)
+    if post.shape == "text":
+        await bot.send_message(chat_id, post.text, parse_mode=ParseMode.HTML, reply_markup=post.keyboard)
+        _mark_bot_sent(chat_id)
+        return
+
+    sent = False
+    if post.media is not None:
         try:
-            await bot.send_message(user_id, txt, reply_markup=kb_access())
-            _mark_bot_sent(user_id)
-        except TelegramForbiddenError:
-            break
-        except Exception as e:
-            logging.warning("PM access nudge failed: %s", e)
-            break
+            await bot.send_media_group(chat_id, list(post.media))
+            sent = True
+        except TelegramBadRequest as e:
+            if not is_bad_file_id(e):
+                raise
+            # file_id отозван — send_group сбросит его и загрузит файл заново (версия кеша сменится)
+    if not sent:
+        await MEDIA_CACHE.send_group(list(post.items), lambda medias: bot.send_media_group(
+            chat_id, _build_group(post.text, post.items, medias)))
+    _mark_bot_sent(chat_id)
+    if post.follow_up is not None:
+        # у альбома не бывает inline-клавиатуры: сразу отдельным сообщением, без попытки edit
+        text, keyboard = post.follow_up
+        await bot.send_message(chat_id, text, reply_markup=keyboard)
+        _mark_bot_sent(chat_id)
+
+def start_access_nurture(user_id: int):
+    if ACCESS_REM_DELAYS:
+        SCHEDULER.schedule("access_nurture", {"user_id": user_id, "step": 0},
+                           delay=ACCESS_REM_DELAYS[0], key=f"access_nurture:{user_id}")
+
+async def access_nurture(user_id: int, step: int = 0):
+    """Спам до нажатия «ПОЛУЧИТЬ ДОСТУП»: одно напоминание за шаг планировщика."""
+    if get_stage(user_id) >= 1:
+        return
+    txt = ACCESS_NUDGE_TEXTS[min(step, len(ACCESS_NUDGE_TEXTS) - 1)]
+    try:
+        await bot.send_message(user_id, txt, reply_markup=kb_access())
+        _mark_bot_sent(user_id)
+    except TelegramForbiddenError:
+        return
+    except Exception as e:
+        logging.warning("PM access nudge failed: %s", e)
+        return
+    if step + 1 < len(ACCESS_REM_DELAYS):
+        SCHEDULER.schedule("access_nurture", {"user_id": user_id, "step": step + 1},
+                           delay=ACCESS_REM_DELAYS[step + 1], key=f"access_nurture:{user_id}")
+
+def schedule_open_reminder(user_id: int, stage_expected: int, delay: int):
+    SCHEDULER.schedule("remind_open", {"user_id": user_id, "stage_expected": stage_expected},
+                       delay=delay, key=f"remind_open:{user_id}:{stage_expected}")
 
-async def remind_if_not_opened(user_id: int, stage_expected: int, delay: int):
-    """Напоминаем открыть урок stage_expected, если через delay он не открыт."""
-    await asyncio.sleep(delay)
+async def remind_if_not_opened(user_id: int, stage_expected: int):
+    """Напоминаем открыть урок stage_expected, если он ещё не открыт."""
     if get_stage(user_id) < stage_expected:
         texts = {
             1: "Вижу, ты ещё не открыл *первый бесплатный урок*. Забирай его сейчас 👇",
@@ -945,12 +1230,42 @@ async def remind_if_not_opened(user_id: int, stage_expected: int, delay: int):
         except Exception as e:
             logging.warning("PM reminder failed: %s", e)
 
+def _in_user_lane(fn, key: str):
+    """Задача планировщика выполняется в той же очереди, что и апдейты этого юзера."""
+    async def run(**payload):
+        return await SHARDS.run(payload[key], fn, **payload)
+    return run
+
+SCHEDULER.register("drip", _in_user_lane(send_course_posts, "chat_id"))
+SCHEDULER.register("access_nurture", _in_user_lane(access_nurture, "user_id"))
+SCHEDULER.register("remind_open", _in_user_lane(remind_if_not_opened, "user_id"))
+SCHEDULER.register("next_lesson", _in_user_lane(auto_send_next_lesson, "user_id"))
+SCHEDULER.register("delete_message", delete_message)
+SCHEDULER.register("l3_followup", _in_user_lane(_send_l3_video, "chat_id"))
+
+def _seed_drip_jobs():
+    """Первый запуск с планировщиком: подхватываем дрип для уже идущих юзеров.
+
+    Кроме купивших (loop_stopped) и заблокировавших бота (pm_ok=False / blocked_ts) — им
+    ротация после рестарта и раньше не возобновлялась.
+    """
+    seeded = 0
+    for uid, rec in STORE.iter_users():
+        if rec.get("loop_stopped") or rec.get("pm_ok") is False or rec.get("blocked_ts"):
+            continue
+        if int(rec.get("stage", 0)) >= 1 and SCHEDULER.due_of(f"drip:{uid}") is None:
+            SCHEDULER.schedule("drip", {"chat_id": uid}, key=f"drip:{uid}",
+                               delay=random.uniform(0, SCHEDULER.catchup_spread))
+            seeded += 1
+    logging.info("Seeded %d drip jobs from the store", seeded)
+
 # ========= HANDLERS =========
 
 async def start_welcome_sequence(chat_id: int):
     """Sends the full welcome message sequence."""
     set_stage(chat_id, 0)
     set_pm_ok(chat_id, True)
+    UNREACHABLE.discard(chat_id)
     # Отправляем первый блок с кнопкой
     await send_block(chat_id, BANNER_WELCOME, WELCOME_LONG, reply_markup=kb_access_reply(),
                      parse_mode=ParseMode.MARKDOWN)
@@ -978,15 +1293,15 @@ async def on_get_access(m: Message):
     _mark_bot_sent(m.chat.id)
 
     # Schedule deletion of the message after 1 second
-    asyncio.create_task(delete_message_after_delay(m.chat.id, sent_message.message_id, 1))
+    delete_message_after_delay(m.chat.id, sent_message.message_id, 1)
 
     # Отправляем интро к уроку 1 с кнопкой "ОТКРЫТЬ УРОК 1"
     await send_block(uid, BANNER_AFTER4, LESSON1_INTRO, reply_markup=kb_open(1), parse_mode=ParseMode.HTML)
 
     set_stage(uid, 1)
-    asyncio.create_task(remind_if_not_opened(uid, 1, REM1_DELAY))
-    asyncio.create_task(access_nurture(uid))
-    asyncio.create_task(send_course_posts(uid))
+    schedule_open_reminder(uid, 1, REM1_DELAY)
+    start_access_nurture(uid)
+    await start_course_posts(uid)
 
 
 
@@ -1018,30 +1333,7 @@ async def on_open(cb: CallbackQuery):
     except Exception:
         pass
 
-    if n in (1, 2):
-        URLS = {1: LESSON1_URL, 2: LESSON2_URL}
-        await send_url_only(cb.message.chat.id, URLS[n])
-        _mark_bot_sent(cb.message.chat.id)
-        stage = get_stage(uid)
-        if n > stage:
-            set_stage(uid, n)
-        await asyncio.sleep(1)
-        asyncio.create_task(auto_send_next_lesson(uid, n))
-        return
-
-    if n == 3:
-        stage = get_stage(uid)
-        if stage < 7:
-            await send_block(cb.message.chat.id, BANNER_AFTER2, GATE_BEFORE_L3, reply_markup=kb_subscribe_then_l3(), parse_mode=ParseMode.HTML)
-            _mark_bot_sent(cb.message.chat.id)
-            if stage < 6:
-                set_stage(uid, 6)
-        else:
-            await send_url_only(cb.message.chat.id, LESSON3_URL)
-            _mark_bot_sent(cb.message.chat.id)
-            if stage < 8:
-                set_stage(uid, 8)
-        return
+    await FLOW.run(f"open:{n}", Context(cb.message.chat.id, get_stage(uid)))
 
 
     # Урок 3 → блоки и рассылка постов
@@ -1061,48 +1353,45 @@ async def capture_video_note(m: Message):
     fid = m.video_note.file_id
     await m.reply(f"Captured video_note file_id:\n<code>{fid}</code>\nlen={len(fid)}", parse_mode=ParseMode.HTML)
     # сохранить в stats.json для удобства (для L3_FOLLOWUP_FILE)
-    d = _read()
-    d.setdefault("meta", {})["L3_FOLLOWUP_FILE"] = fid
-    _write(d)
+    meta = dict(STORE.get_section("meta", {}))
+    meta["L3_FOLLOWUP_FILE"] = fid
+    STORE.set_section("meta", meta)
     logging.info("Captured and saved L3_FOLLOWUP_FILE as file_id=%s", fid)
     await m.reply("Сохранил file_id в store (stats.json). Теперь можно использовать /test_l3.", parse_mode=None)
 
 @router.callback_query(F.data == "check_diary")
 async def check_diary(cb: CallbackQuery):
+    # повторные нажатия того же юзера обрабатываются строго по очереди (SHARDS)
     uid = cb.from_user.id
-    if uid in PROCESSING_CHECKS:
-        await cb.answer("Проверка уже идет, подождите...", show_alert=True)
-        return
+    await cb.answer("Проверяем подписку...", show_alert=False)
 
-    PROCESSING_CHECKS.add(uid)
-    try:
-        await cb.answer("Проверяем подписку...", show_alert=False)
+    if not FLOW.handles("diary_ok", get_stage(uid)):
+        try:
+            await cb.message.edit_reply_markup(reply_markup=None)
+        except TelegramBadRequest:
+            pass
+        return
 
-        if get_stage(uid) >= 8:
-            try:
-                await cb.message.edit_reply_markup(reply_markup=None)
-            except TelegramBadRequest:
-                pass
-            return
+    if await is_subscribed_telegram(uid):
+        try:
+            await cb.message.edit_reply_markup(reply_markup=None)
+        except TelegramBadRequest:
+            pass
+        await FLOW.run("diary_ok", Context(cb.message.chat.id, get_stage(uid)))
+    else:
+        txt = (
+            "Пока не вижу твою подписку на дневник.\n"
+            "Нажми «Подписаться на дневник», подпишись, и затем снова жми «ПРОВЕРИТЬ»."
+        )
+        await cb.message.answer(txt, reply_markup=kb_subscribe_then_l3())
 
-        if await is_subscribed_telegram(uid):
-            try:
-                await cb.message.edit_reply_markup(reply_markup=None)
-            except TelegramBadRequest:
-                pass
-            await _send_file_with_fallback(cb.message.chat.id, L3_FOLLOWUP_FILE, None)
-            URLS = {1: LESSON1_URL, 2: LESSON2_URL, 3: LESSON3_URL}
-            set_stage(uid, 8)
-            await send_url_only(cb.message.chat.id, URLS[3])
-        else:
-            txt = (
-                "Пока не вижу твою подписку на дневник.\n"
-                "Нажми «Подписаться на дневник», подпишись, и затем снова жми «ПРОВЕРИТЬ»."
-            )
-            await cb.message.answer(txt, reply_markup=kb_subscribe_then_l3())
-    finally:
-        PROCESSING_CHECKS.discard(uid)
 
+@router.chat_member()
+async def on_chat_member(update: ChatMemberUpdated):
+    """Вступил / вышел из дневника — обновляем индекс участников (бот должен быть админом канала)."""
+    if DIARY_TG_CHAT_ID and update.chat.id == DIARY_TG_CHAT_ID:
+        new = update.new_chat_member
+        DIARY_MEMBERS.note_status(new.user.id, str(getattr(new.status, "value", new.status)))
 
 @router.chat_join_request()
 async def on_join_request(req: ChatJoinRequest):
@@ -1111,21 +1400,22 @@ async def on_join_request(req: ChatJoinRequest):
     # если это твой ДНЕВНИК (канал с заявками)
     if DIARY_TG_CHAT_ID and req.chat.id == DIARY_TG_CHAT_ID:
         await req.approve()
-        logging.info("Silently approved diary join request for user %s in chat %s", uid, req.chat.id)
+        logging.info("diary join request approved", extra={"chat_id": uid, "diary_chat": req.chat.id})
         set_diary_request(uid, True)
+        DIARY_MEMBERS.note_joined(uid)
         return
 
     # For all other channels, approve and try to start the full welcome sequence.
     # await req.approve()
-    logging.info(f"Approved join request for user {uid} in chat {req.chat.id}.")
     try:
-        logging.info(f"Attempting to proactively start welcome sequence for user {uid}.")
         await start_welcome_sequence(uid)
-        logging.info(f"Successfully started welcome sequence for user {uid}.")
+        logging.info("welcome sequence started from join request",
+                     extra={"chat_id": uid, "channel": req.chat.id, "result": "ok"})
     except TelegramForbiddenError:
-        logging.warning(f"Cannot send proactive message to user {uid}. They must start the bot manually.")
+        logging.warning("cannot message user from join request, they must start the bot manually",
+                        extra={"chat_id": uid, "result": "forbidden"})
     except Exception as e:
-        logging.error(f"An unexpected error occurred in on_join_request for user {uid}: {e}")
+        logging.error("on_join_request failed: %s", e, extra={"chat_id": uid})
 
 
 @router.message(Command("test_l3"))
@@ -1162,12 +1452,225 @@ async def diag(m: Message):
     )
     _mark_bot_sent(m.chat.id)
 
+async def _funnel_days() -> dict:
+    if not MULTI_PROCESS:
+        return FUNNEL.days
+    # у каждого воркера своя секция; свою берём из памяти — в базе она может отставать
+    rows = await STORE.backend.query("SELECT name, value FROM sections WHERE name LIKE 'funnel%'")
+    states = {name: json.loads(value) for name, value in rows}
+    states[FUNNEL.section] = {"days": FUNNEL.days}
+    return merge_states(states.values())
+
 @router.message(Command("stats"))
 async def stats(m: Message):
+    """/stats [N] — состояние бота, воронка и когорты за последние N дней (по умолчанию 7)."""
     if ADMIN_ID and m.from_user.id != ADMIN_ID:
         return
-    d = _read()
-    await m.answer(f"Users tracked: {len(d.get('users', {}))}")
+    args = (m.text or "").split()[1:]
+    cohorts = int(args[0]) if args and args[0].isdigit() else 7
+    st = STORE.stats()
+    sch = SCHEDULER.stats()
+    drip_waiters = await SCHEDULER.count("drip")
+    ob = OUTBOUND.stats()
+    qg = QUIET.stats()
+    mc = MEDIA_CACHE.stats()
+    lines = [
+        f"Users tracked: {st['users']}",
+        f"Store: {st['backend']}, dirty={st['dirty']}, "
+        f"last flush {st['last_flush_dirty']} records in {st['last_flush_ms']} ms",
+        f"Scheduler: pending={sch['pending']}, running={sch['running']}, "
+        f"fired={sch['fired']}, failed={sch['failed']}",
+        f"Quiet gate: {drip_waiters} drip waiters, {qg['chats']} chats, "
+        f"wakeups={qg['wakeups']} ({qg['wakeups_per_min']}/min), deferred={qg['deferred']}",
+        f"Outbound: queued={ob['depth']}, sent={ob['sent']}, failed={ob['failed']}, "
+        f"retries 429/net={ob['retries_retry_after']}/{ob['retries_network']}, "
+        f"wait avg/max={ob['wait_avg_ms']}/{ob['wait_max_ms']} ms",
+        f"Media cache: {mc['entries']} file_ids, hits={mc['hits']}, uploads={mc['uploads']}, "
+        f"invalidated={mc['invalidations']}",
+    ]
+    if isinstance(STORE.backend, JournalBackend):
+        jb = STORE.backend.stats()
+        lines.insert(2, f"Journal: {jb['journal_bytes'] // 1024} KiB, {jb['entries']} entries in {jb['commits']} "
+                        f"commits, {jb['compactions']} snapshots (last {jb['last_compact_ms']} ms), "
+                        f"replayed {jb['replayed']} in {jb['replay_ms']} ms at start")
+    dm = DIARY_MEMBERS.stats()
+    lines.append(
+        f"Diary members: {dm['entries']} known, hit rate {dm['hit_rate'] * 100:.0f}% "
+        f"(cache {dm['hits']}, store {dm['hint_hits']}), API calls {dm['api_calls']} "
+        f"(errors {dm['api_errors']}), saved {dm['saved']}, events {dm['events']}"
+    )
+    ur = UNREACHABLE.stats()
+    lines.append(f"Unreachable: {ur['chats']} chats ({ur['bytes']} B), calls avoided {ur['avoided']}, "
+                 f"added {ur['added']}, cleared by /start {ur['cleared']}")
+    sh = SHARDS.stats()
+    lines.append(
+        f"User lanes: {sh['active_users']} active, backlog={sh['backlog']} "
+        f"(busiest shard {sh['busiest_shard_backlog']}, max {sh['max_shard_backlog']})"
+    )
+    if UPDATE_FILTER is not None:
+        uf = UPDATE_FILTER.stats()
+        reasons = ", ".join(f"{k}={v}" for k, v in sorted(uf["dropped"].items()))
+        lines.append(f"Prefilter: passed {uf['passed']}, dropped {uf['dropped_total']}"
+                     + (f" ({reasons})" if reasons else ""))
+    if UPDATE_QUEUE is not None:
+        uq = UPDATE_QUEUE.stats()
+        lines.append(
+            f"Update queue: depth={uq['depth']} (max {uq['max_depth']}), processed={uq['processed']}, "
+            f"failed={uq['failed']}, rejected={uq['rejected']}, dropped={uq['dropped']}, "
+            f"lag avg/max={uq['lag_avg_ms']}/{uq['lag_max_ms']} ms"
+        )
+    if COORD is not None:
+        co = COORD.stats()
+        lines.append(
+            f"Worker {WORKER_INDEX + 1}/{WEB_PROCESSES} ({co['owner']}, {'leader' if co['leader'] else 'follower'}): "
+            f"user locks={co['locks']}, lock waits={co['lock_waits']}, "
+            f"renewals={co['renewals']}, lost={co['locks_lost']}, "
+            f"markers claimed/lost={co['claims'] - co['claims_lost']}/{co['claims_lost']}"
+        )
+    su = STARTUP.stats()
+    lines.append("Startup (ms since process start): " + ", ".join(
+        f"{phase} {ms}" for phase, ms in su["milestones_ms"].items())
+        + f"; backlog paced {su['paced']}/{su['expected']} (waited {su['paced_wait_s']} s)")
+    slowest = sorted(FLOW.stats().items(), key=lambda kv: kv[1]["avg_ms"], reverse=True)[:3]
+    if slowest:
+        lines.append("Slowest transitions (avg/max ms): " + ", ".join(
+            f"{name} {st['avg_ms']}/{st['max_ms']} ×{st['count']}" for name, st in slowest))
+    lines.extend(report_lines(await _funnel_days(), cohorts=cohorts))
+    await m.answer("\n".join(lines), parse_mode=None)
+    _mark_bot_sent(m.chat.id)
+
+@router.message(Command("funnel_rebuild"))
+async def funnel_rebuild_cmd(m: Message):
+    """/funnel_rebuild — пересчитать счётчики воронки по всей базе."""
+    if ADMIN_ID and m.from_user.id != ADMIN_ID:
+        return
+    if MULTI_PROCESS:
+        # остальные воркеры продолжили бы писать свои секции поверх пересчёта
+        await m.answer("Rebuild is not available in webhook-multi mode; run it with RUN_MODE=webhook.",
+                       parse_mode=None)
+    else:
+        n = FUNNEL.rebuild()
+        await m.answer(f"Funnel rebuilt from {n} users ({len(FUNNEL.days)} cohort days).", parse_mode=None)
+    _mark_bot_sent(m.chat.id)
+
+@router.message(Command("media_cache"))
+async def media_cache_cmd(m: Message):
+    """/media_cache — состояние кешей медиа; /media_cache clear — сбросить список битых URL."""
+    if ADMIN_ID and m.from_user.id != ADMIN_ID:
+        return
+    if (m.text or "").split()[1:2] == ["clear"]:
+        URL_RESOLVER.clear_failures()
+    mc = MEDIA_CACHE.stats()
+    uc = URL_RESOLVER.stats()
+    lines = [
+        f"Local files: {mc['entries']} file_ids, hits={mc['hits']}, uploads={mc['uploads']}, "
+        f"invalidated={mc['invalidations']}",
+        f"URLs: {uc['file_ids']} file_ids, {uc['rewrites']} rewrites, {uc['failing']} failing, "
+        f"hits={uc['hits']}, fetches={uc['fetches']}, skipped={uc['negative_hits']}",
+    ]
+    pc = POSTS.stats()
+    lines.append(f"Rendered posts: {pc['entries']}, hits={pc['hits']}, renders={pc['renders']}, "
+                 f"invalidated={pc['invalidations']}")
+    now = time()
+    for url, via in URL_RESOLVER.rewrites.items():
+        lines.append(f"↪ {url} → {via}")
+    for url, until in URL_RESOLVER.failures.items():
+        if until > now:
+            lines.append(f"✖ {url} (ещё {int(until - now)}s)")
+    await m.answer("\n".join(lines), parse_mode=None, disable_web_page_preview=True)
+    _mark_bot_sent(m.chat.id)
+
+# ========= РАССЫЛКА ПО ВСЕЙ БАЗЕ =========
+def mark_blocked(uid: int):
+    """Юзер заблокировал бота: больше не пишем ему, пока снова не нажмёт /start."""
+    STORE.update_user(uid, pm_ok=False, blocked_ts=int(time()))
+    UNREACHABLE.add(uid)
+
+async def _deliver_broadcast(uid: int, message: Dict[str, Any]):
+    if "post" in message:
+        await _send_course_post(uid, message["post"])
+    elif "copy" in message:
+        await bot.copy_message(uid, *message["copy"])
+        _mark_bot_sent(uid)
+    else:
+        await bot.send_message(uid, message["text"])
+        _mark_bot_sent(uid)
+
+def _broadcast_skip(uid: int, rec) -> bool:
+    """Известно, что не дойдёт: бот заблокирован или чат недоступен. Зовётся из потока —
+    бинарный поиск по живому массиву UNREACHABLE в худшем случае ошибётся на одном юзере,
+    а отправку всё равно остановит UnreachableGuard."""
+    return rec.get("pm_ok") is False or uid in UNREACHABLE
+
+BROADCAST = Broadcaster(STORE, _deliver_broadcast, send_admin_message, mark_blocked, skip=_broadcast_skip,
+                        batch_size=int(os.getenv("BROADCAST_BATCH", "100")),
+                        progress_every=float(os.getenv("BROADCAST_PROGRESS_EVERY", "30")))
+
+@router.message(Command("broadcast"))
+async def broadcast_cmd(m: Message):
+    """/broadcast [stage>=N] [pm_ok=1] [loop_stopped=0] [diary_request=1] (текст | post=i | ответом на сообщение)
+
+    /broadcast status — прогресс, /broadcast cancel — остановить.
+    """
+    # рассылка по всей базе — только при заданном ADMIN_ID
+    if not ADMIN_ID or m.from_user.id != ADMIN_ID:
+        return
+    if MULTI_PROCESS:
+        # состояние рассылки — секция стора в памяти одного воркера: cancel/status с другого её не видят,
+        # а второй /broadcast на другом воркере запустил бы параллельную рассылку
+        await m.answer("Broadcast is not available in webhook-multi mode; run it with RUN_MODE=webhook.",
+                       parse_mode=None)
+        _mark_bot_sent(m.chat.id)
+        return
+    args = (m.text or "").partition(" ")[2]
+    if args.strip() in ("status", "cancel"):
+        if args.strip() == "cancel" and BROADCAST.cancel():
+            await m.answer("Рассылка остановлена.", parse_mode=None)
+            return
+        state = BROADCAST.current()
+        if not state:
+            await m.answer("Рассылок ещё не было.", parse_mode=None)
+            return
+        await m.answer(f"Broadcast #{state['id']}: {state['status']}, {describe_filters(state['filters'])}, "
+                       f"sent={state['sent']}, failed={state['failed']} (blocked={state['blocked']}), "
+                       f"skipped={state.get('skipped', 0)}, "
+                       f"done {state['sent'] + state['failed']} of {state['total']}", parse_mode=None)
+        return
+
+    filters, post, text = parse_args(args)
+    if m.reply_to_message:
+        message = {"copy": [m.chat.id, m.reply_to_message.message_id]}
+    elif post is not None:
+        if not 0 <= post < len(COURSE_POSTS):
+            await m.answer(f"post={post}: в COURSE_POSTS индексы 0..{len(COURSE_POSTS) - 1}", parse_mode=None)
+            return
+        message = {"post": post}
+    elif text:
+        message = {"text": text}
+    else:
+        await m.answer(broadcast_cmd.__doc__, parse_mode=None)
+        return
+    try:
+        state = await BROADCAST.start(message, filters)
+    except RuntimeError as e:
+        await m.answer(f"{e}; /broadcast cancel чтобы остановить", parse_mode=None)
+        return
+    await m.answer(f"Broadcast #{state['id']} запущен: {state['total']} юзеров ({describe_filters(filters)}), "
+                   f"пропущено недоступных: {state['skipped']}", parse_mode=None)
+
+@router.message(Command("profile"))
+async def profile_cmd(m: Message):
+    """/profile — отчёт; /profile on [slow_ms] | off | reset."""
+    if ADMIN_ID and m.from_user.id != ADMIN_ID:
+        return
+    args = (m.text or "").split()[1:]
+    if args[:1] == ["on"]:
+        PROFILER.enable(float(args[1]) if len(args) > 1 and args[1].isdigit() else None)
+    elif args[:1] == ["off"]:
+        PROFILER.disable()
+    elif args[:1] == ["reset"]:
+        PROFILER.reset()
+    await m.answer(PROFILER.report(), parse_mode=None)
     _mark_bot_sent(m.chat.id)
 
 @router.message(Command("test_error"))
@@ -1199,15 +1702,6 @@ def extract_file_id(msg: Message):
         return msg.animation.file_id, ct
     return None, ct
 
-@router.message()
-async def any_dm_message(message: Message):
-    fid, ct = extract_file_id(message)
-    if fid:
-        pass
-    else:
-        pass
-
-@router.channel_post()
 async def any_channel_post(message: Message):
     fid, ct = extract_file_id(message)
     if fid:
@@ -1217,22 +1711,235 @@ async def any_channel_post(message: Message):
     else:
         await message.reply(f"content_type: <b>{ct}</b>\n(немає file_id)")
 
+if FILE_ID_CHANNEL_ID:
+    router.channel_post.register(any_channel_post, F.chat.id == FILE_ID_CHANNEL_ID)
+
 # ========= WEBHOOK INFRASTRUCTURE =========
+def _register_gauges():
+    """Всё, что уже считается в stats() компонентов, — читается только при скрейпе."""
+    m = METRICS
+    m.gauge("bot_asyncio_tasks", "Live asyncio tasks", task_count)
+    m.gauge("bot_users", "Users known to the store", STORE.user_count)
+    m.gauge("bot_users_by_stage", "Users per funnel stage", lambda: dict(STORE.stage_counts), ("stage",))
+    m.gauge("bot_store_dirty_records", "Records waiting for the next flush", lambda: STORE.stats()["dirty"])
+    m.counter_func("bot_store_flush_errors_total", "Failed store flushes", lambda: STORE.flush_errors)
+    m.gauge("bot_scheduler_pending_jobs", "Pending scheduler jobs", lambda: SCHEDULER.stats()["pending"])
+    m.counter_func("bot_scheduler_jobs_total", "Scheduler jobs run by result",
+                   lambda: {"ok": SCHEDULER.fired, "failed": SCHEDULER.failed}, ("result",))
+    m.gauge("bot_outbound_queue_depth", "Sends waiting for a rate-limit token", lambda: OUTBOUND.stats()["depth"])
+    m.counter_func("bot_outbound_retries_total", "Outbound retries by cause", lambda: {
+        "retry_after": OUTBOUND.stats()["retries_retry_after"],
+        "network": OUTBOUND.stats()["retries_network"],
+    }, ("cause",))
+    m.counter_func("bot_media_cache_total", "File-id cache events", lambda: {
+        "hit": MEDIA_CACHE.hits, "upload": MEDIA_CACHE.uploads, "invalidation": MEDIA_CACHE.invalidations,
+    }, ("event",))
+    m.counter_func("bot_diary_membership_lookups_total", "Diary membership checks by source", lambda: {
+        "cache": DIARY_MEMBERS.hits, "store_hint": DIARY_MEMBERS.hint_hits, "api": DIARY_MEMBERS.api_calls,
+    }, ("source",))
+    m.gauge("bot_startup_seconds", "Cold start milestones, seconds since process start",
+            lambda: dict(STARTUP.milestones), ("phase",))
+    m.gauge("bot_unreachable_chats", "Chats suppressed after 403 / chat not found", lambda: len(UNREACHABLE))
+    m.counter_func("bot_unreachable_avoided_total", "API calls skipped for unreachable chats",
+                   lambda: UNREACHABLE.avoided)
+    m.gauge("bot_user_lanes_active", "Users with updates in flight", lambda: SHARDS.stats()["active_users"])
+    m.gauge("bot_user_lanes_backlog", "Updates waiting behind the same user", lambda: SHARDS.stats()["backlog"])
+    m.counter_func("bot_updates_prefiltered_total", "Webhook updates dropped before validation by reason",
+                   lambda: UPDATE_FILTER.stats()["dropped"] if UPDATE_FILTER is not None else {}, ("reason",))
+    m.gauge("bot_update_queue_depth", "Webhook updates queued for workers",
+            lambda: UPDATE_QUEUE.stats()["depth"] if UPDATE_QUEUE is not None else None)
+    m.counter_func("bot_update_queue_total", "Webhook queue events", lambda: {
+        k: UPDATE_QUEUE.stats()[k] for k in ("accepted", "rejected", "dropped", "processed", "failed")
+    } if UPDATE_QUEUE is not None else {}, ("event",))
+
+_register_gauges()
+
+_PROFILE_RUNNING = False
+
+async def handle_profile(request: web.Request):
+    """GET /debug/profile?seconds=10&format=collapsed|pstats, заголовок X-Profile-Secret."""
+    global _PROFILE_RUNNING
+    if not PROFILE_SECRET or not hmac.compare_digest(
+            request.headers.get("X-Profile-Secret", "").encode(), PROFILE_SECRET.encode()):
+        return web.Response(status=404)
+    try:
+        seconds = min(max(float(request.query.get("seconds", "10")), 0.1), 120.0)
+    except ValueError:
+        return web.Response(status=400, text="seconds must be a number")
+    fmt = request.query.get("format", "collapsed")
+    if fmt not in ("collapsed", "pstats"):
+        return web.Response(status=400, text="format: collapsed | pstats")
+    if _PROFILE_RUNNING:
+        return web.Response(status=409, text="a profile is already running")
+    _PROFILE_RUNNING = True
+    try:
+        return web.Response(text=await profile_cpu(seconds, fmt))
+    finally:
+        _PROFILE_RUNNING = False
 
-async def on_startup(app: web.Application):
-    """Set webhook on startup"""
-    await bot.delete_webhook(drop_pending_updates=True)
+async def _start_metrics_server() -> web.AppRunner | None:
+    """Отдельный маленький сервер /metrics для polling-режима."""
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler(METRICS, METRICS_TOKEN))
+    app.router.add_get("/debug/profile", handle_profile)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host="0.0.0.0", port=METRICS_PORT).start()
+    logging.info("Metrics server on 0.0.0.0:%s/metrics", METRICS_PORT)
+    return runner
+
+BACKGROUND_TASKS: set[asyncio.Task] = set()
+UPDATE_QUEUE: UpdateQueue | None = None  # только в режиме WEBHOOK_ACK_MODE=queue
+UPDATE_FILTER: UpdateFilter | None = None  # только в webhook-режимах
+
+def make_update_filter() -> UpdateFilter:
+    """Фильтр сырых апдейтов под те же типы, что уходят в allowed_updates."""
+    return UpdateFilter(
+        router.resolve_used_update_types(),
+        ignored_chats=WEBHOOK_IGNORE_CHATS,
+        # on_chat_member смотрит только на дневник; без него chat_member не нужен вовсе
+        only_chats={"chat_member": [DIARY_TG_CHAT_ID] if DIARY_TG_CHAT_ID else [],
+                    "channel_post": [FILE_ID_CHANNEL_ID]},
+        private_only=("message",) if WEBHOOK_PRIVATE_ONLY else (),
+    )
+
+def _start_media_warm_up():
+    # фоновая задача: сервер уже принимает апдейты, пока греются кеши
+    if MEDIA_STORAGE_CHAT_ID:
+        BACKGROUND_TASKS.add(asyncio.create_task(warm_up_media()))
+
+def _start_scheduler():
+    fresh = SCHEDULER.created
+    SCHEDULER.start()
+    if fresh:
+        _seed_drip_jobs()
+
+LEADER_LOCK = DATA_DIR / "leader.lock"
+LEADER_RETRY = float(os.getenv("LEADER_RETRY", "5"))
+
+def _start_leader_work():
+    """Планировщик, дрип, прогрев медиа и недоделанная рассылка — только в одном процессе."""
+    _start_scheduler()
+    _start_media_warm_up()
+    if MULTI_PROCESS:
+        if (BROADCAST.current() or {}).get("status") == "running":
+            logging.warning("Unfinished broadcast is left for the next single-process run (RUN_MODE=webhook)")
+    else:
+        BROADCAST.resume()
+
+async def _wait_for_leadership():
+    # лидер упал — flock освободился, забираем его работу
+    while not COORD.try_lead(LEADER_LOCK):
+        await asyncio.sleep(LEADER_RETRY)
+    _start_leader_work()
+
+def _start_background_work():
+    if COORD is None:
+        _start_leader_work()
+    elif COORD.try_lead(LEADER_LOCK):
+        _start_leader_work()
+    else:
+        BACKGROUND_TASKS.add(asyncio.create_task(_wait_for_leadership()))
+
+async def _register_webhook() -> int:
+    """setWebhook только если адрес, секрет или список апдейтов поменялись; вернёт число ждущих апдейтов."""
     if not EXTERNAL_URL:
         raise RuntimeError("External URL is required for webhook mode. Platform should provide RENDER_EXTERNAL_URL, RAILWAY_STATIC_URL, or REPLIT_DEV_DOMAIN.")
     webhook_url = f"{EXTERNAL_URL}/webhook/{WEBHOOK_SECRET}"
+    # без явного списка Telegram не присылает chat_member
+    allowed = router.resolve_used_update_types()
+    info = await bot.get_webhook_info()
+    # всё сравниваем с тем, что помнит Telegram: секрет сидит в пути url, локальный диск на Render не переживает сон
+    unchanged = (info.url == webhook_url
+                 and sorted(info.allowed_updates or []) == sorted(allowed)
+                 and info.max_connections == WEBHOOK_MAX_CONNECTIONS)
+    if unchanged and not WEBHOOK_DROP_PENDING:
+        logging.info("Webhook unchanged, %d pending updates kept", info.pending_update_count)
+        return info.pending_update_count
     await bot.set_webhook(
         url=webhook_url,
         secret_token=WEBHOOK_SECRET,
+        allowed_updates=allowed,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        drop_pending_updates=WEBHOOK_DROP_PENDING,
     )
-    logging.info("Webhook set to: %s", webhook_url)
+    pending = 0 if WEBHOOK_DROP_PENDING else info.pending_update_count
+    logging.info("Webhook set to: %s (%d pending updates %s)", webhook_url, info.pending_update_count,
+                 "dropped" if WEBHOOK_DROP_PENDING else "kept")
+    return pending
+
+def _set_deep_link(username: str):
+    global DEEP_LINK
+    DEEP_LINK = f"https://t.me/{username}?start=from_channel"
+    kb_deeplink.cache_clear()  # клавиатура могла закешироваться с пустой ссылкой
+    logging.info("Bot: @%s, Deep-link: %s", username, DEEP_LINK)
+
+async def _fetch_bot_info():
+    try:
+        me = await bot.get_me()
+    except Exception as e:
+        logging.error("Failed to get bot info: %s", e)
+        await send_admin_message(f"❌ Failed to get bot info: {e}")
+        return
+    _set_deep_link(me.username)
+
+async def _warm_start(register: bool):
+    """Порт уже слушается: состояние грузим в потоке, параллельно — вебхук и get_me."""
+    async def load():
+        try:
+            await asyncio.to_thread(_load_state)
+        except Exception as e:
+            logging.exception("Failed to load state")
+            await send_admin_message(f"❌ Failed to load state: {e}")
+            raise SystemExit(1)  # без прогресса работать нельзя — пусть платформа перезапустит
+        STARTUP.mark("state_loaded")
+        STORE.start()
+        QUIET.start()
+        UNREACHABLE.start()
+        URL_RESOLVER.start()
+        MEDIA_CACHE.start()
+        _start_background_work()
+
+    async def register_webhook():
+        try:
+            STARTUP.expect(await _register_webhook())
+        except Exception as e:
+            logging.error("Failed to register webhook: %s", e)
+            await send_admin_message(f"❌ Failed to register webhook: {e}")
+        STARTUP.mark("webhook_checked")
+
+    bot_info = asyncio.create_task(_fetch_bot_info())
+    await asyncio.gather(load(), *([register_webhook()] if register else []))
+    # открываем только после expect(): иначе бэклог Telegram проскочит без темпа,
+    # а темп достанется следующим живым апдейтам
+    STARTUP.open()
+    await bot_info
+
+async def on_startup(app: web.Application):
+    """Start background work; the slow part runs after the port is bound."""
+    if "update_queue" in app:
+        app["update_queue"].start()
+    if MULTI_PROCESS:
+        # webhook ставит родитель, он же передаёт долю накопившихся апдейтов
+        STARTUP.expect(int(os.getenv("STARTUP_PENDING", "0")))
+    BACKGROUND_TASKS.add(asyncio.create_task(_warm_start(register=not MULTI_PROCESS)))
 
 async def on_shutdown(app: web.Application):
     """Clean up on shutdown"""
+    if "update_queue" in app:
+        await app["update_queue"].close()
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    await SCHEDULER.close()
+    await QUIET.close()
+    await UNREACHABLE.close()
+    await MEDIA_CACHE.close()
+    await URL_RESOLVER.close()
+    await STORE.close()
+    if COORD is not None:
+        COORD.close()
     await bot.session.close()
 
 async def handle_webhook(request: web.Request):
@@ -1240,8 +1947,26 @@ async def handle_webhook(request: web.Request):
     if request.match_info.get("token") != WEBHOOK_SECRET:
         return web.Response(status=403)
 
+    update_filter: UpdateFilter | None = request.app.get("update_filter")
+    queue: UpdateQueue | None = request.app.get("update_queue")
+    if queue is not None:
+        # быстрый ответ Telegram: кладём апдейт в очередь, обработают воркеры
+        try:
+            data = await request.json()
+        except Exception as e:
+            logging.error("Webhook: malformed update body: %s", e)
+            return web.Response(text="OK")
+        if update_filter is not None and update_filter.check(data):
+            return web.Response(text="OK")
+        if not queue.offer(data):
+            logging.warning("Webhook: update queue is full, asking Telegram to redeliver")
+            return web.Response(status=503)
+        return web.Response(text="OK")
+
     try:
         data = await request.json()
+        if update_filter is not None and update_filter.check(data):
+            return web.Response(text="OK")  # 200, чтобы Telegram не слал его снова
         update = Update.model_validate(data)
         dp = request.app["dp"]
         await dp.feed_update(bot, update)
@@ -1251,15 +1976,39 @@ async def handle_webhook(request: web.Request):
         await send_admin_message(f"❌ Webhook error: {e}")
         return web.Response(status=500)
 
+def make_dispatcher() -> Dispatcher:
+    dp = Dispatcher()
+    dp.update.outer_middleware(STARTUP)  # до загрузки состояния апдейты ждут здесь, не в полосах юзеров
+    dp.update.outer_middleware(UserOrderMiddleware(SHARDS))
+    PROFILER.attach(dp)  # регистрируется после UserOrder: время очереди юзера не считается
+    dp.include_router(router)
+    return dp
+
 def make_web_app():
     """Create and configure the web application"""
     app = web.Application()
-    dp = Dispatcher()
-    dp.include_router(router)
+    dp = make_dispatcher()
     app["dp"] = dp
+    if WEBHOOK_PREFILTER:
+        global UPDATE_FILTER
+        UPDATE_FILTER = app["update_filter"] = make_update_filter()
+
+    if WEBHOOK_ACK_MODE == "queue":
+        async def process(data: dict):
+            try:
+                await dp.feed_update(bot, Update.model_validate(data))
+            except Exception as e:
+                await send_admin_message(f"❌ Webhook error: {e}")
+                raise
+
+        global UPDATE_QUEUE
+        UPDATE_QUEUE = app["update_queue"] = UpdateQueue(
+            process, maxsize=WEBHOOK_QUEUE_SIZE, workers=WEBHOOK_WORKERS, overflow=WEBHOOK_OVERFLOW)
     
     # Add webhook route
     app.router.add_post(f"/webhook/{{token}}", handle_webhook)
+    app.router.add_get("/metrics", metrics_handler(METRICS, METRICS_TOKEN))
+    app.router.add_get("/debug/profile", handle_profile)
     
     # Add lifecycle handlers
     app.on_startup.append(on_startup)
@@ -1269,51 +2018,57 @@ def make_web_app():
 
 async def run_polling():
     """Run bot in polling mode"""
-    dp = Dispatcher()
-    dp.include_router(router)
+    dp = make_dispatcher()
+    logging.info("Starting bot in polling mode...")
+    metrics_runner = await _start_metrics_server()
+    warm = asyncio.create_task(_warm_start(register=False))
 
     try:
-        await bot.delete_webhook(drop_pending_updates=True)
+        # getUpdates отдаст то, что накопилось, пока бот спал; вебхук снимаем, только если он стоит
+        info = await bot.get_webhook_info()
+        if info.url or WEBHOOK_DROP_PENDING:
+            await bot.delete_webhook(drop_pending_updates=WEBHOOK_DROP_PENDING)
+        if not WEBHOOK_DROP_PENDING:
+            STARTUP.expect(info.pending_update_count)
     except Exception as e:
         logging.error("Failed to delete webhook in polling mode: %s", e)
         await send_admin_message(f"❌ Error deleting webhook in polling mode: {e}")
 
-    logging.info("Starting bot in polling mode...")
     try:
         await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     except Exception as e:
         logging.error("Polling failed: %s", e)
         await send_admin_message(f"❌ Polling error: {e}")
         raise
+    finally:
+        warm.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await SCHEDULER.close()
+        await QUIET.close()
+        await UNREACHABLE.close()
+        await MEDIA_CACHE.close()
+        await URL_RESOLVER.close()
+        await STORE.close()
 
 async def main():
     """Initialize bot and set deep link"""
-    global DEEP_LINK
     me = await bot.get_me()
-    DEEP_LINK = f"https://t.me/{me.username}?start=from_channel"
-    logging.info("Bot: @%s, Deep-link: %s", me.username, DEEP_LINK)
+    _set_deep_link(me.username)
 
 async def run_webhook():
     """Run webhook server for production"""
     logging.info("Running in webhook mode on port %s", PORT)
-    global DEEP_LINK
-    try:
-        me = await bot.get_me()
-        DEEP_LINK = f"https://t.me/{me.username}?start=from_channel"
-        logging.info("Bot: @%s, Deep-link: %s", me.username, DEEP_LINK)
-    except Exception as e:
-        logging.error("Failed to get bot info: %s", e)
-        await send_admin_message(f"❌ Failed to get bot info: {e}")
-        raise
-
+    # get_me, загрузка состояния и вебхук — в _warm_start, уже после bind
     try:
         app = make_web_app()
         runner = web.AppRunner(app)
         await runner.setup()
-        site = web.TCPSite(runner, host="0.0.0.0", port=PORT)
+        site = web.TCPSite(runner, host="0.0.0.0", port=PORT, reuse_port=MULTI_PROCESS)
         await site.start()
+        STARTUP.mark("port_bound")
 
-        logging.info("Webhook server started on 0.0.0.0:%s", PORT)
+        logging.info("Webhook server started on 0.0.0.0:%s (pid %s)", PORT, os.getpid())
         # Keep the server running
         try:
             await asyncio.Future()  # run
@@ -1326,10 +2081,60 @@ async def run_webhook():
         await send_admin_message(f"❌ Webhook server error: {e}")
         raise
 
+def _run_webhook_worker():
+    asyncio.run(run_webhook())
+
+def run_webhook_multi():
+    """Parent of WEB_PROCESSES webhook workers: registers the webhook once, restarts dead workers."""
+    async def register() -> int:
+        try:
+            return await _register_webhook()
+        finally:
+            await bot.session.close()
+    # накопившиеся апдейты делим между воркерами первого запуска; перезапущенным — 0
+    pending_share = -(-asyncio.run(register()) // WEB_PROCESSES)
+
+    ctx = multiprocessing.get_context("spawn")  # не форкаем потоки и event loop родителя
+    procs: dict[int, multiprocessing.Process] = {}
+    stopping = False
+
+    def spawn(i: int):
+        os.environ["WEBHOOK_WORKER_INDEX"] = str(i)
+        os.environ["STARTUP_PENDING"] = str(pending_share if i not in procs else 0)
+        p = ctx.Process(target=_run_webhook_worker, name=f"webhook-{i}")
+        p.start()
+        procs[i] = p
+        logging.info("Webhook worker %d started (pid %s)", i, p.pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for p in procs.values():
+            if p.is_alive():
+                p.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for i in range(WEB_PROCESSES):
+        spawn(i)
+    while True:
+        multiprocessing.connection.wait([p.sentinel for p in procs.values()])
+        if stopping:
+            break
+        for i, p in list(procs.items()):
+            if not p.is_alive():
+                logging.error("Webhook worker %d (pid %s) exited with %s, restarting", i, p.pid, p.exitcode)
+                spawn(i)
+    for p in procs.values():
+        p.join()
+
 if __name__ == "__main__":
     if RUN_MODE.lower() == "polling":
         logging.info("Running in polling mode")
         asyncio.run(run_polling())
+    elif MULTI_PROCESS:
+        logging.info("Running in webhook-multi mode with %d workers", WEB_PROCESSES)
+        run_webhook_multi()
     else:
         logging.info("Running in webhook mode")
         asyncio.run(run_webhook())
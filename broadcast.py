@@ -0,0 +1,211 @@
+"""Resumable broadcast to the whole user base or a segment of it.
+
+A broadcast walks the matching users in ascending uid order in batches of
+``batch_size``.  The target list is built once per run, in a thread (a
+scan of the whole base would otherwise stall the event loop), and users
+``skip(uid, record)`` rules out — chats already known to be unreachable
+— are counted as skipped instead of being sent to.  After every batch the cursor (last uid done) and the
+counters are saved as the ``broadcast`` store section, so after a crash or
+redeploy ``resume()`` continues after the cursor; at most one batch is
+sent twice.  Pacing is left to the outbound dispatcher: the batch is sent
+concurrently and the global/per-chat token buckets keep it at the fastest
+rate Telegram allows.
+"""
+import asyncio
+import logging
+from time import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram.exceptions import TelegramForbiddenError
+
+log = logging.getLogger(__name__)
+
+FLAG_FILTERS = ("pm_ok", "loop_stopped", "diary_request")
+_STAGE_OPS = {
+    "=": lambda a, b: a == b,
+    ">=": lambda a, b: a >= b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    "<": lambda a, b: a < b,
+}
+
+
+def parse_filter(token: str) -> Optional[tuple[str, Any]]:
+    """``stage>=3`` / ``pm_ok=1`` -> (name, value); None if ``token`` is not a filter."""
+    if token.startswith("stage"):
+        for op in (">=", "<=", "=", ">", "<"):
+            rest = token[len("stage"):]
+            if rest.startswith(op) and rest[len(op):].lstrip("-").isdigit():
+                return "stage", [op, int(rest[len(op):])]
+        return None
+    name, sep, value = token.partition("=")
+    if sep and name in FLAG_FILTERS and value.lower() in ("1", "0", "true", "false", "yes", "no"):
+        return name, value.lower() in ("1", "true", "yes")
+    return None
+
+
+def parse_args(args: str) -> tuple[Dict[str, Any], Optional[int], str]:
+    """``"stage>=3 pm_ok=1 post=4"`` / ``"loop_stopped=0 Hello!"`` -> (filters, post index, text)."""
+    filters: Dict[str, Any] = {}
+    post = None
+    rest = args.strip()
+    while rest:
+        token = rest.split(None, 1)[0]
+        if token.startswith("post=") and token[5:].isdigit():
+            post = int(token[5:])
+        else:
+            parsed = parse_filter(token)
+            if parsed is None:
+                break
+            filters[parsed[0]] = parsed[1]
+        rest = rest[len(token):].lstrip()
+    return filters, post, rest
+
+
+def matches(rec: Dict[str, Any], filters: Dict[str, Any]) -> bool:
+    for name, want in filters.items():
+        if name == "stage":
+            op, n = want
+            if not _STAGE_OPS[op](int(rec.get("stage", 0)), n):
+                return False
+        elif bool(rec.get(name, False)) != want:
+            return False
+    return True
+
+
+def describe_filters(filters: Dict[str, Any]) -> str:
+    if not filters:
+        return "all users"
+    parts = []
+    for name, want in filters.items():
+        parts.append(f"stage{want[0]}{want[1]}" if name == "stage" else f"{name}={int(want)}")
+    return " ".join(parts)
+
+
+class Broadcaster:
+    def __init__(self, store, deliver: Callable[[int, Dict[str, Any]], Awaitable[Any]],
+                 notify: Callable[[str], Awaitable[Any]], on_blocked: Callable[[int], Any],
+                 skip: Optional[Callable[[int, Any], bool]] = None,
+                 batch_size: int = 100, progress_every: float = 30.0, section: str = "broadcast"):
+        self.store = store
+        self.deliver = deliver
+        self.notify = notify
+        self.on_blocked = on_blocked
+        self.skip = skip
+        self.batch_size = batch_size
+        self.progress_every = progress_every
+        self.section = section
+        self._task: asyncio.Task | None = None
+        self._starting = False
+
+    def current(self) -> Optional[Dict[str, Any]]:
+        return self.store.get_section(self.section)
+
+    def running(self) -> bool:
+        return self._starting or (self._task is not None and not self._task.done())
+
+    def targets(self, filters: Dict[str, Any], after: int = 0) -> tuple[list[int], int]:
+        """Blocking, run it in a thread: sorted matching uids after ``after``, and how many were skipped."""
+        uids, skipped = [], 0
+        for uid, rec in self.store.iter_users():
+            if uid > after and matches(rec, filters):
+                if self.skip is not None and self.skip(uid, rec):
+                    skipped += 1
+                else:
+                    uids.append(uid)
+        uids.sort()
+        return uids, skipped
+
+    async def start(self, message: Dict[str, Any], filters: Dict[str, Any]) -> Dict[str, Any]:
+        """``message`` is {"text": ...}, {"post": index} or {"copy": [chat_id, message_id]}."""
+        if self.running():
+            raise RuntimeError("a broadcast is already running")
+        self._starting = True
+        try:
+            pending, skipped = await asyncio.to_thread(self.targets, filters)
+        finally:
+            self._starting = False
+        prev = self.current() or {}
+        state = {
+            "id": int(prev.get("id", 0)) + 1,
+            "message": message,
+            "filters": filters,
+            "status": "running",
+            "cursor": 0,
+            "total": len(pending),
+            "sent": 0,
+            "failed": 0,
+            "blocked": 0,
+            "skipped": skipped,
+            "started": time(),
+        }
+        self.store.set_section(self.section, state)
+        self._task = asyncio.create_task(self._run(state, pending))
+        return state
+
+    def resume(self) -> bool:
+        state = self.current()
+        if not state or state.get("status") != "running" or self.running():
+            return False
+        log.info("broadcast #%s: resuming after uid %s", state["id"], state["cursor"])
+        self._task = asyncio.create_task(self._run(dict(state)))
+        return True
+
+    def cancel(self) -> bool:
+        state = self.current()
+        if not state or state.get("status") != "running":
+            return False
+        self.store.set_section(self.section, dict(state, status="cancelled", finished=time()))
+        if self._task is not None:
+            self._task.cancel()
+        return True
+
+    async def _send_one(self, uid: int, state: Dict[str, Any], counts: Dict[str, int]):
+        try:
+            await self.deliver(uid, state["message"])
+            counts["sent"] += 1
+        except TelegramForbiddenError:
+            counts["blocked"] += 1
+            counts["failed"] += 1
+            self.on_blocked(uid)
+        except Exception as e:
+            counts["failed"] += 1
+            log.warning("broadcast #%s: failed to deliver to %s: %s", state["id"], uid, e)
+
+    async def _run(self, state: Dict[str, Any], pending: Optional[list[int]] = None):
+        if pending is None:  # resume: пропущенные до курсора уже посчитаны при старте
+            pending, _ = await asyncio.to_thread(self.targets, state["filters"], state["cursor"])
+        # total мог измениться после рестарта: пересчитываем от уже сделанного
+        done = state["sent"] + state["failed"]
+        state["total"] = done + len(pending)
+        started_at, done_at_start = time(), done
+        last_report = time()
+        for i in range(0, len(pending), self.batch_size):
+            batch = pending[i:i + self.batch_size]
+            counts = {"sent": 0, "failed": 0, "blocked": 0}
+            await asyncio.gather(*(self._send_one(uid, state, counts) for uid in batch))
+            state = dict(state, cursor=batch[-1],
+                         sent=state["sent"] + counts["sent"],
+                         failed=state["failed"] + counts["failed"],
+                         blocked=state["blocked"] + counts["blocked"])
+            self.store.set_section(self.section, state)
+            if time() - last_report >= self.progress_every:
+                last_report = time()
+                await self.notify(self.progress_text(state, started_at, done_at_start))
+        state = dict(state, status="done", finished=time())
+        self.store.set_section(self.section, state)
+        await self.notify(self.progress_text(state, started_at, done_at_start))
+
+    @staticmethod
+    def progress_text(state: Dict[str, Any], started_at: float, done_at_start: int) -> str:
+        done = state["sent"] + state["failed"]
+        remaining = max(0, state["total"] - done)
+        rate = (done - done_at_start) / max(1e-9, time() - started_at)
+        eta = f"{remaining / rate / 60:.1f} min" if rate > 0 and remaining else "—"
+        head = "📣 Broadcast #%s %s" % (state["id"], "finished" if state["status"] == "done" else "in progress")
+        return (
+            f"{head} ({describe_filters(state['filters'])})\n"
+            f"sent: {state['sent']}, failed: {state['failed']} (blocked: {state['blocked']}), "
+            f"skipped as unreachable: {state.get('skipped', 0)}\n"
+            f"remaining: {remaining} of {state['total']}, {rate:.1f} msg/s, ETA {eta}"
+        )
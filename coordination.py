@@ -0,0 +1,298 @@
+"""Cross-process coordination for ``RUN_MODE=webhook-multi``.
+
+Several worker processes share the webhook port (SO_REUSEPORT), so any of
+them can receive any user's update.  State that used to live in process
+memory goes through one local SQLite file instead:
+
+* ``user_lock(uid)``   — per-user lock, so one user's updates and jobs never
+                          run in two processes at once.  It is a lease of
+                          ``lock_ttl`` seconds, renewed every third of that
+                          while held; if a renewal finds the lock taken over
+                          (or keeps failing until the lease could have run
+                          out) the holder is cancelled with ``LockLost``;
+* ``mark_quiet`` / ``quiet_last`` — when the bot last wrote to a chat;
+* ``claim`` / ``release`` — "already sending" markers (e.g. the video note);
+* ``set_unreachable`` / ``is_unreachable`` — chats that blocked the bot;
+* ``put_cached`` / ``cached_since`` — media file_id caches: every change is
+  a row with a growing ``seq`` (None value = deleted), workers pull what
+  is newer than the last row they saw.
+
+Leadership (who runs the scheduler and the drip) is an ``fcntl`` lock on a
+separate file: the kernel drops it when the leader dies, and a follower
+picks it up on its next ``try_lead()``.
+"""
+import asyncio
+import logging
+import os
+import socket
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from pathlib import Path
+from time import monotonic, time
+from typing import Any, Dict, Optional
+
+log = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS locks (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS quiet (
+    chat_id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS markers (
+    name TEXT NOT NULL,
+    key INTEGER NOT NULL,
+    PRIMARY KEY (name, key)
+);
+CREATE TABLE IF NOT EXISTS unreachable (
+    chat_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS cache (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    ns TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    UNIQUE (ns, key)
+);
+"""
+
+# захват свободного или протухшего лока одной командой
+_TRY_LOCK = (
+    "INSERT INTO locks (key, owner, expires) VALUES (?, ?, ?)"
+    " ON CONFLICT(key) DO UPDATE SET owner=excluded.owner, expires=excluded.expires"
+    " WHERE locks.expires < ?"
+)
+
+
+class LockLost(RuntimeError):
+    """The lease ran out while held; another process may own the user now."""
+
+
+class _Lease:
+    __slots__ = ("key", "lost")
+
+    def __init__(self, key: str):
+        self.key = key
+        self.lost = False
+
+
+class Coordinator:
+    def __init__(self, path: Path, lock_ttl: float = 120.0, quiet_window: float = 86400.0):
+        self.path = Path(path)
+        self.lock_ttl = lock_ttl
+        self.quiet_window = quiet_window
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.leader = False
+        self._leader_fd: int | None = None
+        # у каждого процесса своё соединение, все запросы — из одного потока
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="coord-db")
+        self._conn: sqlite3.Connection | None = None
+        self.locks = 0
+        self.lock_waits = 0
+        self.renewals = 0
+        self.locks_lost = 0
+        self.claims = 0
+        self.claims_lost = 0
+        self._marks = 0
+
+    # ----- coord-db thread only -----
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=10, check_same_thread=False,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _try_lock(self, key: str) -> bool:
+        now = time()
+        cur = self._db().execute(_TRY_LOCK, (key, self.owner, now + self.lock_ttl, now))
+        return cur.rowcount == 1
+
+    def _renew(self, key: str) -> bool:
+        cur = self._db().execute("UPDATE locks SET expires = ? WHERE key = ? AND owner = ?",
+                                 (time() + self.lock_ttl, key, self.owner))
+        return cur.rowcount == 1
+
+    def _unlock(self, key: str):
+        self._db().execute("DELETE FROM locks WHERE key = ? AND owner = ?", (key, self.owner))
+
+    def _put_quiet(self, chat_id: int, ts: float, prune: bool):
+        conn = self._db()
+        conn.execute("INSERT INTO quiet (chat_id, ts) VALUES (?, ?)"
+                     " ON CONFLICT(chat_id) DO UPDATE SET ts=max(ts, excluded.ts)", (chat_id, ts))
+        if prune:
+            conn.execute("DELETE FROM quiet WHERE ts < ?", (ts - self.quiet_window,))
+
+    def _get_quiet(self, chat_id: int) -> float:
+        row = self._db().execute("SELECT ts FROM quiet WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else 0.0
+
+    def _claim(self, name: str, key: int) -> bool:
+        cur = self._db().execute("INSERT OR IGNORE INTO markers (name, key) VALUES (?, ?)", (name, key))
+        return cur.rowcount == 1
+
+    def _release(self, name: str, key: int):
+        self._db().execute("DELETE FROM markers WHERE name = ? AND key = ?", (name, key))
+
+    def _put_unreachable(self, chat_id: int, flag: bool):
+        if flag:
+            self._db().execute("INSERT OR IGNORE INTO unreachable (chat_id) VALUES (?)", (chat_id,))
+        else:
+            self._db().execute("DELETE FROM unreachable WHERE chat_id = ?", (chat_id,))
+
+    def _get_unreachable(self, chat_id: int) -> bool:
+        row = self._db().execute("SELECT 1 FROM unreachable WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row is not None
+
+    def _all_unreachable(self) -> list:
+        return [r[0] for r in self._db().execute("SELECT chat_id FROM unreachable")]
+
+    def _put_cached(self, ns: str, key: str, value: Optional[str]):
+        # REPLACE удаляет старую строку и вставляет новую — с новым seq, его и увидят остальные
+        self._db().execute("INSERT OR REPLACE INTO cache (ns, key, value) VALUES (?, ?, ?)", (ns, key, value))
+
+    def _cached_since(self, seq: int) -> list:
+        return self._db().execute(
+            "SELECT seq, ns, key, value FROM cache WHERE seq > ? ORDER BY seq", (seq,)).fetchall()
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    # ----- per-user locks -----
+    @asynccontextmanager
+    async def user_lock(self, uid: Any):
+        """Hold ``uid`` across processes; yields a lease whose ``lost`` tells the body's cleanup
+        not to write back (the lock may already belong to someone else)."""
+        lease = _Lease(f"user:{uid}")
+        delay = 0.005
+        while not await self._run(self._try_lock, lease.key):
+            self.lock_waits += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        self.locks += 1
+        beat = asyncio.create_task(self._heartbeat(lease, asyncio.current_task()))
+        try:
+            yield lease
+        except asyncio.CancelledError:
+            if not lease.lost:
+                raise
+            asyncio.current_task().uncancel()
+            raise LockLost(lease.key) from None
+        finally:
+            beat.cancel()
+            await self._run(self._unlock, lease.key)
+
+    async def _heartbeat(self, lease: _Lease, holder: asyncio.Task):
+        """Продлеваем аренду, пока тело под локом работает (sleep-шаги, 429, загрузка видео)."""
+        renewed = monotonic()
+        while True:
+            await asyncio.sleep(self.lock_ttl / 3)
+            try:
+                ok = await self._run(self._renew, lease.key)
+            except sqlite3.Error as e:
+                log.warning("coordination: renewing %s failed: %s", lease.key, e)
+                ok = None
+            if ok:
+                renewed = monotonic()
+                self.renewals += 1
+                continue
+            # ok is False — лок уже чужой; ok is None — две неудачи подряд, аренда вот-вот истечёт
+            if ok is False or monotonic() - renewed >= self.lock_ttl * 2 / 3:
+                lease.lost = True
+                self.locks_lost += 1
+                log.error("coordination: lost %s while holding it, cancelling the holder", lease.key)
+                holder.cancel()
+                return
+
+    # ----- quiet-period timestamps -----
+    def mark_quiet(self, chat_id: int, ts: float):
+        """Fire-and-forget: writes are ordered on the coord-db thread."""
+        self._marks += 1
+        self._executor.submit(self._put_quiet, chat_id, ts, self._marks % 1000 == 0)
+
+    async def quiet_last(self, chat_id: int) -> float:
+        return await self._run(self._get_quiet, chat_id)
+
+    # ----- "already sending" markers -----
+    async def claim(self, name: str, key: int) -> bool:
+        """True for exactly one caller across all processes."""
+        won = await self._run(self._claim, name, key)
+        self.claims += 1
+        if not won:
+            self.claims_lost += 1
+        return won
+
+    async def release(self, name: str, key: int):
+        await self._run(self._release, name, key)
+
+    # ----- unreachable chats -----
+    def set_unreachable(self, chat_id: int, flag: bool):
+        """Fire-and-forget, like ``mark_quiet``."""
+        self._executor.submit(self._put_unreachable, chat_id, flag)
+
+    async def is_unreachable(self, chat_id: int) -> bool:
+        return await self._run(self._get_unreachable, chat_id)
+
+    def unreachable_ids(self) -> list:
+        """Blocking; for startup only."""
+        return self._executor.submit(self._all_unreachable).result()
+
+    # ----- shared caches -----
+    def put_cached(self, ns: str, key: str, value: Optional[str]):
+        """Fire-and-forget, like ``mark_quiet``; ``value=None`` deletes."""
+        self._executor.submit(self._put_cached, ns, key, value)
+
+    async def cached_since(self, seq: int) -> list:
+        """(seq, ns, key, value) rows changed after ``seq``, oldest first."""
+        return await self._run(self._cached_since, seq)
+
+    # ----- leadership -----
+    def try_lead(self, lock_path: Path) -> bool:
+        """Become the leader if nobody holds ``lock_path``; non-blocking."""
+        if self.leader:
+            return True
+        import fcntl
+
+        fd = os.open(str(lock_path), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, self.owner.encode())
+        self._leader_fd = fd
+        self.leader = True
+        log.info("coordination: %s is the leader", self.owner)
+        return True
+
+    def close(self):
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        self._executor.submit(_close).result()
+        if self._leader_fd is not None:
+            os.close(self._leader_fd)  # закрытие fd снимает flock
+            self._leader_fd = None
+            self.leader = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "owner": self.owner,
+            "leader": self.leader,
+            "locks": self.locks,
+            "lock_waits": self.lock_waits,
+            "renewals": self.renewals,
+            "locks_lost": self.locks_lost,
+            "claims": self.claims,
+            "claims_lost": self.claims_lost,
+        }
@@ -0,0 +1,152 @@
+"""Declarative funnel: what happens to a user at each stage, per event.
+
+The funnel is written as a table::
+
+    {"drip":   {2: Rule(("url", L1), ("sleep", 2), ("block", ...), ("stage", 3)), ...},
+     "open:3": {range(0, 7): Rule(("block", ...), ("stage", 6)), range(7, 10): Rule(...)}}
+
+Every rule is a sequence of actions; an action is ``(kind, *args)`` and
+``kind`` names an ``async fn(ctx, *args)`` in the action registry.
+``("stage", n)`` raises the user's stage to ``n`` (it never lowers it).
+
+``compile_flow`` checks the table once at startup (known kinds, arguments
+that bind to the action's signature, stages in range, the drip covering
+every stage and always moving forward) and turns it into one list per
+event indexed by stage, so ``Flow.run`` is a list lookup plus the awaits.
+Each transition is timed: ``stats()`` and an optional ``observe`` hook.
+"""
+import inspect
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Union
+
+Action = Callable[..., Awaitable[Any]]
+Stages = Union[int, range]
+
+
+class Rule:
+    __slots__ = ("actions",)
+
+    def __init__(self, *actions: tuple):
+        self.actions = actions
+
+
+@dataclass
+class Context:
+    """What an action gets: the chat, the stage the rule was picked for and the drip position."""
+
+    chat_id: int
+    stage: int
+    pos: int = 0
+
+
+class _Compiled:
+    __slots__ = ("name", "steps", "to", "count", "total", "max", "failed")
+
+    def __init__(self, name: str, steps: tuple, to: Optional[int]):
+        self.name = name
+        self.steps = steps  # ((fn, args), ...)
+        self.to = to
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.failed = 0
+
+
+class Flow:
+    def __init__(self, events: Dict[str, list], observe: Optional[Callable[[str, float], None]] = None):
+        self.events = events
+        self.observe = observe
+
+    def rule(self, event: str, stage: int) -> Optional[_Compiled]:
+        table = self.events.get(event)
+        if table is None:
+            return None
+        return table[min(max(stage, 0), len(table) - 1)]
+
+    def handles(self, event: str, stage: int) -> bool:
+        return self.rule(event, stage) is not None
+
+    async def run(self, event: str, ctx: Context) -> bool:
+        """Run the rule for ``ctx.stage``; False if the table has none."""
+        compiled = self.rule(event, ctx.stage)
+        if compiled is None:
+            return False
+        started = perf_counter()
+        try:
+            for fn, args in compiled.steps:
+                await fn(ctx, *args)
+        except BaseException:
+            compiled.failed += 1
+            raise
+        finally:
+            elapsed = perf_counter() - started
+            compiled.count += 1
+            compiled.total += elapsed
+            compiled.max = max(compiled.max, elapsed)
+            if self.observe is not None:
+                self.observe(compiled.name, elapsed)
+        return True
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        seen: Dict[str, Dict[str, Any]] = {}
+        for table in self.events.values():
+            for c in table:
+                if c is not None and c.name not in seen and c.count:
+                    seen[c.name] = {
+                        "count": c.count,
+                        "failed": c.failed,
+                        "avg_ms": round(c.total / c.count * 1000, 1),
+                        "max_ms": round(c.max * 1000, 1),
+                    }
+        return seen
+
+
+def _stages_of(key: Stages) -> Iterable[int]:
+    return key if isinstance(key, range) else (key,)
+
+
+def _label(key: Stages) -> str:
+    if isinstance(key, range):
+        return f"{key.start}-{key.stop - 1}"
+    return str(key)
+
+
+def compile_flow(table: Dict[str, Dict[Stages, Rule]], actions: Dict[str, Action], stages: int,
+                 drip: str = "drip", observe: Optional[Callable[[str, float], None]] = None) -> Flow:
+    """Validate ``table`` and build the per-stage dispatch lists; ValueError on mistakes."""
+    events: Dict[str, list] = {}
+    for event, rules in table.items():
+        slots: list = [None] * stages
+        for key, rule in rules.items():
+            name = f"{event}@{_label(key)}"
+            steps, to = [], None
+            for action in rule.actions:
+                kind, *args = action
+                fn = actions.get(kind)
+                if fn is None:
+                    raise ValueError(f"{name}: unknown action {kind!r}")
+                try:
+                    inspect.signature(fn).bind(None, *args)
+                except TypeError as e:
+                    raise ValueError(f"{name}: bad arguments for {kind!r}: {e}") from None
+                if kind == "stage":
+                    if not 0 <= args[0] < stages:
+                        raise ValueError(f"{name}: stage {args[0]} out of range 0..{stages - 1}")
+                    to = args[0]
+                steps.append((fn, tuple(args)))
+            compiled = _Compiled(name if to is None else f"{name}->{to}", tuple(steps), to)
+            for stage in _stages_of(key):
+                if not 0 <= stage < stages:
+                    raise ValueError(f"{name}: stage {stage} out of range 0..{stages - 1}")
+                if slots[stage] is not None:
+                    raise ValueError(f"{name}: stage {stage} already handled by {slots[stage].name}")
+                if event == drip and to is not None and to <= stage:
+                    raise ValueError(f"{name}: drip must move forward, {stage} -> {to}")
+                slots[stage] = compiled
+        events[event] = slots
+    if drip in events:
+        missing = [s for s, c in enumerate(events[drip]) if c is None]
+        if missing:
+            raise ValueError(f"{drip}: no rule for stages {missing}")
+    return Flow(events, observe)
@@ -0,0 +1,156 @@
+"""Funnel counters maintained on every stage/flag change.
+
+Each user belongs to the cohort of the day they entered the funnel (the
+``joined`` field of the record, UTC).  Per cohort day we keep how many
+users entered, how many ever reached each stage (``max_stage`` on the
+record, so a /start that resets the stage doesn't count twice) and how
+many ever set each tracked flag.  ``update()`` changes at most one
+cohort bucket, so reports never scan users; ``rebuild()`` recomputes
+everything from the store.
+
+The counters are a store section.  With ``RUN_MODE=webhook-multi`` every
+worker writes its own section (``funnel.w<N>``) and reports sum them.
+"""
+import logging
+from time import gmtime, strftime, time
+from typing import Any, Dict, Iterable, Optional
+
+log = logging.getLogger(__name__)
+
+FLAGS = ("diary_request", "first_rotation_done", "loop_stopped")
+
+
+def day_of(ts: float) -> str:
+    return strftime("%Y-%m-%d", gmtime(ts))
+
+
+def _empty(stages: int) -> Dict[str, Any]:
+    return {"users": 0, "reached": [0] * stages, **{f: 0 for f in FLAGS}}
+
+
+class Funnel:
+    def __init__(self, store, stages: int = 10, section: str = "funnel"):
+        self.store = store
+        self.stages = stages
+        self.section = section
+        self.days: Dict[str, Dict[str, Any]] = {}
+        self.rebuilt: Optional[float] = None
+
+    # ----- lifecycle -----
+    def load(self) -> bool:
+        """Pick up the persisted counters; False if there are none yet."""
+        state = self.store.get_section(self.section)
+        if not state:
+            return False
+        self.days = dict(state.get("days", {}))
+        self.rebuilt = state.get("rebuilt")
+        return True
+
+    def _save(self):
+        self.store.set_section(self.section, {"days": self.days, "rebuilt": self.rebuilt})
+
+    # ----- O(1) maintenance -----
+    def update(self, uid: int, **fields: Any):
+        """``store.update_user`` that also moves the funnel counters."""
+        old = self.store.get_user(uid)
+        if "joined" not in old:
+            # ts — последняя смена этапа; для старых записей лучше ничего нет
+            fields.setdefault("joined", int(old.get("ts") or time()))
+        if "stage" in fields and int(fields["stage"]) > self._max_stage(old):
+            fields["max_stage"] = int(fields["stage"])
+        self.store.update_user(uid, **fields)
+        self._count(old, self.store.get_user(uid))
+
+    @staticmethod
+    def _max_stage(rec: Dict[str, Any]) -> int:
+        if "joined" not in rec:
+            return -1  # ещё не в воронке
+        return int(rec.get("max_stage", rec.get("stage", 0)))
+
+    def _count(self, old: Dict[str, Any], new: Dict[str, Any]):
+        entered = "joined" not in old
+        old_max, new_max = self._max_stage(old), self._max_stage(new)
+        flags = [f for f in FLAGS if new.get(f) and not old.get(f)]
+        if not entered and new_max <= old_max and not flags:
+            return
+        day = day_of(new["joined"])
+        bucket = self.days.get(day)
+        # copy-on-write: поток flush может как раз сериализовать секцию
+        bucket = _empty(self.stages) if bucket is None else dict(bucket, reached=list(bucket["reached"]))
+        if entered:
+            bucket["users"] += 1
+        for stage in range(max(old_max + 1, 0), min(new_max + 1, self.stages)):
+            bucket["reached"][stage] += 1
+        for f in flags:
+            bucket[f] += 1
+        if day not in self.days:
+            self.days = dict(self.days)  # новый ключ — раз в сутки, копируем словарь целиком
+        self.days[day] = bucket
+        self._save()
+
+    # ----- full recount -----
+    def rebuild(self) -> int:
+        """Recount from every record in the store; backfills ``joined``/``max_stage``."""
+        days: Dict[str, Dict[str, Any]] = {}
+        n = 0
+        for uid, rec in self.store.iter_users():
+            if "joined" not in rec or "max_stage" not in rec:
+                rec = dict(rec)
+                rec.setdefault("joined", int(rec.get("ts") or time()))
+                rec.setdefault("max_stage", int(rec.get("stage", 0)))
+                self.store.update_user(uid, joined=rec["joined"], max_stage=rec["max_stage"])
+            bucket = days.setdefault(day_of(rec["joined"]), _empty(self.stages))
+            bucket["users"] += 1
+            for stage in range(min(int(rec["max_stage"]) + 1, self.stages)):
+                bucket["reached"][stage] += 1
+            for f in FLAGS:
+                if rec.get(f):
+                    bucket[f] += 1
+            n += 1
+        self.days = days
+        self.rebuilt = time()
+        self._save()
+        log.info("funnel: rebuilt counters from %d users (%d cohort days)", n, len(days))
+        return n
+
+
+def merge_states(states: Iterable[Dict[str, Any]], stages: int = 10) -> Dict[str, Dict[str, Any]]:
+    """Sum per-day counters of several ``funnel`` sections (one per worker)."""
+    out: Dict[str, Dict[str, Any]] = {}
+    for state in states:
+        for day, b in (state or {}).get("days", {}).items():
+            acc = out.setdefault(day, _empty(stages))
+            acc["users"] += b.get("users", 0)
+            for i, v in enumerate(b.get("reached", [])[:stages]):
+                acc["reached"][i] += v
+            for f in FLAGS:
+                acc[f] += b.get(f, 0)
+    return out
+
+
+def _sum_days(days: Dict[str, Dict[str, Any]], stages: int) -> Dict[str, Any]:
+    total = merge_states([{"days": {"all": b}} for b in days.values()], stages).get("all")
+    return total or _empty(stages)
+
+
+def _pct(part: int, whole: int) -> str:
+    return f"{part / whole * 100:.1f}%" if whole else "—"
+
+
+def report_lines(days: Dict[str, Dict[str, Any]], cohorts: int = 7, stages: int = 10) -> list[str]:
+    total = _sum_days(days, stages)
+    reached = total["reached"]
+    lines = [f"Funnel ({total['users']} users entered):"]
+    steps = [f"{reached[0]}"]
+    for s in range(1, stages):
+        steps.append(f"→{s}: {reached[s]} ({_pct(reached[s], reached[s - 1])})")
+    lines.append("  0: " + " ".join(steps))
+    lines.append(f"  diary requests: {total['diary_request']} ({_pct(total['diary_request'], total['users'])} of all), "
+                 f"first rotation: {total['first_rotation_done']}, loop stopped: {total['loop_stopped']}")
+    if cohorts:
+        lines.append(f"Cohorts (last {cohorts} days): entered / stage 1 / stage {stages - 1} / diary")
+        for day in sorted(days)[-cohorts:]:
+            b = days[day]
+            lines.append(f"  {day}: {b['users']} / {b['reached'][1]} / {b['reached'][stages - 1]} "
+                         f"({_pct(b['reached'][stages - 1], b['users'])}) / {b['diary_request']}")
+    return lines
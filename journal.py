@@ -0,0 +1,249 @@
+"""Append-only journal persistence: field changes to a log, snapshots now and then.
+
+``JsonBackend`` rewrites the whole stats.json on every flush, so one
+changed field costs O(all users).  ``JournalBackend`` keeps stats.json as
+the snapshot and appends to ``stats.journal`` only what changed:
+
+    [uid, "stage", 3, ts]         one field of a user
+    [uid, "*", {...}, ts]         whole record (a field disappeared)
+    [uid, null, null, ts]         user removed
+    [null, "funnel", {...}, ts]   a store section
+
+The store already batches setters between flushes, so each ``write()``
+is one group commit: the changed fields of every dirty record, one
+``write`` and one ``fsync``.  Entries are serialized with ``ujson`` when
+it is installed (``json`` otherwise).
+
+When the journal grows past ``compact_bytes`` it is renamed to
+``stats.journal.old`` and a fresh one is started; a compactor thread
+writes the snapshot from a copy of the in-memory state and then deletes
+the old journal.  Entries only ever *set* values, so replaying any
+journal over a newer snapshot is harmless: after a crash at any point
+``load()`` reads the snapshot, replays ``.old`` and then the journal.
+A torn last line (crash mid-append) is cut off.
+"""
+import json
+import logging
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter, time
+from typing import Any, Dict, Optional
+
+from records import UserRecord, records_from_json, records_to_json
+from store import atomic_write_text
+
+try:
+    import ujson
+
+    def _dumps(obj: Any) -> str:
+        return ujson.dumps(obj, ensure_ascii=False)
+
+    _loads = ujson.loads
+except ImportError:  # pragma: no cover - ujson есть в requirements, но не обязателен
+    def _dumps(obj: Any) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+    _loads = json.loads
+
+log = logging.getLogger(__name__)
+
+_USERS_KEY = "users"
+_WHOLE = "*"
+_MISSING = object()
+
+
+def _parse(data: bytes) -> tuple[list, int]:
+    """Entries of a journal and the length of its intact prefix."""
+    end = data.rfind(b"\n") + 1
+    try:
+        # одним массивом в разы быстрее, чем loads на строку; переводов строк внутри JSON нет
+        entries = _loads(b"[" + data[:end - 1].replace(b"\n", b",") + b"]") if end else []
+        if all(len(e) == 4 for e in entries):
+            return entries, end
+    except (ValueError, TypeError):
+        pass
+    entries, good = [], 0
+    for line in data[:end].splitlines(keepends=True):
+        try:
+            entry = _loads(line)
+        except ValueError:
+            break
+        if not isinstance(entry, list) or len(entry) != 4:
+            break
+        entries.append(entry)
+        good += len(line)
+    return entries, good
+
+
+class JournalBackend:
+    name = "journal"
+
+    def __init__(self, path: Path, compact_bytes: int = 16 * 2**20):
+        self.path = Path(path)  # снапшот — тот же формат, что у stats.json
+        self.journal_path = self.path.with_suffix(".journal")
+        self.old_path = self.path.with_suffix(".journal.old")
+        self.compact_bytes = compact_bytes
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+        self._compactor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal-compact")
+        self._compacting: Optional[Future] = None
+        self._users: Dict[int, UserRecord] = {}
+        self._sections: Dict[str, Any] = {}
+        self._file = None
+        self.journal_bytes = 0
+        self.entries = 0
+        self.commits = 0
+        self.compactions = 0
+        self.last_compact_ms = 0.0
+        self.replayed = 0
+        self.replay_ms = 0.0
+
+    # ----- recovery -----
+    def load(self) -> tuple[Dict[int, UserRecord], Dict[str, Any]]:
+        started = perf_counter()
+        try:
+            doc = _loads(self.path.read_text(encoding="utf-8") or "{}")
+        except FileNotFoundError:
+            doc = {}
+        users = records_from_json(doc.pop(_USERS_KEY, {}) or {})
+        sections = dict(doc)
+        self.replayed = 0
+        for path in (self.old_path, self.journal_path):
+            self.replayed += self._replay(path, users, sections)
+        self._users = dict(users)
+        self._sections = dict(sections)
+        self._file = open(self.journal_path, "ab")
+        self.journal_bytes = self._file.tell()
+        self.replay_ms = (perf_counter() - started) * 1000
+        log.info("journal: %d users from snapshot + %d journal entries in %.1f ms",
+                 len(users), self.replayed, self.replay_ms)
+        return users, sections
+
+    @staticmethod
+    def _replay(path: Path, users: Dict[int, UserRecord], sections: Dict[str, Any]) -> int:
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return 0
+        entries, good = _parse(data)
+        touched: Dict[int, Optional[Dict[str, Any]]] = {}  # правим dict'ы, в записи превращаем в конце
+        for uid, field, value, _ts in entries:
+            if uid is None:
+                sections[field] = value
+            elif field is None:
+                touched[uid] = None
+            elif field == _WHOLE:
+                touched[uid] = dict(value)
+            else:
+                rec = touched.get(uid)
+                if rec is None:
+                    old = None if uid in touched else users.get(uid)
+                    rec = touched[uid] = old.to_dict() if old is not None else {}
+                rec[field] = value
+        if good < len(data):
+            log.warning("journal: %s has a torn tail (%d bytes), cutting it off", path, len(data) - good)
+            with open(path, "r+b") as f:
+                f.truncate(good)
+        for uid, rec in touched.items():
+            if rec is None:
+                users.pop(uid, None)
+            else:
+                users[uid] = UserRecord.from_dict(rec)
+        return len(entries)
+
+    # ----- group commit (journal thread) -----
+    def write(self, dirty: Dict[int, Optional[UserRecord]], sections: Dict[str, Any]):
+        ts = int(time())
+        lines = []
+        for uid, rec in dirty.items():
+            old = self._users.get(uid)
+            if rec is None:
+                if old is not None:
+                    lines.append(_dumps([uid, None, None, ts]))
+                    del self._users[uid]
+                continue
+            if rec is old:
+                continue
+            new = rec.to_dict()
+            before = old.to_dict() if old is not None else {}
+            if any(k not in new for k in before):
+                lines.append(_dumps([uid, _WHOLE, new, ts]))
+            else:
+                for field, value in new.items():
+                    if before.get(field, _MISSING) != value:
+                        lines.append(_dumps([uid, field, value, ts]))
+            self._users[uid] = rec
+        for name, value in sections.items():
+            lines.append(_dumps([None, name, value, ts]))
+            self._sections[name] = value
+        if not lines:
+            return
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.journal_bytes += len(data)
+        self.entries += len(lines)
+        self.commits += 1
+        if self.journal_bytes >= self.compact_bytes and (self._compacting is None or self._compacting.done()):
+            self._start_compaction()
+
+    # ----- compaction -----
+    def _start_compaction(self):
+        self._file.close()
+        if self.old_path.exists():
+            # прошлое сжатие не дошло до конца (упали) — доклеиваем, порядок записей сохраняется
+            with open(self.old_path, "ab") as dst:
+                dst.write(self.journal_path.read_bytes())
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.unlink(self.journal_path)
+        else:
+            os.replace(self.journal_path, self.old_path)
+        self._file = open(self.journal_path, "ab")
+        self.journal_bytes = 0
+        # копии словарей: записи неизменяемые, сериализуем их уже в другом потоке
+        self._compacting = self._compactor.submit(self._compact, dict(self._users), dict(self._sections))
+
+    def _compact(self, users: Dict[int, UserRecord], sections: Dict[str, Any]):
+        started = perf_counter()
+        try:
+            doc = dict(sections)
+            doc[_USERS_KEY] = records_to_json(users)
+            atomic_write_text(self.path, _dumps(doc))
+            os.unlink(self.old_path)
+        except Exception:
+            log.exception("journal: compaction failed, %s is kept for replay", self.old_path)
+            return
+        self.compactions += 1
+        self.last_compact_ms = (perf_counter() - started) * 1000
+        log.info("journal: snapshot of %d users written in %.1f ms", len(users), self.last_compact_ms)
+
+    def compact(self):
+        """Snapshot now and wait for it (admin command, tests, benches)."""
+        def _now():
+            if self._compacting is not None:
+                self._compacting.result()
+            self._start_compaction()
+            return self._compacting
+        self.executor.submit(_now).result().result()
+
+    def close(self):
+        def _close():
+            if self._compacting is not None:
+                self._compacting.result()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        self.executor.submit(_close).result()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "journal_bytes": self.journal_bytes,
+            "entries": self.entries,
+            "commits": self.commits,
+            "compactions": self.compactions,
+            "last_compact_ms": round(self.last_compact_ms, 1),
+            "replayed": self.replayed,
+            "replay_ms": round(self.replay_ms, 1),
+        }
@@ -0,0 +1,134 @@
+"""Logging off the event loop: QueueHandler -> background QueueListener.
+
+The event loop only builds a ``LogRecord``, runs the rate limiter and puts
+the record on a queue; ``%`` formatting, JSON encoding and the write to
+stderr happen in the listener thread.
+
+* ``JsonFormatter`` emits one object per line: ts, level, logger, msg and
+  any ``extra={...}`` fields (chat_id, stage, method, result, ...);
+* ``SiteRateLimit`` caps INFO/WARNING records per call site (file:line) to
+  ``rate``/s with a ``burst``; over the cap only every ``sample_every``-th
+  record passes and carries ``suppressed`` = how many were dropped since
+  the previous one.  ERROR and above always pass;
+* levels are set per logger from ``LOG_LEVELS="aiogram.event=WARNING,store=DEBUG"``.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from time import gmtime, monotonic, strftime
+from typing import Any, Dict, Optional
+
+# атрибуты, которые есть у любой записи; всё остальное пришло через extra=
+_STANDARD = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, static: Optional[Dict[str, Any]] = None):
+        super().__init__()
+        self.static = static or {}
+
+    def format(self, record: logging.LogRecord) -> str:
+        doc: Dict[str, Any] = {
+            "ts": strftime("%Y-%m-%dT%H:%M:%S", gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **self.static,
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD:
+                doc[key] = value
+        if record.exc_info:
+            doc["exc"] = self.formatException(record.exc_info)
+        return json.dumps(doc, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Plain text with the ``extra`` fields appended as key=value."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = " ".join(f"{k}={v}" for k, v in record.__dict__.items() if k not in _STANDARD)
+        return f"{line} [{fields}]" if fields else line
+
+
+class SiteRateLimit(logging.Filter):
+    def __init__(self, rate: float = 20.0, burst: float = 100.0, sample_every: int = 100):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample_every = max(1, sample_every)
+        # (pathname, lineno) -> [tokens, last_refill, dropped]
+        self._sites: Dict[tuple, list] = {}
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.ERROR or self.rate <= 0:
+            return True
+        site = (record.pathname, record.lineno)
+        now = monotonic()
+        st = self._sites.get(site)
+        if st is None:
+            st = self._sites[site] = [self.burst, now, 0]
+        st[0] = min(self.burst, st[0] + (now - st[1]) * self.rate)
+        st[1] = now
+        if st[0] >= 1:
+            st[0] -= 1
+        elif (st[2] + 1) % self.sample_every:
+            st[2] += 1
+            self.dropped += 1
+            return False
+        if st[2]:
+            record.suppressed = st[2]
+            st[2] = 0
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # стандартный prepare форматирует сообщение здесь, на event loop; отдаём запись как есть
+        return record
+
+
+def parse_levels(spec: str) -> Dict[str, str]:
+    """``"aiogram.event=WARNING, store=DEBUG"`` -> {"aiogram.event": "WARNING", "store": "DEBUG"}."""
+    levels = {}
+    for part in spec.split(","):
+        name, sep, level = part.strip().partition("=")
+        if sep and name.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(level: str = "INFO", fmt: str = "json", levels: str = "",
+                  rate: float = 20.0, burst: float = 100.0, sample_every: int = 100,
+                  static: Optional[Dict[str, Any]] = None) -> logging.handlers.QueueListener:
+    """Route the root logger through a queue to a stderr writer thread."""
+    out = logging.StreamHandler(sys.stderr)
+    out.setFormatter(JsonFormatter(static) if fmt == "json" else TextFormatter())
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    handler = _QueueHandler(q)
+    handler.addFilter(SiteRateLimit(rate, burst, sample_every))
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+    for name, lvl in parse_levels(levels).items():
+        logging.getLogger(name).setLevel(lvl)
+    listener = logging.handlers.QueueListener(q, out, respect_handler_level=True)
+    listener.start()
+    atexit.register(_stop, listener)
+    return listener
+
+
+def _stop(listener: logging.handlers.QueueListener):
+    """Drain the queue on exit (no-op if already stopped)."""
+    if listener._thread is not None:
+        listener.stop()
@@ -0,0 +1,424 @@
+"""Upload-once caches of Telegram file_ids for local files and remote URLs.
+
+The first successful upload of ``videos/post_2.MOV`` (or the welcome video
+note) records the ``file_id`` Telegram returns; every later send reuses
+it instead of uploading the same megabytes again.  Entries are keyed by
+kind, absolute path, size and mtime, so replacing a file on disk yields a
+fresh upload.  If Telegram rejects a cached id, the entry is dropped and
+the file is uploaded again.
+
+``UrlResolver`` does the same for remote banners (files.fm, imgur): it
+memoizes the file_id of the first successful send, remembers which imgur
+album -> direct URL rewrite worked, and keeps a TTL'd negative cache of
+URLs Telegram refuses, so broken banners go straight to the text path.
+
+With several workers (``RUN_MODE=webhook-multi``, ``shared`` is a
+``coordination.Coordinator``) the JSON files are only read at start:
+every change is written through to the coordinator's ``cache`` table, and
+``start()`` pulls what other workers learned every ``sync_interval``
+seconds, so a file_id uploaded by one worker (or the leader's warm-up)
+reaches all of them and no worker's file overwrites another's.
+"""
+import asyncio
+import json
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from time import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+
+from store import atomic_write_text
+
+log = logging.getLogger(__name__)
+
+
+def is_bad_file_id(e: Exception) -> bool:
+    """Telegram no longer accepts this file_id (expired, foreign bot, ...)."""
+    text = str(e).lower()
+    return isinstance(e, TelegramBadRequest) and (
+        "file identifier" in text or "file reference" in text or "wrong remote file" in text
+    )
+
+
+def is_bad_url(e: Exception) -> bool:
+    """Telegram could not fetch the URL or it is not an image."""
+    text = str(e)
+    return isinstance(e, TelegramBadRequest) and (
+        "wrong type of the web page content" in text
+        or "failed to get HTTP URL content" in text
+        or "wrong HTTP URL" in text
+    )
+
+
+def imgur_direct_url(url: str) -> Optional[str]:
+    """imgur.com/a/<id> album link -> i.imgur.com/<id>.jpg guess."""
+    if "imgur.com/a/" not in url:
+        return None
+    album_id = url.split("/a/")[-1].split("?")[0].split("#")[0]
+    return f"https://i.imgur.com/{album_id}.jpg"
+
+
+# один поток на все записи: снапшоты ложатся на диск в том порядке, в каком сделаны
+_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="media-cache-io")
+
+
+def _log_write_error(path: Path, fut: Future):
+    e = fut.exception()
+    if e is not None:
+        log.error("media cache: failed to write %s: %s", path, e)
+
+
+def _save_json_soon(path: Path, obj: Any):
+    """Serialize now, write on the writer thread; returns at once."""
+    data = json.dumps(obj, ensure_ascii=False, indent=1)
+    fut = _WRITER.submit(atomic_write_text, path, data)
+    fut.add_done_callback(partial(_log_write_error, path))
+
+
+class _SharedCache:
+    """Write-through to ``shared`` and a periodic pull of other workers' changes."""
+
+    version: int
+
+    def _init_shared(self, shared, sync_interval: float):
+        self.shared = shared
+        self.sync_interval = sync_interval
+        self._seq = 0  # последняя строка общей таблицы, которую мы видели
+        self._task: asyncio.Task | None = None
+        self.synced = 0
+
+    def _publish(self, ns: str, key: str, value: Optional[str]):
+        if self.shared is not None:
+            self.shared.put_cached(ns, key, value)
+
+    def _apply(self, ns: str, key: str, value: Optional[str]):
+        raise NotImplementedError
+
+    async def sync(self):
+        rows = await self.shared.cached_since(self._seq)
+        for seq, ns, key, value in rows:
+            self._seq = seq
+            self._apply(ns, key, value)
+        if rows:
+            self.synced += len(rows)
+            self.version += 1
+
+    def start(self):
+        if self.shared is not None and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._sync_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _sync_loop(self):
+        while True:
+            try:
+                await self.sync()
+            except Exception:
+                log.exception("media cache: pulling shared entries failed")
+            await asyncio.sleep(self.sync_interval)
+
+
+def file_id_of(msg: Message, kind: str) -> Optional[str]:
+    obj = getattr(msg, kind, None)
+    if kind == "photo" and obj:
+        obj = obj[-1]
+    return getattr(obj, "file_id", None)
+
+
+class FileIdCache(_SharedCache):
+    def __init__(self, path: Path, base_dir: Path, urls: Optional["UrlResolver"] = None,
+                 shared=None, sync_interval: float = 5.0):
+        self._init_shared(shared, sync_interval)
+        self.path = Path(path)
+        self.base_dir = Path(base_dir)
+        self.urls = urls
+        self._entries: Dict[str, str] = {}
+        self.version = 0  # растёт при каждом изменении — для тех, кто кеширует поверх
+        self.hits = 0
+        self.uploads = 0
+        self.invalidations = 0
+        try:
+            self._entries = json.loads(self.path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            pass
+        except Exception:
+            log.exception("media cache: failed to read %s, starting empty", self.path)
+
+    def resolve(self, path: str) -> Path:
+        p = Path(path)
+        return p if p.is_absolute() else self.base_dir / p
+
+    def _key(self, path: str, kind: str) -> Optional[str]:
+        p = self.resolve(path)
+        try:
+            st = p.stat()
+        except OSError:
+            return None
+        return f"{kind}:{p}:{st.st_size}:{st.st_mtime_ns}"
+
+    def get(self, path: str, kind: str) -> Optional[str]:
+        key = self._key(path, kind)
+        return self._entries.get(key) if key else None
+
+    def media(self, path: str, kind: str):
+        """Cached file_id if we have one, otherwise an FSInputFile to upload."""
+        return self.get(path, kind) or FSInputFile(self.resolve(path))
+
+    def remember(self, path: str, kind: str, file_id: Optional[str]):
+        key = self._key(path, kind)
+        if not key or not file_id or self._entries.get(key) == file_id:
+            return
+        self._entries[key] = file_id
+        self.version += 1
+        self._publish("file_id", key, file_id)
+        self._save_soon()
+
+    def invalidate(self, path: str, kind: str):
+        key = self._key(path, kind)
+        if key and self._entries.pop(key, None) is not None:
+            self.invalidations += 1
+            self.version += 1
+            log.warning("media cache: dropped rejected file_id for %s (%s)", path, kind)
+            self._publish("file_id", key, None)
+            self._save_soon()
+
+    def _save_soon(self):
+        if self.shared is None:  # иначе воркеры затирали бы файл друг друга — всё лежит в общей базе
+            _save_json_soon(self.path, self._entries)
+
+    def _apply(self, ns: str, key: str, value: Optional[str]):
+        if ns != "file_id":
+            return
+        if value is None:
+            self._entries.pop(key, None)
+        else:
+            self._entries[key] = value
+
+    async def send(self, path: str, kind: str, send: Callable[[Any], Awaitable[Message]]) -> Message:
+        """Send a local file via ``send(media)``, reusing the cached file_id if any."""
+        file_id = self.get(path, kind)
+        if file_id:
+            try:
+                msg = await send(file_id)
+                self.hits += 1
+                return msg
+            except TelegramBadRequest as e:
+                if not is_bad_file_id(e):
+                    raise
+                self.invalidate(path, kind)
+        msg = await send(FSInputFile(self.resolve(path)))
+        self.uploads += 1
+        self.remember(path, kind, file_id_of(msg, kind))
+        return msg
+
+    def _remote(self, kind: str, media: Any) -> Any:
+        if self.urls is not None and kind == "photo" and isinstance(media, str):
+            return self.urls.file_id(media) or self.urls.rewrites.get(media, media)
+        return media
+
+    def ready_media(self, items: list[tuple[str, Optional[str], Any]]) -> Optional[list]:
+        """Media objects for ``send_group`` items if no local file needs an upload, else None."""
+        medias = []
+        for kind, path, media in items:
+            if path:
+                file_id = self.get(path, kind)
+                if file_id is None:
+                    return None
+                medias.append(file_id)
+            else:
+                medias.append(self._remote(kind, media))
+        return medias
+
+    async def send_group(self, items: list[tuple[str, Optional[str], Any]],
+                         send: Callable[[list], Awaitable[list[Message]]]) -> list[Message]:
+        """Send a media group; ``items`` are (kind, local_path | None, remote media).
+
+        ``send(medias)`` receives one media object per item in the same order.
+        """
+        remote = self._remote
+        medias = [self.media(path, kind) if path else remote(kind, media) for kind, path, media in items]
+        try:
+            msgs = await send(medias)
+        except TelegramBadRequest as e:
+            if not is_bad_file_id(e):
+                raise
+            for kind, path, media in items:
+                if path:
+                    self.invalidate(path, kind)
+                elif self.urls is not None and isinstance(media, str):
+                    self.urls.forget(media)
+            medias = [FSInputFile(self.resolve(path)) if path else remote(kind, media)
+                      for kind, path, media in items]
+            msgs = await send(medias)
+        for (kind, path, orig), media, msg in zip(items, medias, msgs):
+            if not path:
+                if self.urls is not None and kind == "photo" and isinstance(orig, str) and media != self.urls.file_id(orig):
+                    self.urls.remember(orig, file_id_of(msg, kind))
+                continue
+            if isinstance(media, FSInputFile):
+                self.uploads += 1
+                self.remember(path, kind, file_id_of(msg, kind))
+            else:
+                self.hits += 1
+        return msgs
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "uploads": self.uploads,
+            "invalidations": self.invalidations,
+            "synced": self.synced,
+        }
+
+
+class UrlResolver(_SharedCache):
+    """file_id memo + working rewrites + TTL negative cache for remote photos."""
+
+    def __init__(self, path: Path, negative_ttl: float = 3600.0, shared=None, sync_interval: float = 5.0):
+        self._init_shared(shared, sync_interval)
+        self.path = Path(path)
+        self.negative_ttl = negative_ttl
+        self.file_ids: Dict[str, str] = {}
+        self.rewrites: Dict[str, str] = {}
+        self.failures: Dict[str, float] = {}  # url -> unix time, до которого не пробуем
+        self.hits = 0
+        self.fetches = 0
+        self.negative_hits = 0
+        self.version = 0
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+            self.file_ids = data.get("file_ids", {})
+            self.rewrites = data.get("rewrites", {})
+            self.failures = data.get("failures", {})
+        except FileNotFoundError:
+            pass
+        except Exception:
+            log.exception("url cache: failed to read %s, starting empty", self.path)
+
+    def _save_soon(self):
+        self.version += 1
+        if self.shared is None:
+            _save_json_soon(self.path, {
+                "file_ids": self.file_ids, "rewrites": self.rewrites, "failures": self.failures,
+            })
+
+    def _apply(self, ns: str, key: str, value: Optional[str]):
+        if ns == "url_file_id":
+            target = self.file_ids
+        elif ns == "url_rewrite":
+            target = self.rewrites
+        elif ns == "url_failure":
+            target, value = self.failures, None if value is None else float(value)
+        else:
+            return
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = value
+
+    def file_id(self, url: str) -> Optional[str]:
+        return self.file_ids.get(url)
+
+    def is_failing(self, url: str) -> bool:
+        until = self.failures.get(url)
+        if until is None:
+            return False
+        if until <= time():
+            del self.failures[url]
+            return False
+        return True
+
+    def remember(self, url: str, file_id: Optional[str], via: Optional[str] = None):
+        changed = False
+        if file_id and self.file_ids.get(url) != file_id:
+            self.file_ids[url] = file_id
+            self._publish("url_file_id", url, file_id)
+            changed = True
+        if via and via != url and self.rewrites.get(url) != via:
+            self.rewrites[url] = via
+            self._publish("url_rewrite", url, via)
+            changed = True
+        if self.failures.pop(url, None) is not None:
+            self._publish("url_failure", url, None)
+            changed = True
+        if changed:
+            self._save_soon()
+
+    def forget(self, url: str):
+        if self.file_ids.pop(url, None) is not None:
+            self._publish("url_file_id", url, None)
+            self._save_soon()
+
+    def mark_failed(self, url: str):
+        until = self.failures[url] = time() + self.negative_ttl
+        self._publish("url_failure", url, repr(until))
+        self._save_soon()
+
+    def clear_failures(self):
+        for url in self.failures:
+            self._publish("url_failure", url, None)
+        self.failures.clear()
+        self._save_soon()
+
+    async def send_photo(self, url: str, send: Callable[[Any], Awaitable[Message]]) -> Optional[Message]:
+        """Send a remote photo via ``send(photo)``.
+
+        Returns None if the URL is known (or found) to be unusable — the
+        caller should fall back to a text message.
+        """
+        if self.is_failing(url):
+            self.negative_hits += 1
+            return None
+        file_id = self.file_ids.get(url)
+        if file_id:
+            try:
+                msg = await send(file_id)
+                self.hits += 1
+                return msg
+            except TelegramBadRequest as e:
+                if not is_bad_file_id(e):
+                    raise
+                self.forget(url)
+
+        candidates = [self.rewrites.get(url, url)]
+        direct = imgur_direct_url(url)
+        if direct and direct not in candidates:
+            candidates.append(direct)
+        for candidate in candidates:
+            try:
+                msg = await send(candidate)
+            except TelegramBadRequest as e:
+                if not is_bad_url(e):
+                    raise
+                log.warning("Banner URL '%s' rejected by Telegram: %s", candidate, e)
+                continue
+            self.fetches += 1
+            self.remember(url, file_id_of(msg, "photo"), via=candidate)
+            return msg
+        log.warning("Banner URL '%s' is unusable, using text for the next %.0fs", url, self.negative_ttl)
+        self.mark_failed(url)
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        now = time()
+        return {
+            "file_ids": len(self.file_ids),
+            "rewrites": len(self.rewrites),
+            "failing": sum(1 for until in self.failures.values() if until > now),
+            "hits": self.hits,
+            "fetches": self.fetches,
+            "negative_hits": self.negative_hits,
+            "synced": self.synced,
+        }
@@ -0,0 +1,173 @@
+"""Startup media manifest: resolve, validate and pre-upload every media reference.
+
+Media is referenced from many places (``BANNER_*`` env vars, course post
+photos/videos, the welcome video note, the L3 follow-up).  The manifest
+resolves each reference once, checks that local files exist and fit
+Telegram's upload limits, and can pre-upload everything to a private
+storage chat so the file_id caches are warm before the first user arrives.
+"""
+import asyncio
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Dict, Iterable, Optional
+
+log = logging.getLogger(__name__)
+
+# лимиты Bot API на загрузку файлов
+MAX_UPLOAD_BYTES = {
+    "photo": 10 * 1024 * 1024,
+    "video": 50 * 1024 * 1024,
+    "video_note": 50 * 1024 * 1024,
+    "document": 50 * 1024 * 1024,
+}
+
+
+def resolve_local(value: str, base_dir: Path) -> Optional[Path]:
+    """Path of an existing local file for ``value``, or None.
+
+    A bare file name is looked up in ``videos/``, a relative path against
+    the project directory.
+    """
+    p = Path(value)
+    if p.is_absolute():
+        return p if p.is_file() else None
+    if "/" not in value and "\\" not in value:
+        candidate = base_dir / "videos" / value
+        if candidate.is_file():
+            return candidate
+    candidate = base_dir / value
+    return candidate if candidate.is_file() else None
+
+
+def is_path_like(value: str) -> bool:
+    return "/" in value or "\\" in value
+
+
+@dataclass
+class MediaRef:
+    name: str
+    value: str
+    kind: str
+    status: str = "unchecked"  # ok | remote | file_id | missing | too_large | empty
+    local: Optional[Path] = None
+    size: Optional[int] = None
+    warmed: bool = False
+
+
+class MediaManifest:
+    def __init__(self, base_dir: Path):
+        self.base_dir = Path(base_dir)
+        self.refs: list[MediaRef] = []
+        self._by_value: Dict[str, MediaRef] = {}
+        self.warmup_seconds: Optional[float] = None
+
+    def add(self, name: str, value: str, kind: str):
+        self.refs.append(MediaRef(name=name, value=value or "", kind=kind))
+
+    def validate(self):
+        for ref in self.refs:
+            value = ref.value
+            if not value:
+                ref.status = "empty"
+            elif value.startswith(("http://", "https://")):
+                ref.status = "remote"
+            else:
+                ref.local = resolve_local(value, self.base_dir)
+                if ref.local is not None:
+                    ref.size = ref.local.stat().st_size
+                    limit = MAX_UPLOAD_BYTES.get(ref.kind, MAX_UPLOAD_BYTES["document"])
+                    ref.status = "ok" if ref.size <= limit else "too_large"
+                elif is_path_like(value) or Path(value).suffix:
+                    ref.status = "missing"
+                else:
+                    ref.status = "file_id"
+            self._by_value.setdefault(value, ref)
+
+    def resolve(self, value: str) -> Optional[Path]:
+        """Resolved local path, memoized for known references."""
+        ref = self._by_value.get(value)
+        if ref is not None and ref.status in ("ok", "too_large"):
+            return ref.local
+        if ref is not None and ref.status in ("missing", "file_id", "remote", "empty"):
+            return None
+        return resolve_local(value, self.base_dir)
+
+    def problems(self) -> list[MediaRef]:
+        return [r for r in self.refs if r.status in ("missing", "too_large")]
+
+    def report(self) -> str:
+        counts: Dict[str, int] = {}
+        for ref in self.refs:
+            counts[ref.status] = counts.get(ref.status, 0) + 1
+        lines = [
+            "Media manifest: %d refs (%s)" % (
+                len(self.refs), ", ".join(f"{k}={v}" for k, v in sorted(counts.items()))),
+        ]
+        for ref in self.problems():
+            detail = f"{ref.size / 1024 / 1024:.1f} MB" if ref.size is not None else ref.value
+            lines.append(f"  {ref.status.upper()}: {ref.name} -> {detail}")
+        if self.warmup_seconds is not None:
+            warmed = sum(1 for r in self.refs if r.warmed)
+            lines.append(f"  warm-up: {warmed} assets cached in {self.warmup_seconds:.1f}s")
+        return "\n".join(lines)
+
+    async def warm_up(self, bot, storage_chat_id: int, file_cache, url_resolver, concurrency: int = 4):
+        """Pre-upload every usable asset to ``storage_chat_id`` to fill the caches."""
+        started = perf_counter()
+        sem = asyncio.Semaphore(concurrency)
+        senders = {
+            "photo": bot.send_photo,
+            "video": bot.send_video,
+            "video_note": bot.send_video_note,
+        }
+        seen: set[tuple[str, str]] = set()
+
+        async def warm(ref: MediaRef):
+            send = senders.get(ref.kind)
+
+            async def upload(media: Any):
+                return await send(storage_chat_id, media, disable_notification=True)
+
+            async with sem:
+                try:
+                    if ref.status == "ok":
+                        if not file_cache.get(str(ref.local), ref.kind):
+                            await file_cache.send(str(ref.local), ref.kind, upload)
+                        ref.warmed = True
+                    elif ref.status == "remote" and ref.kind == "photo":
+                        if url_resolver.file_id(ref.value) or await url_resolver.send_photo(ref.value, upload):
+                            ref.warmed = True
+                except Exception as e:
+                    log.warning("media warm-up: %s (%s) failed: %s", ref.name, ref.value, e)
+
+        tasks = []
+        for ref in self.refs:
+            key = (ref.value, ref.kind)
+            if key in seen or ref.kind not in senders:
+                continue
+            seen.add(key)
+            tasks.append(warm(ref))
+        await asyncio.gather(*tasks)
+        # одинаковые значения под разными именами тоже считаем прогретыми
+        warmed = {(r.value, r.kind) for r in self.refs if r.warmed}
+        for ref in self.refs:
+            ref.warmed = (ref.value, ref.kind) in warmed
+        self.warmup_seconds = perf_counter() - started
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "refs": len(self.refs),
+            "problems": len(self.problems()),
+            "warmed": sum(1 for r in self.refs if r.warmed),
+            "warmup_seconds": self.warmup_seconds,
+        }
+
+
+def build_manifest(base_dir: Path, entries: Iterable[tuple[str, str, str]]) -> MediaManifest:
+    manifest = MediaManifest(base_dir)
+    for name, value, kind in entries:
+        manifest.add(name, value, kind)
+    manifest.validate()
+    return manifest
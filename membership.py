@@ -0,0 +1,87 @@
+"""Who is in the diary channel, answered mostly without ``get_chat_member``.
+
+Entries come from three places, most trusted first:
+
+* events: ``chat_join_request`` (the bot approves diary requests at once)
+  and ``chat_member`` updates for the channel.  These are Telegram's own
+  word and don't expire until the next event for that user;
+* the store hint: ``hint(uid)`` returns when the bot approved the user's
+  request (``diary_ts``) or None.  An approval counts as membership for
+  ``member_ttl`` seconds after it, like a positive API answer — the flag is
+  never cleared, and a later ``left``/``kicked`` event is only seen by the
+  process that received it;
+* ``get_chat_member`` through ``check(uid)``, cached ``member_ttl``
+  seconds when positive and ``nonmember_ttl`` when negative (short, since
+  users press "ПРОВЕРИТЬ" right after subscribing).  Failed calls are not
+  cached.
+"""
+import logging
+from time import monotonic, time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+log = logging.getLogger(__name__)
+
+MEMBER_STATUSES = frozenset({"member", "administrator", "creator"})
+_FOREVER = float("inf")
+
+
+class MembershipIndex:
+    def __init__(self, check: Callable[[int], Awaitable[bool]],
+                 hint: Optional[Callable[[int], Optional[float]]] = None,
+                 member_ttl: float = 3600.0, nonmember_ttl: float = 30.0):
+        self.check = check
+        self.hint = hint
+        self.member_ttl = member_ttl
+        self.nonmember_ttl = nonmember_ttl
+        self._entries: Dict[int, tuple[bool, float]] = {}  # uid -> (member, истекает по monotonic())
+        self.hits = 0
+        self.hint_hits = 0
+        self.events = 0
+        self.api_calls = 0
+        self.api_errors = 0
+
+    # ----- events -----
+    def note_status(self, uid: int, status: str):
+        """A ``chat_member`` update: ``status`` is the new ChatMemberStatus value."""
+        self.events += 1
+        self._entries[uid] = (status in MEMBER_STATUSES, _FOREVER)
+
+    def note_joined(self, uid: int):
+        self.events += 1
+        self._entries[uid] = (True, _FOREVER)
+
+    # ----- lookups -----
+    async def is_member(self, uid: int) -> bool:
+        entry = self._entries.get(uid)
+        if entry is not None:
+            member, expires = entry
+            if expires > monotonic():
+                self.hits += 1
+                return member
+            del self._entries[uid]
+        approved = self.hint(uid) if self.hint is not None else None
+        if approved and time() - approved < self.member_ttl:
+            self.hint_hits += 1
+            return True
+        self.api_calls += 1
+        try:
+            member = await self.check(uid)
+        except Exception as e:
+            self.api_errors += 1
+            log.warning("membership: get_chat_member failed: %s", e, extra={"chat_id": uid})
+            return False
+        self._entries[uid] = (member, monotonic() + (self.member_ttl if member else self.nonmember_ttl))
+        return member
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.hint_hits + self.api_calls
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "hint_hits": self.hint_hits,
+            "events": self.events,
+            "api_calls": self.api_calls,
+            "api_errors": self.api_errors,
+            "saved": self.hits + self.hint_hits,
+            "hit_rate": round((self.hits + self.hint_hits) / lookups, 3) if lookups else 0.0,
+        }
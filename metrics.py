@@ -0,0 +1,248 @@
+"""Prometheus text-format metrics without a client library.
+
+Hot-path instrumentation is a dict lookup plus an add: ``Counter.inc`` and
+``Histogram.observe`` (a ``bisect`` over the bucket bounds).  Everything
+that already has a counter somewhere (store, scheduler, outbound queue,
+...) is exported through ``GaugeFunc`` callbacks that only run when
+``/metrics`` is scraped.
+
+With ``RUN_MODE=webhook-multi`` every worker has its own registry; samples
+carry a ``worker`` label set via ``Registry(const_labels=...)``.
+"""
+import asyncio
+import functools
+from bisect import bisect_left
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from aiohttp import web
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Iterable[str], values: Iterable[Any], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labelvalues: Any, amount: float = 1):
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self, const: str) -> Iterable[str]:
+        for values, v in self._values.items():
+            yield f"{self.name}{_labels(self.labels, values, const)} {_num(v)}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # на серию: счётчики по корзинам (+Inf последней), затем сумма
+        self._series: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labelvalues: Any):
+        series = self._series.get(labelvalues)
+        if series is None:
+            series = self._series[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, *labelvalues: Any) -> "_Timer":
+        return _Timer(self, labelvalues)
+
+    def render(self, const: str) -> Iterable[str]:
+        for values, series in self._series.items():
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                total += count
+                le = f'le="{_num(bound)}"'
+                yield f"{self.name}_bucket{_labels(self.labels, values, ','.join(filter(None, (const, le))))} {total}"
+            yield f"{self.name}_sum{_labels(self.labels, values, const)} {_num(series[-1])}"
+            yield f"{self.name}_count{_labels(self.labels, values, const)} {total}"
+
+
+class _Timer:
+    __slots__ = ("hist", "labels", "started")
+
+    def __init__(self, hist: Histogram, labels: tuple):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(perf_counter() - self.started, *self.labels)
+
+
+class GaugeFunc:
+    """Gauge computed at scrape time: ``fn()`` returns a number or ``{labelvalues: number}``."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn: Callable[[], Any], labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labels = labels
+
+    def render(self, const: str) -> Iterable[str]:
+        value = self.fn()
+        if isinstance(value, dict):
+            for values, v in value.items():
+                values = values if isinstance(values, tuple) else (values,)
+                yield f"{self.name}{_labels(self.labels, values, const)} {_num(v)}"
+        elif value is not None:
+            yield f"{self.name}{_labels((), (), const)} {_num(value)}"
+
+
+class CounterFunc(GaugeFunc):
+    """Monotonic counter kept elsewhere (a component's ``stats()``), read at scrape time."""
+
+    kind = "counter"
+
+
+class Registry:
+    def __init__(self, const_labels: Optional[Dict[str, Any]] = None):
+        self._metrics: list = []
+        self.const = ",".join(f'{k}="{_escape(v)}"' for k, v in (const_labels or {}).items())
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, fn: Callable[[], Any], labels: tuple[str, ...] = ()) -> GaugeFunc:
+        return self.register(GaugeFunc(name, help, fn, labels))
+
+    def counter_func(self, name: str, help: str, fn: Callable[[], Any],
+                     labels: tuple[str, ...] = ()) -> CounterFunc:
+        return self.register(CounterFunc(name, help, fn, labels))
+
+    def render(self) -> str:
+        lines = []
+        for m in self._metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            lines.extend(m.render(self.const))
+        return "\n".join(lines) + "\n"
+
+
+def api_result(exc: Optional[BaseException]) -> str:
+    """Short result label for a Bot API call outcome."""
+    if exc is None:
+        return "ok"
+    return {
+        "TelegramRetryAfter": "retry_after",
+        "TelegramForbiddenError": "forbidden",
+        "TelegramBadRequest": "bad_request",
+        "TelegramNotFound": "not_found",
+        "TelegramEntityTooLarge": "too_large",
+        "TelegramNetworkError": "network",
+        "TelegramServerError": "server_error",
+    }.get(type(exc).__name__, "error")
+
+
+class HandlerMetrics:
+    """aiogram inner middleware: calls and latency per handler function."""
+
+    def __init__(self, calls: Counter, duration: Histogram):
+        self.calls = calls
+        self.duration = duration
+
+    async def __call__(self, handler, event, data: Dict[str, Any]):
+        handler_obj = data.get("handler")
+        name = getattr(getattr(handler_obj, "callback", None), "__name__", "unknown")
+        started = perf_counter()
+        try:
+            result = await handler(event, data)
+        except Exception:
+            self.calls.inc(name, "error")
+            raise
+        finally:
+            self.duration.observe(perf_counter() - started, name)
+        self.calls.inc(name, "ok")
+        return result
+
+
+class ApiMetrics:
+    """aiogram session request middleware: every Bot API attempt by method and result."""
+
+    def __init__(self, calls: Counter, duration: Histogram):
+        self.calls = calls
+        self.duration = duration
+
+    async def __call__(self, make_request, bot, method):
+        name = getattr(method, "__api_method__", type(method).__name__)
+        started = perf_counter()
+        try:
+            result = await make_request(bot, method)
+        except Exception as e:
+            self.calls.inc(name, api_result(e))
+            raise
+        finally:
+            self.duration.observe(perf_counter() - started, name)
+        self.calls.inc(name, "ok")
+        return result
+
+
+def count_results(counter: Counter):
+    """Decorator: count the result string an async function returns."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        async def run(*args, **kwargs):
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception:
+                counter.inc("exception")
+                raise
+            counter.inc(result)
+            return result
+        return run
+    return wrap
+
+
+def task_count() -> int:
+    return len(asyncio.all_tasks())
+
+
+def metrics_handler(registry: Registry, token: str = ""):
+    async def handle(request: web.Request) -> web.Response:
+        if token and request.headers.get("Authorization") != f"Bearer {token}":
+            return web.Response(status=401)
+        return web.Response(body=registry.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+    return handle
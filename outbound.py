@@ -0,0 +1,177 @@
+"""Outbound dispatcher for Bot API sends: rate limits, per-chat FIFO, retries.
+
+Installed as an aiogram session middleware, so every ``bot.send_*`` call in
+the code base passes through it without changing call sites:
+
+* a global token bucket (Telegram allows ~30 msg/s per bot);
+* a per-chat token bucket: ~1 msg/s in private chats, 20 msg/min in groups;
+* per-chat FIFO: calls to one chat are sent strictly in arrival order, so
+  ``send_url_only`` followed by ``send_block`` can never swap places;
+* ``TelegramRetryAfter`` pauses the global bucket (and the chat's) for
+  ``retry_after`` seconds, so flood control slows every send, not only the
+  chat that got the 429; network and 5xx errors are retried with
+  exponential backoff and jitter.
+"""
+import asyncio
+import logging
+import random
+from time import monotonic
+from typing import Any, Dict
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+log = logging.getLogger(__name__)
+
+# методы, на которые распространяются лимиты Telegram на отправку
+_SEND_PREFIXES = ("send", "copy", "forward")
+
+
+class TokenBucket:
+    """Reservation-style token bucket: ``reserve()`` returns how long to wait."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        now = monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds: float):
+        """No token before ``seconds`` from now (429 ``retry_after``); repeated pauses don't stack."""
+        now = monotonic()
+        self._refill(now)
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def is_full(self) -> bool:
+        self._refill(monotonic())
+        return self.tokens >= self.capacity
+
+
+class _ChatLane:
+    __slots__ = ("lock", "bucket")
+
+    def __init__(self, bucket: TokenBucket):
+        self.lock = asyncio.Lock()
+        self.bucket = bucket
+
+
+class OutboundDispatcher(BaseRequestMiddleware):
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 group_rate: float = 20 / 60, group_burst: float = 3.0,
+                 max_retries: int = 5, backoff_base: float = 0.5, backoff_max: float = 30.0):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lanes: Dict[Any, _ChatLane] = {}
+        self._sends_since_sweep = 0
+        # метрики
+        self.depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries_retry_after = 0
+        self.retries_network = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _lane(self, chat_id: Any) -> _ChatLane:
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = (TokenBucket(self.group_rate, self.group_burst) if is_group
+                      else TokenBucket(self.chat_rate, self.chat_burst))
+            lane = self._lanes[chat_id] = _ChatLane(bucket)
+        return lane
+
+    def _sweep(self):
+        """Drop idle lanes whose bucket has fully refilled."""
+        self._sends_since_sweep = 0
+        idle = [cid for cid, lane in self._lanes.items() if not lane.lock.locked() and lane.bucket.is_full()]
+        for cid in idle:
+            del self._lanes[cid]
+
+    async def __call__(self, make_request, bot, method):
+        api_method = getattr(method, "__api_method__", "")
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not api_method.startswith(_SEND_PREFIXES):
+            return await make_request(bot, method)
+
+        lane = self._lane(chat_id)
+        self.depth += 1
+        queued_at = monotonic()
+        try:
+            async with lane.lock:
+                attempt = 0
+                while True:
+                    wait = lane.bucket.reserve()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    wait = self.global_bucket.reserve()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    if attempt == 0:
+                        waited = monotonic() - queued_at
+                        self.wait_total += waited
+                        self.wait_max = max(self.wait_max, waited)
+                    try:
+                        result = await make_request(bot, method)
+                        self.sent += 1
+                        return result
+                    except TelegramRetryAfter as e:
+                        if attempt >= self.max_retries:
+                            self.failed += 1
+                            raise
+                        self.retries_retry_after += 1
+                        log.warning("outbound: %s to %s hit flood control, all sends paused for %ss",
+                                    api_method, chat_id, e.retry_after)
+                        # повтор ждёт в reserve() выше вместе со всеми остальными отправками
+                        self.global_bucket.pause(e.retry_after)
+                        lane.bucket.pause(e.retry_after)
+                    except (TelegramNetworkError, TelegramServerError) as e:
+                        if attempt >= self.max_retries:
+                            self.failed += 1
+                            raise
+                        self.retries_network += 1
+                        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+                        delay += random.uniform(0, delay)
+                        log.warning("outbound: %s to %s failed (%s), retry in %.1fs",
+                                    api_method, chat_id, e, delay)
+                        await asyncio.sleep(delay)
+                    except Exception:
+                        self.failed += 1
+                        raise
+                    attempt += 1
+        finally:
+            self.depth -= 1
+            self._sends_since_sweep += 1
+            if self._sends_since_sweep >= 1000:
+                self._sweep()
+
+    def stats(self) -> Dict[str, Any]:
+        done = self.sent + self.failed
+        return {
+            "depth": self.depth,
+            "chats": len(self._lanes),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries_retry_after": self.retries_retry_after,
+            "retries_network": self.retries_network,
+            "wait_avg_ms": round(self.wait_total / done * 1000, 1) if done else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 1),
+        }
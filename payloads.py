@@ -0,0 +1,65 @@
+"""Ready-to-send course posts, rendered once per media-cache version.
+
+Rendering a post means choosing its keyboard, working out the media group
+items and, when every local file already has a cached ``file_id``,
+building the ``InputMedia`` list itself.  The result is a frozen
+``PostPayload``; a send is then a dict lookup plus the API call.
+
+The cache key includes a version (``FileIdCache.version`` and
+``UrlResolver.version``): when an upload records a new file_id or a
+rejected one is dropped, every payload is rendered again on next use.
+
+Albums can't carry an inline keyboard: ``sendMediaGroup`` has no
+``reply_markup`` and ``editMessageReplyMarkup`` on an album message is
+rejected.  For those shapes the keyboard goes into ``follow_up``, sent as
+its own message, and the edit is never attempted.
+"""
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable, Optional
+
+KEYBOARDLESS_SHAPES = frozenset({"media_group"})
+
+
+@dataclass(frozen=True)
+class PostPayload:
+    key: Hashable
+    text: str
+    keyboard: Any = None
+    shape: str = "text"
+    items: tuple = ()  # (kind, local path | None, remote media / params) — для загрузки через FileIdCache
+    media: Optional[tuple] = None  # готовые InputMedia, если загружать ничего не нужно
+    follow_up: Optional[tuple] = None  # (text, keyboard) отдельным сообщением после альбома
+
+
+class PayloadCache:
+    def __init__(self, render: Callable[[Hashable], PostPayload], version: Callable[[], Hashable]):
+        self.render = render
+        self.version = version
+        self._payloads: Dict[Hashable, PostPayload] = {}
+        self._version: Hashable = None
+        self.hits = 0
+        self.renders = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> PostPayload:
+        version = self.version()
+        if version != self._version:
+            if self._payloads:
+                self.invalidations += 1
+            self._payloads = {}
+            self._version = version
+        payload = self._payloads.get(key)
+        if payload is None:
+            payload = self._payloads[key] = self.render(key)
+            self.renders += 1
+        else:
+            self.hits += 1
+        return payload
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._payloads),
+            "hits": self.hits,
+            "renders": self.renders,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,86 @@
+"""Cheap checks on the raw webhook JSON, before ``Update.model_validate``.
+
+Validating an update builds the whole aiogram model tree (message,
+chat, user, entities, reply markup, ...), and before this every POST paid
+for it, including updates no handler wanted.  ``UpdateFilter.check``
+looks at a few dict keys instead and returns why an update should be
+dropped, or None to let it through:
+
+* ``type``    — the update type isn't in ``allowed`` (the router's used
+  types; Telegram may still send others until ``setWebhook`` applies);
+* ``chat``    — the chat is in ``ignored_chats``;
+* ``scope``   — the type is limited to some chats (``only_chats``, e.g.
+  ``chat_member`` only for the diary channel) and this isn't one;
+* ``private`` — a type in ``private_only`` came from a group or channel.
+
+Dropped updates are answered 200 so Telegram doesn't redeliver them.
+"""
+from typing import Any, Dict, Iterable, Mapping, Optional
+
+# где у каждого типа апдейта лежит чат
+_CHAT_PATHS = {
+    "message": ("chat",),
+    "edited_message": ("chat",),
+    "channel_post": ("chat",),
+    "edited_channel_post": ("chat",),
+    "chat_member": ("chat",),
+    "my_chat_member": ("chat",),
+    "chat_join_request": ("chat",),
+    "callback_query": ("message", "chat"),
+}
+
+
+def update_type(data: Mapping[str, Any]) -> Optional[str]:
+    for key in data:
+        if key != "update_id":
+            return key
+    return None
+
+
+def _chat(payload: Any, path: tuple) -> Optional[Mapping[str, Any]]:
+    for key in path:
+        if not isinstance(payload, Mapping):
+            return None
+        payload = payload.get(key)
+    return payload if isinstance(payload, Mapping) else None
+
+
+class UpdateFilter:
+    def __init__(self, allowed: Iterable[str], ignored_chats: Iterable[int] = (),
+                 only_chats: Optional[Mapping[str, Iterable[int]]] = None,
+                 private_only: Iterable[str] = ()):
+        self.allowed = frozenset(allowed)
+        self.ignored_chats = frozenset(ignored_chats)
+        self.only_chats = {kind: frozenset(ids) for kind, ids in (only_chats or {}).items()}
+        self.private_only = frozenset(private_only)
+        self.passed = 0
+        self.dropped: Dict[str, int] = {}
+
+    def check(self, data: Mapping[str, Any]) -> Optional[str]:
+        """Reason to drop ``data`` (a raw update dict), or None."""
+        if not isinstance(data, Mapping):
+            return None  # пусть model_validate скажет, что не так
+        kind = update_type(data)
+        reason = None
+        if kind not in self.allowed:
+            reason = "type"
+        else:
+            path = _CHAT_PATHS.get(kind)
+            chat = _chat(data[kind], path) if path else None
+            if chat is not None:
+                chat_id = chat.get("id")
+                if chat_id in self.ignored_chats:
+                    reason = "chat"
+                elif kind in self.only_chats and chat_id not in self.only_chats[kind]:
+                    reason = "scope"
+                elif kind in self.private_only and chat.get("type") != "private":
+                    reason = "private"
+        if reason is None:
+            self.passed += 1
+        else:
+            self.dropped[reason] = self.dropped.get(reason, 0) + 1
+        return reason
+
+    def stats(self) -> Dict[str, Any]:
+        return {"passed": self.passed, "dropped": dict(self.dropped),
+                "dropped_total": sum(self.dropped.values())}
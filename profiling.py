@@ -0,0 +1,257 @@
+"""Opt-in update profiling and on-demand CPU profiles.
+
+``UpdateProfiler`` is switched on and off at runtime (``/profile on``).
+While it is off none of its middlewares are registered, so the hot path
+pays nothing.  While it is on:
+
+* an outer update middleware records wall time and CPU time per update
+  type and per handler.  CPU time is measured only across the steps of
+  the update's own coroutine, so concurrent updates don't inflate it;
+* a session middleware and ``span()`` (called from the store's observe
+  hook) add Bot API calls and store I/O to the current update's trace;
+* updates slower than ``slow_ms`` keep their trace with that breakdown in
+  a ring buffer.
+
+``profile_cpu`` backs the secret-protected ``/debug/profile`` endpoint:
+a sampling profiler over the event-loop thread that returns collapsed
+stacks (flamegraph.pl / speedscope input), or a cProfile run dumped as
+pstats text.
+"""
+import asyncio
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from pathlib import Path
+from time import perf_counter, thread_time
+from typing import Any, Dict, Optional
+
+_TRACE: ContextVar[Optional["Trace"]] = ContextVar("profiling_trace", default=None)
+
+
+class Trace:
+    __slots__ = ("update_type", "handler", "wall", "cpu", "spans", "started")
+
+    def __init__(self, update_type: str):
+        self.update_type = update_type
+        self.handler = "unhandled"
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.spans: list[tuple[str, float]] = []
+        self.started = time.time()
+
+    def as_dict(self) -> Dict[str, Any]:
+        waited = self.wall - self.cpu - sum(s for _, s in self.spans)
+        return {
+            "at": round(self.started, 3),
+            "update_type": self.update_type,
+            "handler": self.handler,
+            "wall_ms": round(self.wall * 1000, 1),
+            "cpu_ms": round(self.cpu * 1000, 1),
+            "other_wait_ms": round(max(0.0, waited) * 1000, 1),
+            "spans": [(name, round(s * 1000, 1)) for name, s in self.spans],
+        }
+
+
+def span(name: str, seconds: float):
+    """Attach a timed sub-step to the update being profiled (no-op otherwise)."""
+    trace = _TRACE.get()
+    if trace is not None:
+        trace.spans.append((name, seconds))
+
+
+class _CpuTimed:
+    """Await ``coro`` while summing CPU time of its own steps into ``trace.cpu``."""
+
+    __slots__ = ("coro", "trace")
+
+    def __init__(self, coro, trace: Trace):
+        self.coro = coro
+        self.trace = trace
+
+    def __await__(self):
+        coro, trace = self.coro, self.trace
+        value, error = None, None
+        while True:
+            started = thread_time()
+            try:
+                step = coro.throw(error) if error is not None else coro.send(value)
+            except StopIteration as stop:
+                trace.cpu += thread_time() - started
+                return stop.value
+            except BaseException:
+                trace.cpu += thread_time() - started
+                raise
+            trace.cpu += thread_time() - started
+            try:
+                value, error = (yield step), None
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as e:
+                value, error = None, e
+
+
+class _Stat:
+    __slots__ = ("count", "wall", "cpu", "max_wall")
+
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.max_wall = 0.0
+
+    def add(self, trace: Trace):
+        self.count += 1
+        self.wall += trace.wall
+        self.cpu += trace.cpu
+        self.max_wall = max(self.max_wall, trace.wall)
+
+
+class UpdateProfiler:
+    def __init__(self, slow_ms: float = 1000.0, keep: int = 50):
+        self.enabled = False
+        self.slow_ms = slow_ms
+        self.slow: deque[Dict[str, Any]] = deque(maxlen=keep)
+        self.by_handler: Dict[str, _Stat] = {}
+        self.by_type: Dict[str, _Stat] = {}
+        self._update_managers: list = []
+        self._handler_managers: list = []
+        self._session_managers: list = []
+
+    # ----- wiring -----
+    def attach(self, dispatcher=None, observers=(), session=None):
+        """Remember where to plug in; registers right away if already enabled."""
+        if dispatcher is not None:
+            self._update_managers.append(dispatcher.update.outer_middleware)
+        self._handler_managers.extend(o.middleware for o in observers)
+        if session is not None:
+            self._session_managers.append(session.middleware)
+        if self.enabled:
+            self.enabled = False
+            self.enable()
+
+    def _pairs(self):
+        yield from ((m, self) for m in self._update_managers)
+        yield from ((m, self.name_handler) for m in self._handler_managers)
+        yield from ((m, self.api_span) for m in self._session_managers)
+
+    def enable(self, slow_ms: Optional[float] = None):
+        if slow_ms is not None:
+            self.slow_ms = slow_ms
+        if self.enabled:
+            return
+        for manager, mw in self._pairs():
+            manager.register(mw)
+        self.enabled = True
+
+    def disable(self):
+        if not self.enabled:
+            return
+        for manager, mw in self._pairs():
+            manager.unregister(mw)
+        self.enabled = False
+
+    def reset(self):
+        self.slow.clear()
+        self.by_handler.clear()
+        self.by_type.clear()
+
+    # ----- middlewares (registered only while enabled) -----
+    async def __call__(self, handler, event, data: Dict[str, Any]):
+        trace = Trace(getattr(event, "event_type", None) or type(event).__name__)
+        token = _TRACE.set(trace)
+        started = perf_counter()
+        try:
+            return await _CpuTimed(handler(event, data), trace)
+        finally:
+            trace.wall = perf_counter() - started
+            _TRACE.reset(token)
+            self._record(trace)
+
+    async def name_handler(self, handler, event, data: Dict[str, Any]):
+        trace = _TRACE.get()
+        if trace is not None:
+            callback = getattr(data.get("handler"), "callback", None)
+            trace.handler = getattr(callback, "__name__", "unknown")
+        return await handler(event, data)
+
+    async def api_span(self, make_request, bot, method):
+        trace = _TRACE.get()
+        if trace is None:
+            return await make_request(bot, method)
+        started = perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            trace.spans.append((f"api:{getattr(method, '__api_method__', type(method).__name__)}",
+                                perf_counter() - started))
+
+    def _record(self, trace: Trace):
+        self.by_type.setdefault(trace.update_type, _Stat()).add(trace)
+        self.by_handler.setdefault(trace.handler, _Stat()).add(trace)
+        if trace.wall * 1000 >= self.slow_ms:
+            self.slow.append(trace.as_dict())
+
+    # ----- reporting -----
+    def report(self, top: int = 10) -> str:
+        lines = [f"Profiler: {'on' if self.enabled else 'off'}, slow threshold {self.slow_ms:.0f} ms"]
+        for title, table in (("handler", self.by_handler), ("update type", self.by_type)):
+            rows = sorted(table.items(), key=lambda kv: kv[1].wall, reverse=True)[:top]
+            if rows:
+                lines.append(f"by {title}: count, avg wall / avg cpu / max wall (ms)")
+            for name, st in rows:
+                lines.append(f"  {name}: {st.count}, {st.wall / st.count * 1000:.1f} / "
+                             f"{st.cpu / st.count * 1000:.1f} / {st.max_wall * 1000:.1f}")
+        for tr in list(self.slow)[-5:]:
+            spans = ", ".join(f"{n} {ms}" for n, ms in tr["spans"][:8])
+            lines.append(f"slow {tr['handler']} ({tr['update_type']}): wall {tr['wall_ms']} ms, "
+                         f"cpu {tr['cpu_ms']}, other {tr['other_wait_ms']}; {spans}")
+        return "\n".join(lines)
+
+
+# ----- on-demand CPU profiles -----
+def sample_stacks(thread_id: int, seconds: float, interval: float = 0.005) -> Counter:
+    """Sample the stack of ``thread_id`` every ``interval`` s (run in another thread)."""
+    stacks: Counter[str] = Counter()
+    deadline = perf_counter() + seconds
+    while perf_counter() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{Path(code.co_filename).name}:{code.co_name}")
+            frame = frame.f_back
+        if names:
+            stacks[";".join(reversed(names))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def collapsed(stacks: Counter) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def pstats_text(profile: cProfile.Profile, limit: int = 60) -> str:
+    out = io.StringIO()
+    pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(limit)
+    return out.getvalue()
+
+
+async def profile_cpu(seconds: float, fmt: str = "collapsed") -> str:
+    """Profile the event-loop thread for ``seconds``: collapsed stacks or pstats text."""
+    if fmt == "pstats":
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+        return pstats_text(profile)
+    loop = asyncio.get_running_loop()
+    stacks = await loop.run_in_executor(None, sample_stacks, threading.get_ident(), seconds)
+    return collapsed(stacks)
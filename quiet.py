@@ -0,0 +1,145 @@
+"""Quiet-period gate: when did the bot last write to each chat.
+
+Replaces the bare ``LAST_BOT_MESSAGE_TS`` dict.  Nobody polls it: the drip
+job for a chat sits in the scheduler heap with its due time set to the
+quiet deadline, and ``mark()`` notifies listeners so that job is moved
+forward whenever the bot writes to the chat again.
+
+Timestamps are flushed to disk in the background (only entries younger
+than ``max_window`` matter), so quiet windows survive a restart.  The map
+is kept in mark order (a re-marked chat moves to the end), so pruning
+only walks the expired head, and the snapshot is copied and serialized
+in the writer thread — nothing on the event loop grows with the number of
+active chats.  With several processes (``shared`` is a
+``coordination.Coordinator``) marks go to the shared SQLite file instead
+and ``refresh()`` pulls marks made by other workers before a drip step
+decides whether the chat is quiet.
+"""
+import asyncio
+import json
+import logging
+from pathlib import Path
+from time import monotonic, time
+from typing import Any, Callable, Dict
+
+from store import atomic_write_text
+
+log = logging.getLogger(__name__)
+
+
+class QuietGate:
+    def __init__(self, path: Path, max_window: float, flush_interval: float = 5.0, shared=None):
+        self.path = Path(path)
+        self.shared = shared
+        self.max_window = max_window
+        self.flush_interval = flush_interval
+        self._last: Dict[int, float] = {}
+        self._dirty = False
+        self._listeners: list[Callable[[int, float], None]] = []
+        self._task: asyncio.Task | None = None
+        self._started = monotonic()
+        self.marks = 0
+        self.wakeups = 0
+        self.deferred = 0
+        try:
+            now = time()
+            raw = json.loads(self.path.read_text(encoding="utf-8"))
+            fresh = sorted((v, int(k)) for k, v in raw.items() if now - v < max_window)
+            self._last = {cid: ts for ts, cid in fresh}
+        except FileNotFoundError:
+            pass
+        except Exception:
+            log.exception("quiet gate: failed to read %s, starting empty", self.path)
+
+    def on_mark(self, listener: Callable[[int, float], None]):
+        """``listener(chat_id, ts)`` is called after every ``mark()``."""
+        self._listeners.append(listener)
+
+    def mark(self, chat_id: int):
+        ts = time()
+        self._last.pop(chat_id, None)  # в конец: порядок словаря = порядок меток
+        self._last[chat_id] = ts
+        self._dirty = True
+        self.marks += 1
+        if self.shared is not None:
+            self.shared.mark_quiet(chat_id, ts)
+        for listener in self._listeners:
+            listener(chat_id, ts)
+
+    def last(self, chat_id: int) -> float:
+        return self._last.get(chat_id, 0)
+
+    def deadline(self, chat_id: int, delay: float) -> float:
+        return self._last.get(chat_id, 0) + delay
+
+    def remaining(self, chat_id: int, delay: float) -> float:
+        return self.deadline(chat_id, delay) - time()
+
+    async def refresh(self, chat_id: int):
+        """Pick up a newer mark made by another process (no-op in single-process mode)."""
+        if self.shared is None:
+            return
+        ts = await self.shared.quiet_last(chat_id)
+        if ts > self._last.get(chat_id, 0):
+            self._last.pop(chat_id, None)
+            self._last[chat_id] = ts
+
+    def note_wakeup(self, deferred: bool):
+        """Called by a waiter when it fires; ``deferred`` if it was still too early."""
+        self.wakeups += 1
+        if deferred:
+            self.deferred += 1
+
+    # ----- persistence -----
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("quiet gate: flush failed")
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        cutoff = time() - self.max_window
+        stale = []
+        for cid, ts in self._last.items():  # самые старые — в начале
+            if ts >= cutoff:
+                break
+            stale.append(cid)
+        for cid in stale:
+            del self._last[cid]
+        if self.shared is not None:
+            return  # метки уже лежат в общей базе
+        await asyncio.to_thread(self._write, self._last)
+
+    def _write(self, last: Dict[int, float]):
+        # list(items()) копируется целиком под GIL — цикл событий не успеет поменять словарь посередине
+        data = json.dumps({str(k): round(v, 3) for k, v in list(last.items())}, separators=(",", ":"))
+        atomic_write_text(self.path, data)
+
+    def stats(self) -> Dict[str, Any]:
+        uptime = max(1e-9, monotonic() - self._started)
+        return {
+            "chats": len(self._last),
+            "marks": self.marks,
+            "wakeups": self.wakeups,
+            "deferred": self.deferred,
+            "wakeups_per_min": round(self.wakeups / uptime * 60, 2),
+        }
@@ -0,0 +1,179 @@
+"""Compact in-memory user records.
+
+A user in stats.json is ``"1378979725": {"stage": 3, "ts": ..., "pm_ok":
+true, "watched": {"1": true}}``.  Held as-is that is a str key, a dict
+and often a nested ``watched`` dict: several hundred bytes for a few
+small ints and booleans.  ``UserRecord`` keeps the same data in a
+``__slots__`` object keyed by ``int``:
+
+* ints (``stage``, ``ts``, ``diary_ts``, ``joined``, ``max_stage``,
+  ``blocked_ts``) each get a slot;
+* the booleans ``pm_ok``, ``first_rotation_done``, ``loop_stopped``,
+  ``diary_request`` and ``watched["1".."3"]`` are packed into one int,
+  a "present" bit and a "value" bit each, so ``False`` and "never set"
+  stay distinct and the JSON round-trips exactly;
+* anything else (or a value of an unexpected type) goes to ``extra``.
+
+Records are immutable like the dicts they replace: ``replace()`` returns
+a new record, so flushes in a worker thread can keep references.  They
+read like the old dicts (``get``, ``[]``, ``in``, ``keys``, ``dict(rec)``),
+so callers don't change.
+"""
+from functools import partial
+from typing import Any, Dict, Iterator, Optional
+
+INT_FIELDS = ("stage", "ts", "diary_ts", "joined", "max_stage", "blocked_ts")
+FLAG_FIELDS = ("pm_ok", "first_rotation_done", "loop_stopped", "diary_request")
+WATCHED_KEYS = ("1", "2", "3")
+
+_INT_SET = frozenset(INT_FIELDS)
+_FLAG_BIT = {name: 1 << i for i, name in enumerate(FLAG_FIELDS)}
+_WATCHED_BIT = {key: 1 << (len(FLAG_FIELDS) + i) for i, key in enumerate(WATCHED_KEYS)}
+_NBITS = len(FLAG_FIELDS) + len(WATCHED_KEYS)
+_WATCHED_MASK = sum(_WATCHED_BIT.values())
+_WATCHED_MASKS = _WATCHED_MASK | _WATCHED_MASK << _NBITS
+# одни и те же объекты int для всех записей: значения флагов больше 256 не кешируются самим Python
+_FLAG_INTS = tuple(range(1 << 2 * _NBITS))
+_KIND = {**dict.fromkeys(INT_FIELDS, 0), **dict.fromkeys(FLAG_FIELDS, 1), "watched": 2}
+_MISSING = object()
+
+
+def _packable_watched(value: Any) -> bool:
+    return (isinstance(value, dict) and bool(value)
+            and all(k in _WATCHED_BIT and type(v) is bool for k, v in value.items()))
+
+
+class UserRecord:
+    __slots__ = INT_FIELDS + ("flags", "extra")
+
+    def __init__(self):
+        self.stage = self.ts = self.diary_ts = None
+        self.joined = self.max_stage = self.blocked_ts = None
+        self.flags = 0
+        self.extra: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "UserRecord":
+        return _EMPTY._merged(data)
+
+    def replace(self, **fields: Any) -> "UserRecord":
+        return self._merged(fields)
+
+    def _merged(self, fields: Dict[str, Any]) -> "UserRecord":
+        new = _new_record()
+        new.stage, new.ts, new.diary_ts = self.stage, self.ts, self.diary_ts
+        new.joined, new.max_stage, new.blocked_ts = self.joined, self.max_stage, self.blocked_ts
+        flags, extra = self.flags, self.extra
+        copied = False
+        for name, value in fields.items():
+            kind = _KIND.get(name)
+            if kind is None:
+                pass
+            elif kind == 0:
+                if type(value) is int:
+                    setattr(new, name, value)
+                    if extra is not None and name in extra:
+                        extra, copied = {k: v for k, v in extra.items() if k != name}, True
+                    continue
+                setattr(new, name, None)
+            elif kind == 1:
+                if type(value) is bool:
+                    bit = _FLAG_BIT[name]
+                    flags = (flags | bit | bit << _NBITS) if value else (flags | bit) & ~(bit << _NBITS)
+                    if extra is not None and name in extra:
+                        extra, copied = {k: v for k, v in extra.items() if k != name}, True
+                    continue
+                flags &= ~(_FLAG_BIT[name] | _FLAG_BIT[name] << _NBITS)
+            else:
+                flags &= ~_WATCHED_MASKS
+                if _packable_watched(value):
+                    for key, seen in value.items():
+                        bit = _WATCHED_BIT[key]
+                        flags |= bit | (bit << _NBITS if seen else 0)
+                    if extra is not None and name in extra:
+                        extra, copied = {k: v for k, v in extra.items() if k != name}, True
+                    continue
+            # не влезло в слоты — в extra (упакованное значение с тем же именем уже сброшено)
+            if not copied:
+                extra, copied = dict(extra or {}), True
+            extra[name] = value
+        new.flags = _FLAG_INTS[flags]
+        new.extra = extra or None
+        return new
+
+    # ----- dict-like reads -----
+    def get(self, name: str, default: Any = None) -> Any:
+        if name in _INT_SET:
+            value = getattr(self, name)
+            if value is not None:
+                return value
+        elif name in _FLAG_BIT:
+            bit = _FLAG_BIT[name]
+            if self.flags & bit:
+                return bool(self.flags & bit << _NBITS)
+        elif name == "watched" and self.flags & _WATCHED_MASK:
+            return {key: bool(self.flags & bit << _NBITS)
+                    for key, bit in _WATCHED_BIT.items() if self.flags & bit}
+        if self.extra is None:
+            return default
+        return self.extra.get(name, default)
+
+    def __getitem__(self, name: str) -> Any:
+        value = self.get(name, _MISSING)
+        if value is _MISSING:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name: str) -> bool:
+        return self.get(name, _MISSING) is not _MISSING
+
+    def keys(self) -> list:
+        return list(self.to_dict())
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def items(self) -> list:
+        return list(self.to_dict().items())
+
+    def to_dict(self) -> Dict[str, Any]:
+        out = {}
+        for name in INT_FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                out[name] = value
+        flags = self.flags
+        if flags:
+            for name, bit in _FLAG_BIT.items():
+                if flags & bit:
+                    out[name] = bool(flags & bit << _NBITS)
+            if flags & _WATCHED_MASK:
+                out["watched"] = {key: bool(flags & bit << _NBITS)
+                                  for key, bit in _WATCHED_BIT.items() if flags & bit}
+        if self.extra:
+            out.update(self.extra)
+        return out
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, (UserRecord, dict)):
+            return self.to_dict() == (other.to_dict() if isinstance(other, UserRecord) else other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"UserRecord({self.to_dict()!r})"
+
+
+_new_record = partial(object.__new__, UserRecord)  # без __init__: replace() заполняет все слоты сам
+_EMPTY = UserRecord()
+
+
+def records_from_json(users: Dict[str, Dict[str, Any]]) -> Dict[int, UserRecord]:
+    """The ``users`` object of stats.json -> ``{uid: UserRecord}``."""
+    return {int(key): UserRecord.from_dict(rec) for key, rec in users.items()}
+
+
+def records_to_json(records: Dict[int, UserRecord]) -> Dict[str, Dict[str, Any]]:
+    """Inverse of ``records_from_json``."""
+    return {str(uid): rec.to_dict() for uid, rec in records.items()}
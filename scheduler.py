@@ -0,0 +1,381 @@
+"""Durable timer scheduler: one heap, one dispatcher, a bounded worker pool.
+
+Instead of parking an ``asyncio.sleep`` coroutine per user, callers
+``schedule()`` a named job with a JSON payload and a due time.  Jobs are
+kept in a heap in memory and mirrored to a SQLite table, so pending
+reminders survive a redeploy.  A single dispatcher sleeps until the
+earliest due time and hands due jobs to ``workers`` worker tasks.
+
+A job that was running when the process died is fired again after restart
+(at-least-once), so handlers must tolerate a repeat run.
+
+Shared mode (``shared=True``, used by ``RUN_MODE=webhook-multi``): every
+worker process opens the same database, but only the leader calls
+``start()`` and keeps the heap.  Followers write jobs straight to SQLite
+and the leader ingests new rows in ``seq`` order every ``poll_interval``
+seconds; a job cancelled by a follower is skipped because its row is gone
+by the time it fires.  Job ids are striped by ``id_offset``/``id_stride``
+so processes never hand out the same id.
+"""
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import random
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from time import time
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional
+
+log = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id INTEGER NOT NULL UNIQUE,
+    key TEXT UNIQUE,
+    kind TEXT NOT NULL,
+    due REAL NOT NULL,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs(due);
+CREATE INDEX IF NOT EXISTS jobs_kind ON jobs(kind);
+"""
+
+# таблица до появления seq: переносим строки в новую схему
+_MIGRATE_V1 = """
+ALTER TABLE jobs RENAME TO jobs_v1;
+DROP INDEX IF EXISTS jobs_due;
+""" + _SCHEMA + """
+INSERT INTO jobs (id, key, kind, due, payload) SELECT id, key, kind, due, payload FROM jobs_v1 ORDER BY id;
+DROP TABLE jobs_v1;
+"""
+
+
+@dataclass
+class Job:
+    id: int
+    kind: str
+    due: float
+    payload: Dict[str, Any]
+    key: Optional[str] = None
+
+
+class Scheduler:
+    def __init__(self, path: Path, workers: int = 16, catchup_spread: float = 300.0,
+                 shared: bool = False, id_offset: int = 0, id_stride: int = 1,
+                 poll_interval: float = 1.0):
+        self.path = Path(path)
+        self.workers = workers
+        self.catchup_spread = catchup_spread
+        self.shared = shared
+        self.id_offset = id_offset
+        self.id_stride = id_stride
+        self.poll_interval = poll_interval
+        self.created = not self.path.exists()
+        self._handlers: Dict[str, Callable[..., Awaitable[Any]]] = {}
+        self._jobs: Dict[int, Job] = {}
+        self._by_key: Dict[str, int] = {}
+        self._running_keys: set[str] = set()
+        self._running_ids: set[int] = set()
+        self._kind_counts: Dict[str, int] = {}
+        self._heap: list[tuple[float, int]] = []
+        self._ids: Iterator[int] | None = None
+        self._seq = 0  # последняя строка, которую видел лидер
+        self._wakeup = asyncio.Event()
+        self._queue: asyncio.Queue[Job] | None = None
+        self._tasks: list[asyncio.Task] = []
+        # все записи в SQLite идут по порядку через один поток
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="scheduler-db")
+        self._conn: sqlite3.Connection | None = None
+        self._restored = False
+        self.ingested = 0
+        self.fired = 0
+        self.failed = 0
+
+    # ----- persistence (scheduler-db thread only) -----
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if columns and "seq" not in columns:
+                conn.executescript(_MIGRATE_V1)
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _db_put(self, job: Job):
+        with self._db() as conn:
+            if job.key is not None:
+                conn.execute("DELETE FROM jobs WHERE key = ? AND id != ?", (job.key, job.id))
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, key, kind, due, payload) VALUES (?,?,?,?,?)",
+                (job.id, job.key, job.kind, job.due, json.dumps(job.payload, ensure_ascii=False)),
+            )
+
+    def _db_delete(self, job_id: int):
+        with self._db() as conn:
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def _db_delete_key(self, key: str):
+        with self._db() as conn:
+            conn.execute("DELETE FROM jobs WHERE key = ?", (key,))
+
+    def _db_since(self, seq: int) -> list[tuple[int, Job]]:
+        rows = self._db().execute(
+            "SELECT seq, id, key, kind, due, payload FROM jobs WHERE seq > ? ORDER BY seq", (seq,)).fetchall()
+        return [(r[0], Job(id=r[1], key=r[2], kind=r[3], due=r[4], payload=json.loads(r[5]))) for r in rows]
+
+    def _db_max_id(self) -> int:
+        return self._db().execute("SELECT coalesce(max(id), 0) FROM jobs").fetchone()[0]
+
+    def _db_has(self, key: str) -> bool:
+        return self._db().execute("SELECT 1 FROM jobs WHERE key = ?", (key,)).fetchone() is not None
+
+    def _db_exists(self, job_id: int) -> bool:
+        return self._db().execute("SELECT 1 FROM jobs WHERE id = ?", (job_id,)).fetchone() is not None
+
+    def _db_count(self, kind: str) -> int:
+        return self._db().execute("SELECT count(*) FROM jobs WHERE kind = ?", (kind,)).fetchone()[0]
+
+    @property
+    def _local(self) -> bool:
+        """Jobs are tracked in memory: single-process mode, or the shared-mode leader."""
+        return not self.shared or bool(self._tasks)
+
+    def load_ids(self):
+        """Blocking: pick the id counter up from the database.  Call it off the event loop
+        (the startup thread); otherwise the first ``schedule()`` does it."""
+        if self._ids is None:
+            top = self._executor.submit(self._db_max_id).result()
+            base = (top // self.id_stride + 1) * self.id_stride
+            self._ids = itertools.count(base + self.id_offset, self.id_stride)
+
+    def _next_id(self) -> int:
+        self.load_ids()
+        return next(self._ids)
+
+    async def _query(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    # ----- public API -----
+    def register(self, kind: str, handler: Callable[..., Awaitable[Any]]):
+        """Handler is called as ``await handler(**payload)``."""
+        self._handlers[kind] = handler
+
+    def schedule(self, kind: str, payload: Dict[str, Any], delay: float = 0,
+                 key: Optional[str] = None, at: Optional[float] = None) -> int:
+        """Schedule ``kind`` to run after ``delay`` seconds (or at ``at``).
+
+        A job with the same ``key`` replaces the pending one.
+        """
+        job = Job(id=self._next_id(), kind=kind, due=at if at is not None else time() + delay,
+                  payload=payload, key=key)
+        if self._local:
+            self._restore()
+            if key is not None:
+                self._drop_key(key)
+            self._push(job)
+        self._executor.submit(self._db_put, job)
+        return job.id
+
+    def cancel(self, key: str) -> bool:
+        if not self._local:
+            self._executor.submit(self._db_delete_key, key)
+            return True
+        job_id = self._drop_key(key)
+        if job_id is None:
+            return False
+        self._executor.submit(self._db_delete, job_id)
+        return True
+
+    async def has(self, key: str) -> bool:
+        """True if a job with ``key`` is pending or running right now."""
+        if not self._local:
+            # фолловер: спрашиваем базу в её потоке, не блокируя event loop, пока лидер пишет
+            return await self._query(self._db_has, key)
+        return key in self._by_key or key in self._running_keys
+
+    def due_of(self, key: str) -> Optional[float]:
+        job_id = self._by_key.get(key)
+        return self._jobs[job_id].due if job_id is not None else None
+
+    def reschedule(self, key: str, at: float) -> bool:
+        """Move a pending job to a new due time (no-op if it is not pending)."""
+        job_id = self._by_key.get(key)
+        if job_id is None:
+            return False
+        job = self._jobs[job_id]
+        if job.due == at:
+            return True
+        job.due = at  # старая запись в куче станет «мёртвой»
+        self._push_heap(job)
+        self._executor.submit(self._db_put, job)
+        return True
+
+    async def count(self, kind: str) -> int:
+        """Number of pending jobs of ``kind``."""
+        if not self._local:
+            return await self._query(self._db_count, kind)
+        return self._kind_counts.get(kind, 0)
+
+    def _drop_key(self, key: str) -> Optional[int]:
+        job_id = self._by_key.pop(key, None)
+        if job_id is not None:
+            self._forget(job_id)  # запись в куче станет «мёртвой» и будет пропущена
+        return job_id
+
+    def _forget(self, job_id: int):
+        job = self._jobs.pop(job_id, None)
+        if job is not None:
+            self._kind_counts[job.kind] -= 1
+
+    def _push(self, job: Job):
+        self._jobs[job.id] = job
+        self._kind_counts[job.kind] = self._kind_counts.get(job.kind, 0) + 1
+        if job.key is not None:
+            self._by_key[job.key] = job.id
+        self._push_heap(job)
+
+    def _push_heap(self, job: Job):
+        if len(self._heap) > 2 * len(self._jobs) + 1024:
+            # выкидываем записи отменённых/перенесённых задач
+            self._heap = [(j.due, j.id) for j in self._jobs.values()]
+            heapq.heapify(self._heap)
+        was_first = not self._heap or job.due < self._heap[0][0]
+        heapq.heappush(self._heap, (job.due, job.id))
+        if was_first:
+            self._wakeup.set()
+
+    # ----- lifecycle -----
+    def _restore(self):
+        if self._restored:
+            return
+        self._restored = True
+        rows = self._executor.submit(self._db_since, 0).result()
+        jobs = [job for _, job in rows]
+        self._seq = max((seq for seq, _ in rows), default=0)
+        now = time()
+        overdue = 0
+        for job in jobs:
+            if job.due <= now:
+                # не стреляем всем скопом после рестарта — размазываем с джиттером
+                job.due = now + random.uniform(0, self.catchup_spread)
+                overdue += 1
+            self._push(job)
+        log.info("scheduler: restored %d pending jobs (%d overdue, spread over %.0fs)",
+                 len(jobs), overdue, self.catchup_spread)
+
+    def start(self):
+        if self._tasks:
+            return
+        self._restore()
+        self._queue = asyncio.Queue(maxsize=self.workers * 4)
+        self._tasks.append(asyncio.create_task(self._dispatch()))
+        if self.shared:
+            self._tasks.append(asyncio.create_task(self._ingest_loop()))
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        await asyncio.get_running_loop().run_in_executor(self._executor, _close)
+
+    async def _ingest_loop(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self._ingest()
+            except Exception:
+                log.exception("scheduler: ingest failed")
+
+    async def _ingest(self):
+        """Leader only: pick up jobs other processes added or moved since the last poll."""
+        loop = asyncio.get_running_loop()
+        rows = await loop.run_in_executor(self._executor, self._db_since, self._seq)
+        for seq, job in rows:
+            self._seq = seq
+            if job.id in self._running_ids:
+                continue
+            known = self._jobs.get(job.id)
+            if known is not None:
+                if known.due != job.due:
+                    known.due = job.due
+                    self._push_heap(known)
+                continue
+            if job.key is not None:
+                self._drop_key(job.key)
+            self._push(job)
+            self.ingested += 1
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            due, job_id = self._heap[0]
+            delay = due - time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            job = self._jobs.get(job_id)
+            if job is None or job.due != due:
+                continue
+            self._forget(job_id)
+            if job.key is not None:
+                del self._by_key[job.key]
+                self._running_keys.add(job.key)
+            self._running_ids.add(job.id)
+            await self._queue.put(job)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                handler = self._handlers.get(job.kind)
+                if self.shared and not await asyncio.get_running_loop().run_in_executor(
+                        self._executor, self._db_exists, job.id):
+                    pass  # другой процесс отменил или заменил задачу
+                elif handler is None:
+                    log.error("scheduler: no handler for job kind %r", job.kind)
+                else:
+                    await handler(**job.payload)
+                    self.fired += 1
+            except Exception:
+                self.failed += 1
+                log.exception("scheduler: job %s %s failed", job.kind, job.payload)
+            finally:
+                if job.key is not None:
+                    self._running_keys.discard(job.key)
+                self._running_ids.discard(job.id)
+                self._executor.submit(self._db_delete, job.id)
+                self._queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._jobs),
+            "running": len(self._running_keys),
+            "heap": len(self._heap),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "ingested": self.ingested,
+            "fired": self.fired,
+            "failed": self.failed,
+        }
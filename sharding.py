@@ -0,0 +1,104 @@
+"""Per-user ordered execution of updates and user-scoped background jobs.
+
+``ShardedExecutor.run(key, fn, ...)`` runs ``fn`` under a FIFO lane for
+``key`` (the Telegram user id): work for one user runs strictly in arrival
+order, work for different users runs concurrently.  Lanes are spread over
+``shards`` buckets only for bookkeeping and backlog metrics; a lane exists
+only while it has work, so memory is bounded by active users.
+
+``UserOrderMiddleware`` plugs the executor into an aiogram ``Dispatcher``
+as an outer update middleware, so polling and webhook modes share it.
+
+With several processes (``RUN_MODE=webhook-multi``) the lane only orders
+work inside one process; ``around(key)`` — an async context manager
+entered while holding the lane — extends it across processes.
+"""
+import asyncio
+from typing import Any, AsyncContextManager, Awaitable, Callable, Dict, Optional
+
+
+class _Lane:
+    __slots__ = ("lock", "pending")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()  # asyncio.Lock будит ожидающих строго по очереди
+        self.pending = 0
+
+
+class ShardedExecutor:
+    def __init__(self, shards: int = 64, max_concurrency: Optional[int] = None,
+                 around: Optional[Callable[[Any], AsyncContextManager]] = None):
+        self.shards = shards
+        self.around = around
+        self._lanes: list[Dict[Any, _Lane]] = [{} for _ in range(shards)]
+        self._backlog = [0] * shards
+        self._max_backlog = [0] * shards
+        self._sem = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        self.processed = 0
+        self.failed = 0
+
+    def _shard(self, key: Any) -> int:
+        return hash(key) % self.shards
+
+    async def run(self, key: Any, fn: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        if key is None:
+            return await fn(*args, **kwargs)
+        shard = self._shard(key)
+        lanes = self._lanes[shard]
+        lane = lanes.get(key)
+        if lane is None:
+            lane = lanes[key] = _Lane()
+        lane.pending += 1
+        self._backlog[shard] += 1
+        self._max_backlog[shard] = max(self._max_backlog[shard], self._backlog[shard])
+        acquired = False
+        try:
+            async with lane.lock:
+                acquired = True
+                self._backlog[shard] -= 1
+                if self.around is None:
+                    return await self._call(fn, *args, **kwargs)
+                async with self.around(key):
+                    return await self._call(fn, *args, **kwargs)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            if not acquired:
+                self._backlog[shard] -= 1  # отменили в очереди (закрытие очереди, шатдаун, STARTUP)
+            self.processed += 1
+            lane.pending -= 1
+            if lane.pending == 0:
+                del lanes[key]
+
+    async def _call(self, fn, *args, **kwargs):
+        if self._sem is None:
+            return await fn(*args, **kwargs)
+        async with self._sem:
+            return await fn(*args, **kwargs)
+
+    def backlog(self) -> list[int]:
+        """Updates waiting behind an earlier update of the same user, per shard."""
+        return list(self._backlog)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "shards": self.shards,
+            "active_users": sum(len(lanes) for lanes in self._lanes),
+            "backlog": sum(self._backlog),
+            "busiest_shard_backlog": max(self._backlog),
+            "max_shard_backlog": max(self._max_backlog),
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+
+
+class UserOrderMiddleware:
+    """aiogram outer update middleware: route each update through the executor."""
+
+    def __init__(self, executor: ShardedExecutor):
+        self.executor = executor
+
+    async def __call__(self, handler, event, data: Dict[str, Any]):
+        user = data.get("event_from_user")
+        return await self.executor.run(user.id if user else None, handler, event, data)
@@ -0,0 +1,109 @@
+"""Cold start: answer Telegram early, keep the updates that queued up meanwhile.
+
+On a sleeping free-tier instance the first request wakes the process, and
+everything Telegram collected while it slept is waiting.  The startup path
+in bot.py binds the port before any slow work, loads the store in a
+thread, and only then lets updates through.  ``StartupGate`` is the
+piece in the middle, an outer update middleware (polling and webhook
+alike):
+
+* until ``open()`` every update waits (the store isn't loaded yet) —
+  Telegram keeps the request open instead of getting a refused
+  connection;
+* the first ``expect(n)`` updates after that — the backlog reported by
+  ``getWebhookInfo.pending_update_count`` — go through a token bucket at
+  ``rate`` per second, so a night's worth of taps doesn't hit the API
+  limits and the drip jobs all at once.  ``expect()`` must come before
+  ``open()``: the backlog is what Telegram delivers first, so counting
+  it after the gate opened would pace live updates instead;
+* ``mark(phase)`` records milestones as seconds since the process
+  started (from ``/proc`` where available, so interpreter and import time
+  count too); the first handled update is ``first_response``.
+"""
+import asyncio
+import logging
+import os
+from time import monotonic
+from typing import Any, Dict
+
+from outbound import TokenBucket
+
+log = logging.getLogger(__name__)
+
+
+def process_age() -> float:
+    """Seconds since this process was started (0 where /proc isn't available)."""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rpartition(")")[2].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+class StartupGate:
+    def __init__(self, rate: float = 20.0, burst: float = 20.0):
+        self.bucket = TokenBucket(rate, burst)
+        self._origin = monotonic() - process_age()
+        self._open = asyncio.Event()
+        self.milestones: Dict[str, float] = {}
+        self.backlog = 0
+        self.expected = 0
+        self.held = 0
+        self.paced = 0
+        self.paced_wait = 0.0
+
+    def mark(self, phase: str) -> float:
+        """Record ``phase`` once; returns seconds since process start."""
+        if phase not in self.milestones:
+            self.milestones[phase] = monotonic() - self._origin
+            log.info("startup: %s after %.0f ms", phase, self.milestones[phase] * 1000,
+                     extra={"phase": phase, "ms": round(self.milestones[phase] * 1000)})
+        return self.milestones[phase]
+
+    def expect(self, pending: int):
+        """Telegram holds ``pending`` updates for us: pace that many."""
+        self.expected += pending
+        self.backlog += pending
+        if pending:
+            log.info("startup: %d pending updates, draining at %.0f/s", pending, self.bucket.rate)
+
+    def open(self):
+        self.mark("ready")
+        self._open.set()
+
+    @property
+    def is_open(self) -> bool:
+        return self._open.is_set()
+
+    async def __call__(self, handler, event, data: Dict[str, Any]):
+        if not self._open.is_set():
+            self.held += 1
+            await self._open.wait()
+        if self.backlog > 0:
+            self.backlog -= 1
+            self.paced += 1
+            last = not self.backlog
+            wait = self.bucket.reserve()
+            if wait > 0:
+                self.paced_wait += wait
+                await asyncio.sleep(wait)
+            if last:
+                self.mark("backlog_drained")
+        try:
+            return await handler(event, data)
+        finally:
+            if "first_response" not in self.milestones:
+                self.mark("first_response")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "milestones_ms": {k: round(v * 1000) for k, v in self.milestones.items()},
+            "held": self.held,
+            "expected": self.expected,
+            "backlog": self.backlog,
+            "paced": self.paced,
+            "paced_wait_s": round(self.paced_wait, 1),
+        }
@@ -0,0 +1,423 @@
+"""In-memory user progress store with write-behind persistence.
+
+The whole state is loaded once at startup and every read is served from
+memory.  Setters only mark records dirty; a background task flushes dirty
+records to the backend in batches, off the event loop.
+
+Records are ``records.UserRecord`` keyed by int uid, and copy-on-write:
+``update_user`` always replaces the record instead of mutating it, so a
+backend running in a worker thread can safely hold references to records
+handed over by a flush.  On disk the schema is unchanged.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Callable, Dict, Optional
+
+from records import UserRecord, records_from_json, records_to_json
+
+log = logging.getLogger(__name__)
+
+_USERS_KEY = "users"
+
+
+class JsonBackend:
+    """stats.json persistence: full-document atomic rewrite per flush.
+
+    The backend keeps its own mirror of the users mapping (sharing the
+    immutable records with the store), so the flush thread never
+    iterates a dict the event loop is mutating.
+    """
+
+    name = "json"
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._users: Dict[int, UserRecord] = {}
+        self._sections: Dict[str, Any] = {}
+
+    def load(self) -> tuple[Dict[int, UserRecord], Dict[str, Any]]:
+        try:
+            doc = json.loads(self.path.read_text(encoding="utf-8") or "{}")
+        except FileNotFoundError:
+            doc = {}
+        except Exception:
+            log.exception("Failed to parse %s, starting with empty store", self.path)
+            doc = {}
+        users = records_from_json(doc.pop(_USERS_KEY, {}) or {})
+        self._users = dict(users)
+        self._sections = dict(doc)
+        return users, doc
+
+    def write(self, dirty: Dict[int, Optional[UserRecord]], sections: Dict[str, Any]):
+        for key, rec in dirty.items():
+            if rec is None:
+                self._users.pop(key, None)
+            else:
+                self._users[key] = rec
+        self._sections.update(sections)
+        doc = dict(self._sections)
+        doc[_USERS_KEY] = records_to_json(self._users)
+        atomic_write_text(self.path, json.dumps(doc, ensure_ascii=False, separators=(",", ":")))
+
+    def close(self):
+        pass
+
+
+def atomic_write_text(path: Path, text: str):
+    """Write ``text`` to a temp file next to ``path``, fsync it and rename over."""
+    atomic_write_bytes(path, text.encode("utf-8"))
+
+
+def atomic_write_bytes(path: Path, data: bytes):
+    """Binary counterpart of ``atomic_write_text``."""
+    path = Path(path)
+    fd, tmp = tempfile.mkstemp(prefix=path.name + ".", suffix=".tmp", dir=str(path.parent))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+# колонки users в SQLite; всё остальное из записи уходит в extra (JSON)
+_BOOL_COLUMNS = ("pm_ok", "first_rotation_done", "loop_stopped", "diary_request")
+_INT_COLUMNS = ("stage", "ts", "diary_ts")
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    uid INTEGER PRIMARY KEY,
+    stage INTEGER NOT NULL DEFAULT 0,
+    ts INTEGER,
+    pm_ok INTEGER,
+    first_rotation_done INTEGER,
+    loop_stopped INTEGER,
+    diary_request INTEGER,
+    diary_ts INTEGER,
+    watched TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS users_stage ON users(stage);
+CREATE INDEX IF NOT EXISTS users_ts ON users(ts);
+CREATE TABLE IF NOT EXISTS sections (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+_UPSERT_USER = (
+    "INSERT INTO users (uid, stage, ts, pm_ok, first_rotation_done, loop_stopped,"
+    " diary_request, diary_ts, watched, extra) VALUES (?,?,?,?,?,?,?,?,?,?)"
+    " ON CONFLICT(uid) DO UPDATE SET stage=excluded.stage, ts=excluded.ts,"
+    " pm_ok=excluded.pm_ok, first_rotation_done=excluded.first_rotation_done,"
+    " loop_stopped=excluded.loop_stopped, diary_request=excluded.diary_request,"
+    " diary_ts=excluded.diary_ts, watched=excluded.watched, extra=excluded.extra"
+)
+
+
+def _record_to_row(uid: int, rec) -> tuple:
+    """``rec`` is a ``UserRecord`` or a plain dict in the JSON schema."""
+    extra = {k: v for k, v in rec.items()
+             if k not in _BOOL_COLUMNS and k not in _INT_COLUMNS and k != "watched"}
+    flags = tuple(None if rec.get(k) is None else int(bool(rec[k])) for k in _BOOL_COLUMNS)
+    return (
+        uid, int(rec.get("stage", 0)), rec.get("ts"), *flags, rec.get("diary_ts"),
+        json.dumps(rec["watched"]) if "watched" in rec else None,
+        json.dumps(extra, ensure_ascii=False) if extra else None,
+    )
+
+
+def _row_to_record(row: sqlite3.Row) -> UserRecord:
+    rec: Dict[str, Any] = {"stage": row["stage"]}
+    for k in ("ts", "diary_ts"):
+        if row[k] is not None:
+            rec[k] = row[k]
+    for k in _BOOL_COLUMNS:
+        if row[k] is not None:
+            rec[k] = bool(row[k])
+    if row["watched"] is not None:
+        rec["watched"] = json.loads(row["watched"])
+    if row["extra"]:
+        rec.update(json.loads(row["extra"]))
+    return UserRecord.from_dict(rec)
+
+
+class SqliteBackend:
+    """SQLite (WAL) persistence with typed columns and stage/ts indexes.
+
+    All queries run on a single dedicated worker thread, so the connection
+    is only ever touched from that thread and never from the event loop.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-store")
+        self._conn: sqlite3.Connection | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(str(self.path), check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SQLITE_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def load(self) -> tuple[Dict[int, UserRecord], Dict[str, Any]]:
+        return self.executor.submit(self._load).result()
+
+    def _load(self):
+        conn = self._connect()
+        users = {row["uid"]: _row_to_record(row) for row in conn.execute("SELECT * FROM users")}
+        sections = {name: json.loads(value) for name, value in conn.execute("SELECT name, value FROM sections")}
+        return users, sections
+
+    def write(self, dirty: Dict[int, Optional[UserRecord]], sections: Dict[str, Any]):
+        conn = self._connect()
+        with conn:
+            conn.executemany(_UPSERT_USER, [_record_to_row(k, rec) for k, rec in dirty.items() if rec is not None])
+            gone = [(k,) for k, rec in dirty.items() if rec is None]
+            if gone:
+                conn.executemany("DELETE FROM users WHERE uid = ?", gone)
+            conn.executemany(
+                "INSERT OR REPLACE INTO sections (name, value) VALUES (?, ?)",
+                [(name, json.dumps(value, ensure_ascii=False)) for name, value in sections.items()],
+            )
+
+    def load_user(self, key: int) -> Optional[UserRecord]:
+        """Fresh copy of one record (another process may have changed it)."""
+        row = self._connect().execute("SELECT * FROM users WHERE uid = ?", (key,)).fetchone()
+        return _row_to_record(row) if row is not None else None
+
+    async def query(self, sql: str, params: tuple = ()) -> list:
+        """Run a read-only query on the store thread (segments, funnel reports)."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: self._connect().execute(sql, params).fetchall())
+
+    def close(self):
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        self.executor.submit(_close).result()
+
+
+def import_json(json_path: Path, db_path: Path) -> int:
+    """One-shot import of stats.json (users + joins/captcha/meta) into SQLite."""
+    src = JsonBackend(json_path)
+    users, sections = src.load()
+    dst = SqliteBackend(db_path)
+    try:
+        dst.executor.submit(dst.write, dict(users), sections).result()
+    finally:
+        dst.close()
+    log.info("store: imported %d users and sections %s from %s into %s",
+             len(users), sorted(sections), json_path, db_path)
+    return len(users)
+
+
+class UserStore:
+    def __init__(self, backend, flush_interval: float = 2.0,
+                 observe: Optional[Callable[[str, float], None]] = None):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.observe = observe  # observe(op, seconds) для load/flush/refresh — метрики
+        self.stage_counts: Dict[int, int] = {}
+        self._users: Dict[int, UserRecord] = {}
+        self._sections: Dict[str, Any] = {}
+        self._dirty: set[int] = set()
+        self._dirty_sections: set[str] = set()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self.last_flush_ms = 0.0
+        self.last_flush_dirty = 0
+        self.flushes = 0
+        self.flush_errors = 0
+
+    # ----- lifecycle -----
+    def load(self):
+        started = perf_counter()
+        self._users, self._sections = self.backend.load()
+        self.stage_counts = {}
+        for rec in self._users.values():
+            self._restage(None, rec)
+        elapsed = perf_counter() - started
+        if self.observe is not None:
+            self.observe("load", elapsed)
+        log.info("store: loaded %d users from %s backend in %.1f ms",
+                 len(self._users), self.backend.name, elapsed * 1000)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        self.backend.close()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("store: flush failed")
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty and not self._dirty_sections:
+                return
+            dirty = {key: self._users.get(key) for key in self._dirty}
+            sections = {name: self._sections.get(name) for name in self._dirty_sections}
+            self._dirty = set()
+            self._dirty_sections = set()
+            started = perf_counter()
+            try:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(getattr(self.backend, "executor", None),
+                                           self.backend.write, dirty, sections)
+            except Exception:
+                # вернуть в очередь то, что не успели записать
+                self._dirty.update(dirty)
+                self._dirty_sections.update(sections)
+                self.flush_errors += 1
+                raise
+            self.last_flush_ms = (perf_counter() - started) * 1000
+            self.last_flush_dirty = len(dirty)
+            if self.observe is not None:
+                self.observe("flush", self.last_flush_ms / 1000)
+            self.flushes += 1
+            log.info("store: flushed %d dirty records (%d sections) in %.1f ms",
+                     len(dirty), len(sections), self.last_flush_ms)
+
+    # ----- shared mode (several processes on one SQLite file) -----
+    async def refresh_user(self, uid: int):
+        """Re-read one record from the backend before working on that user."""
+        if not hasattr(self.backend, "load_user"):
+            return
+        key = int(uid)
+        if key in self._dirty:
+            await self.flush_user(uid)
+        started = perf_counter()
+        loop = asyncio.get_running_loop()
+        rec = await loop.run_in_executor(self.backend.executor, self.backend.load_user, key)
+        if self.observe is not None:
+            self.observe("refresh", perf_counter() - started)
+        self._restage(self._users.get(key), rec)
+        if rec is None:
+            self._users.pop(key, None)
+        else:
+            self._users[key] = rec
+
+    async def flush_user(self, uid: int):
+        """Write one record now, so the next process to take the user sees it."""
+        key = int(uid)
+        if key not in self._dirty:
+            return
+        self._dirty.discard(key)
+        started = perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(getattr(self.backend, "executor", None),
+                                       self.backend.write, {key: self._users.get(key)}, {})
+        except Exception:
+            self._dirty.add(key)
+            self.flush_errors += 1
+            raise
+        if self.observe is not None:
+            self.observe("flush_user", perf_counter() - started)
+
+    # ----- users -----
+    def get_user(self, uid: int):
+        """Read-only ``UserRecord`` (empty dict if unknown)."""
+        return self._users.get(int(uid)) or {}
+
+    def get_field(self, uid: int, name: str, default: Any = None) -> Any:
+        rec = self._users.get(int(uid))
+        if rec is None:
+            return default
+        return rec.get(name, default)
+
+    def update_user(self, uid: int, **fields: Any):
+        key = int(uid)
+        old = self._users.get(key)
+        rec = UserRecord.from_dict(fields) if old is None else old.replace(**fields)
+        if old is None or "stage" in fields:
+            self._restage(old, rec)
+        self._users[key] = rec
+        self._dirty.add(key)
+
+    def _restage(self, old: Optional[UserRecord], new: Optional[UserRecord]):
+        """Keep ``stage_counts`` (users per funnel stage) in step with a record change."""
+        counts = self.stage_counts
+        if old is not None:
+            stage = int(old.get("stage", 0))
+            counts[stage] -= 1
+            if not counts[stage]:
+                del counts[stage]
+        if new is not None:
+            stage = int(new.get("stage", 0))
+            counts[stage] = counts.get(stage, 0) + 1
+
+    def user_count(self) -> int:
+        return len(self._users)
+
+    def iter_users(self):
+        """Snapshot iterator of (uid, record) pairs."""
+        yield from list(self._users.items())
+
+    # ----- sections (joins, captcha, meta, ...) -----
+    def get_section(self, name: str, default: Any = None) -> Any:
+        return self._sections.get(name, default)
+
+    def set_section(self, name: str, value: Any):
+        self._sections[name] = value
+        self._dirty_sections.add(name)
+
+    def section_names(self) -> list[str]:
+        return list(self._sections)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend.name,
+            "users": len(self._users),
+            "dirty": len(self._dirty),
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "last_flush_dirty": self.last_flush_dirty,
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Import data/stats.json into a SQLite store")
+    parser.add_argument("json_path", type=Path)
+    parser.add_argument("db_path", type=Path)
+    args = parser.parse_args()
+    import_json(args.json_path, args.db_path)
@@ -0,0 +1,172 @@
+"""Chats the bot can no longer write to, checked before every API call.
+
+A user who blocked the bot (or deleted their account) answers every send
+with 403, and before this every sender found that out on its own: the
+nurture and reminder jobs, the delayed lesson blocks, ``send_block`` and,
+after each restart, the drip.  ``UnreachableGuard`` is a session
+middleware in front of ``OutboundDispatcher``:
+
+* a ``TelegramForbiddenError`` or a "chat not found" ``TelegramBadRequest``
+  from any call adds the chat to the set;
+* later calls to that private chat fail at once with
+  ``TelegramForbiddenError`` (no request, no rate-limit token), so every
+  existing ``except TelegramForbiddenError`` path stops as before;
+* ``discard()`` (on /start) makes the chat reachable again.
+
+The set is a sorted ``array('q')`` (8 bytes per chat, ``bisect`` lookups),
+written to disk in the background as raw int64s.  With several processes
+(``shared`` is a ``coordination.Coordinator``) changes also go to the
+shared database, and a local hit is confirmed there before it suppresses
+a call, since another worker may have seen that user's /start.
+"""
+import array
+import asyncio
+import logging
+from bisect import bisect_left
+from pathlib import Path
+from typing import Any, Dict
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+from store import atomic_write_bytes
+
+log = logging.getLogger(__name__)
+
+# эти методы не пишут юзеру — их не глушим (заявки, проверка подписки)
+_PASS_METHODS = frozenset({"getChatMember", "approveChatJoinRequest", "declineChatJoinRequest", "getChat"})
+
+
+def is_unreachable_error(e: Exception) -> bool:
+    return isinstance(e, TelegramForbiddenError) or (
+        isinstance(e, TelegramBadRequest) and "chat not found" in str(e).lower()
+    )
+
+
+class UnreachableSet:
+    def __init__(self, path: Path, flush_interval: float = 10.0, shared=None):
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self._ids = array.array("q")
+        self._dirty = False
+        self._task: asyncio.Task | None = None
+        self.added = 0
+        self.cleared = 0
+        self.avoided = 0
+        try:
+            self._ids.frombytes(self.path.read_bytes())
+            self._ids = array.array("q", sorted(set(self._ids)))
+        except FileNotFoundError:
+            pass
+        except Exception:
+            log.exception("unreachable: failed to read %s, starting empty", self.path)
+            self._ids = array.array("q")
+        if shared is not None:
+            for chat_id in shared.unreachable_ids():
+                self._insert(chat_id)
+
+    def __contains__(self, chat_id: int) -> bool:
+        ids = self._ids
+        i = bisect_left(ids, chat_id)
+        return i < len(ids) and ids[i] == chat_id
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def _insert(self, chat_id: int) -> bool:
+        i = bisect_left(self._ids, chat_id)
+        if i < len(self._ids) and self._ids[i] == chat_id:
+            return False
+        self._ids.insert(i, chat_id)
+        return True
+
+    def _remove(self, chat_id: int) -> bool:
+        i = bisect_left(self._ids, chat_id)
+        if i < len(self._ids) and self._ids[i] == chat_id:
+            del self._ids[i]
+            return True
+        return False
+
+    def add(self, chat_id: int):
+        if self._insert(chat_id):
+            self.added += 1
+            self._dirty = True
+            if self.shared is not None:
+                self.shared.set_unreachable(chat_id, True)
+
+    def discard(self, chat_id: int):
+        removed = self._remove(chat_id)
+        if removed:
+            self.cleared += 1
+            self._dirty = True
+        if self.shared is not None:
+            # в другом воркере чат мог попасть в набор без нас
+            self.shared.set_unreachable(chat_id, False)
+
+    async def confirm(self, chat_id: int) -> bool:
+        """Still unreachable? Local answer, checked against the shared set if there is one."""
+        if chat_id not in self:
+            return False
+        if self.shared is None or await self.shared.is_unreachable(chat_id):
+            return True
+        self._remove(chat_id)
+        self._dirty = True
+        return False
+
+    # ----- persistence -----
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("unreachable: flush failed")
+
+    async def flush(self):
+        if not self._dirty or self.shared is not None:
+            return  # в webhook-multi набор живёт в общей базе
+        self._dirty = False
+        await asyncio.to_thread(atomic_write_bytes, self.path, self._ids.tobytes())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "chats": len(self._ids),
+            "bytes": self._ids.itemsize * len(self._ids),
+            "added": self.added,
+            "cleared": self.cleared,
+            "avoided": self.avoided,
+        }
+
+
+class UnreachableGuard(BaseRequestMiddleware):
+    def __init__(self, unreachable: UnreachableSet):
+        self.unreachable = unreachable
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if not isinstance(chat_id, int) or chat_id <= 0 or method.__api_method__ in _PASS_METHODS:
+            return await make_request(bot, method)
+        if chat_id in self.unreachable and await self.unreachable.confirm(chat_id):
+            self.unreachable.avoided += 1
+            raise TelegramForbiddenError(method=method, message="Forbidden: chat is marked unreachable")
+        try:
+            return await make_request(bot, method)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            if is_unreachable_error(e):
+                self.unreachable.add(chat_id)
+            raise
@@ -0,0 +1,99 @@
+"""Bounded in-process queue between the webhook endpoint and update handlers.
+
+The webhook handler only validates the secret, parses the body and calls
+``offer()``; Telegram gets its 200 right away while ``workers`` background
+tasks run the actual handlers.  When the queue is full the behaviour is
+explicit:
+
+* ``reject``      — ``offer()`` returns False and the endpoint answers 503,
+                    so Telegram keeps the update and redelivers it later;
+* ``drop_oldest`` — the oldest queued update is discarded to make room.
+"""
+import asyncio
+import logging
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict
+
+log = logging.getLogger(__name__)
+
+OVERFLOW_MODES = ("reject", "drop_oldest")
+
+
+class UpdateQueue:
+    def __init__(self, process: Callable[[Dict[str, Any]], Awaitable[Any]],
+                 maxsize: int = 1000, workers: int = 8, overflow: str = "reject"):
+        if overflow not in OVERFLOW_MODES:
+            raise ValueError(f"overflow must be one of {OVERFLOW_MODES}, got {overflow!r}")
+        self.process = process
+        self.workers = workers
+        self.overflow = overflow
+        self._queue: asyncio.Queue[tuple[float, Dict[str, Any]]] = asyncio.Queue(maxsize=maxsize)
+        self._tasks: list[asyncio.Task] = []
+        self.accepted = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.processed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+
+    def offer(self, raw: Dict[str, Any]) -> bool:
+        item = (monotonic(), raw)
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            if self.overflow == "reject":
+                self.rejected += 1
+                return False
+            self._queue.get_nowait()
+            self._queue.task_done()
+            self.dropped += 1
+            self._queue.put_nowait(item)
+        self.accepted += 1
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self, drain_timeout: float = 10.0):
+        """Let workers finish what is queued (up to ``drain_timeout``), then stop."""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            log.warning("update queue: %d updates left unprocessed at shutdown", self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            received, raw = await self._queue.get()
+            lag = monotonic() - received
+            self.lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
+            try:
+                await self.process(raw)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                log.exception("update queue: failed to process update %s", raw.get("update_id"))
+            finally:
+                self._queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        started = self.processed + self.failed
+        return {
+            "depth": self._queue.qsize(),
+            "max_depth": self.max_depth,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "dropped": self.dropped,
+            "processed": self.processed,
+            "failed": self.failed,
+            "lag_avg_ms": round(self.lag_total / started * 1000, 1) if started else 0.0,
+            "lag_max_ms": round(self.lag_max * 1000, 1),
+        }